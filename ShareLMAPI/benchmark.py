@@ -0,0 +1,242 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import re
+import time
+from collections import Counter
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "the model server shares one language model between many programs and devices while the gateway "
+    "routes requests batches tokens streams answers keeps latency low under load for every user"
+).split()
+
+def parse_range(spec):
+    # "128" is a fixed value, "32:256" is uniform between the two bounds.
+    low, _, high = str(spec).partition(":")
+    return int(low), int(high or low)
+
+def build_payload(rng, prompt_words, output_tokens, temperature):
+    words = rng.randint(*prompt_words)
+    return {
+        "dialogue_history": [{"role": "user", "content": " ".join(rng.choice(WORDS) for _ in range(words))}],
+        "max_length": rng.randint(*output_tokens),
+        "temperature": temperature
+    }
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def describe(values):
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99)
+    }
+
+def summarize(records, duration, generated_tokens=None):
+    succeeded = [record for record in records if record["ok"]]
+    if generated_tokens is None and succeeded and all(record.get("output_tokens") is not None for record in succeeded):
+        generated_tokens = sum(record["output_tokens"] for record in succeeded)
+    return {
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "error_rate": (len(records) - len(succeeded)) / len(records) if records else 0.0,
+        "errors": dict(Counter(str(record.get("status") or record.get("error")) for record in records if not record["ok"])),
+        "duration_s": duration,
+        "requests_per_s": len(succeeded) / duration if duration else None,
+        "generated_tokens": generated_tokens,
+        "tokens_per_s": generated_tokens / duration if generated_tokens is not None and duration else None,
+        "ttft_s": describe([record["ttft"] for record in succeeded]),
+        "latency_s": describe([record["latency"] for record in succeeded])
+    }
+
+async def send_request(client, payload, stream):
+    record = {"ok": False, "max_length": payload["max_length"]}
+    started_at = time.perf_counter()
+    try:
+        if stream:
+            ttft = None
+            chunks = []
+            async with client.stream("POST", "/generate_stream", json={**payload, "stream_format": "ndjson"}) as response:
+                record["status"] = response.status_code
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "token":
+                        if ttft is None:
+                            ttft = time.perf_counter() - started_at
+                        chunks.append(event["text"])
+                    elif event["type"] == "done":
+                        record["output_tokens"] = event["usage"]["completion_tokens"]
+                    elif event["type"] == "error":
+                        # The response already started with 200, so report the in-band failure instead.
+                        record["status"] = None
+                        record["error"] = event["detail"]
+                        return record
+            text = "".join(chunks)
+        else:
+            response = await client.post("/generate", json=payload)
+            record["status"] = response.status_code
+            response.raise_for_status()
+            body = response.json()
+            text = body["generated_text"]
+            record["output_tokens"] = body.get("usage", {}).get("completion_tokens")
+        record["latency"] = time.perf_counter() - started_at
+        record["ttft"] = ttft if stream and ttft is not None else record["latency"]
+        record["output_chars"] = len(text)
+        record["ok"] = True
+    except httpx.HTTPStatusError:
+        record["error"] = f"HTTP {record['status']}"
+    except httpx.HTTPError as e:
+        record["error"] = type(e).__name__
+    return record
+
+async def scrape_generated_tokens(client, metrics_url):
+    try:
+        response = await client.get(metrics_url)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not scrape {metrics_url}: {str(e)}")
+        return None
+    match = re.search(r"^sharelmapi_generated_tokens_total (\S+)$", response.text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+async def run_benchmark(base_url, num_requests=100, concurrency=8, prompt_words=(32, 256), output_tokens=(16, 128),
+                        stream=False, temperature=1.0, seed=0, timeout=300, metrics_url=None, transport=None):
+    rng = random.Random(seed)
+    payloads = [build_payload(rng, prompt_words, output_tokens, temperature) for _ in range(num_requests)]
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits, transport=transport) as client:
+        async def bounded(payload):
+            async with semaphore:
+                return await send_request(client, payload, stream)
+
+        tokens_before = await scrape_generated_tokens(client, metrics_url) if metrics_url else None
+        started_at = time.perf_counter()
+        records = await asyncio.gather(*(bounded(payload) for payload in payloads))
+        duration = time.perf_counter() - started_at
+        tokens_after = await scrape_generated_tokens(client, metrics_url) if metrics_url else None
+
+    generated_tokens = None
+    if tokens_before is not None and tokens_after is not None:
+        generated_tokens = tokens_after - tokens_before
+    return {
+        "config": {
+            "base_url": base_url,
+            "num_requests": num_requests,
+            "concurrency": concurrency,
+            "prompt_words": list(prompt_words),
+            "output_tokens": list(output_tokens),
+            "stream": stream,
+            "temperature": temperature,
+            "seed": seed
+        },
+        "summary": summarize(records, duration, generated_tokens),
+        "records": records
+    }
+
+def compare(result, baseline):
+    rows = [("requests_per_s",), ("tokens_per_s",), ("error_rate",)]
+    rows += [(metric, stat) for metric in ("ttft_s", "latency_s") for stat in ("p50", "p95", "p99")]
+    lines = []
+    for row in rows:
+        current, previous = result["summary"], baseline["summary"]
+        for key in row:
+            current, previous = (current or {}).get(key), (previous or {}).get(key)
+        name = ".".join(row)
+        if current is None or previous is None:
+            lines.append(f"{name:<20} {'-' if previous is None else f'{previous:.4f}':>12} "
+                         f"{'-' if current is None else f'{current:.4f}':>12}")
+            continue
+        change = f"{(current - previous) / previous * 100:+.1f}%" if previous else ""
+        lines.append(f"{name:<20} {previous:>12.4f} {current:>12.4f} {change:>9}")
+    return "\n".join(lines)
+
+def format_summary(summary):
+    lines = [f"requests: {summary['succeeded']}/{summary['requests']} succeeded "
+             f"(error rate {summary['error_rate']:.2%}) in {summary['duration_s']:.2f}s"]
+    lines.append(f"throughput: {summary['requests_per_s']:.2f} req/s"
+                 + (f", {summary['tokens_per_s']:.1f} tokens/s" if summary["tokens_per_s"] is not None else ""))
+    for metric in ("ttft_s", "latency_s"):
+        stats = summary[metric]
+        if stats["p50"] is not None:
+            lines.append(f"{metric}: p50 {stats['p50']:.3f}  p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+    if summary["errors"]:
+        lines.append(f"errors: {summary['errors']}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a ShareLMAPI gateway or model server")
+    parser.add_argument("--url", default="http://localhost:8000", help="Gateway or model server base URL")
+    parser.add_argument("--num-requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--prompt-words", default="32:256", help="Prompt length in words, N or MIN:MAX")
+    parser.add_argument("--output-tokens", default="16:128", help="max_length per request, N or MIN:MAX")
+    parser.add_argument("--stream", action="store_true", help="Use /generate_stream instead of /generate")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--metrics-url", default=None,
+                        help="Model server /metrics URL used to count generated tokens, e.g. http://localhost:5000/metrics")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(
+        args.url,
+        num_requests=args.num_requests,
+        concurrency=args.concurrency,
+        prompt_words=parse_range(args.prompt_words),
+        output_tokens=parse_range(args.output_tokens),
+        stream=args.stream,
+        temperature=args.temperature,
+        seed=args.seed,
+        timeout=args.timeout,
+        metrics_url=args.metrics_url
+    ))
+    print(format_summary(result["summary"]))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare(result, json.load(file)))
+
+if __name__ == "__main__":
+    main()
@@ -19,46 +19,327 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from requests.adapters import HTTPAdapter
+import asyncio
+import httpx
 import requests
+import json
 import logging
+import random
+import time
+
+# Statuses worth retrying: overload (429/503) and a gateway that lost its backend (502/504).
+RETRY_STATUSES = {429, 502, 503, 504}
+
+def build_payload(prompt=None, dialogue_history=None, system_prompt=None, max_length=50, temperature=1.0,
+                  generation_kwargs=None, request_id=None, timeout=None):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if dialogue_history:
+        messages.extend(dialogue_history)
+    elif prompt:
+        messages.append({"role": "user", "content": prompt})
+    else:
+        raise ValueError("Either 'prompt' or 'dialogue_history' must be provided.")
+
+    return {
+        "dialogue_history": messages,
+        "max_length": max_length,
+        "temperature": temperature,
+        "generation_kwargs": generation_kwargs or {},
+        "request_id": request_id,
+        "timeout": timeout
+    }
+
+def retry_delay(attempt, backoff, retry_after=None):
+    # Honour the server's Retry-After, otherwise back off exponentially with jitter.
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+
+def parse_event(line):
+    event = json.loads(line)
+    if event["type"] == "error":
+        raise RuntimeError(event["detail"])
+    return event
+
+def batch_kwargs(item, kwargs):
+    # Batch items are either a prompt string or a dict of generate_text arguments.
+    if isinstance(item, dict):
+        return {**kwargs, **item}
+    return {**kwargs, "prompt": item}
 
 class ShareLMClient:
-    def __init__(self, base_url):
+    def __init__(self, base_url, pool_size=10, max_retries=3, backoff=0.5, timeout=None):
         self.base_url = base_url
         self.logger = logging.getLogger(__name__)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Reuse connections across calls instead of opening a new one per request.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Usage, timing and finish reason from the last completed stream.
+        self.last_stream_info = None
+        # Pass to cancel() to stop the most recent generation.
+        self.last_request_id = None
 
-    def generate_text(self, prompt=None, dialogue_history=None, system_prompt=None, max_length=50, temperature=1.0, streamer=False, generation_kwargs=None):
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        if dialogue_history:
-            messages.extend(dialogue_history)
-        elif prompt:
-            messages.append({"role": "user", "content": prompt})
-        else:
-            raise ValueError("Either 'prompt' or 'dialogue_history' must be provided.")
-
-        payload = {
-            "dialogue_history": messages,
-            "max_length": max_length,
-            "temperature": temperature,
-            "generation_kwargs": generation_kwargs or {}
-        }
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _post(self, endpoint, payload, stream=False):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(f"{self.base_url}/{endpoint}", json=payload, stream=stream,
+                                             timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.logger.warning(f"Retrying {endpoint} after error: {str(e)}")
+                time.sleep(retry_delay(attempt, self.backoff))
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                response.close()
+                self.logger.warning(f"Retrying {endpoint} after HTTP {response.status_code}")
+                time.sleep(retry_delay(attempt, self.backoff, response.headers.get("Retry-After")))
+            attempt += 1
+
+    def generate_text(self, prompt=None, dialogue_history=None, system_prompt=None, max_length=50, temperature=1.0, streamer=False, generation_kwargs=None, request_id=None, timeout=None):
+        payload = build_payload(prompt, dialogue_history, system_prompt, max_length, temperature, generation_kwargs,
+                                request_id, timeout)
         try:
             if streamer:
-                response = requests.post(f"{self.base_url}/generate_stream", json=payload, stream=True)
-                response.raise_for_status()
+                payload["stream_format"] = "ndjson"
+                response = self._post("generate_stream", payload, stream=True)
+                self.last_request_id = response.headers.get("X-Request-ID")
                 return self._handle_streaming_response(response)
             else:
-                response = requests.post(f"{self.base_url}/generate", json=payload)
-                response.raise_for_status()
+                response = self._post("generate", payload)
+                self.last_request_id = response.headers.get("X-Request-ID")
                 return response.json()["generated_text"]
         except requests.RequestException as e:
             self.logger.error(f"Error in generate_text: {str(e)}")
             raise
 
+    def generate_batch(self, prompts, concurrency=8, return_exceptions=False, **kwargs):
+        return list(self.map(prompts, concurrency=concurrency, return_exceptions=return_exceptions, **kwargs))
+
+    def map(self, prompts, concurrency=8, ordered=True, return_exceptions=False, **kwargs):
+        # Yields results in input order, or (index, result) pairs as they complete when ordered=False.
+        # Prompts are consumed lazily, so arbitrarily long iterables run in constant memory.
+        kwargs["streamer"] = False
+
+        def run(item):
+            try:
+                return self.generate_text(**batch_kwargs(item, kwargs))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            if ordered:
+                # A window larger than the pool keeps workers busy while the head of the queue is slow.
+                window = deque()
+                for item in prompts:
+                    window.append(pool.submit(run, item))
+                    if len(window) >= 2 * concurrency:
+                        yield window.popleft().result()
+                while window:
+                    yield window.popleft().result()
+            else:
+                running = {}
+                for index, item in enumerate(prompts):
+                    running[pool.submit(run, item)] = index
+                    if len(running) >= concurrency:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield running.pop(future), future.result()
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield running.pop(future), future.result()
+        finally:
+            # Drop queued prompts if the caller stops iterating or a request failed.
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def cancel(self, request_id=None):
+        request_id = request_id or self.last_request_id
+        try:
+            response = self.session.post(f"{self.base_url}/cancel", json={"request_id": request_id},
+                                         timeout=self.timeout)
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            self.logger.error(f"Error in cancel: {str(e)}")
+            raise
+
     def _handle_streaming_response(self, response):
-        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
-            if chunk:
-                yield chunk.replace('\n', '')
\ No newline at end of file
+        self.last_stream_info = None
+        try:
+            for line in response.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                event = parse_event(line)
+                if event["type"] == "token":
+                    yield event["text"]
+                elif event["type"] == "done":
+                    self.last_stream_info = event
+        finally:
+            # Closing the connection early (e.g. the caller stops iterating) cancels the generation server-side.
+            response.close()
+
+class AsyncShareLMClient:
+    def __init__(self, base_url, pool_size=10, max_retries=3, backoff=0.5, timeout=None, transport=None):
+        self.base_url = base_url
+        self.logger = logging.getLogger(__name__)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout, transport=transport)
+        # Usage, timing and finish reason from the last completed stream.
+        self.last_stream_info = None
+        # Pass to cancel() to stop the most recent generation.
+        self.last_request_id = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _post(self, endpoint, payload, stream=False):
+        attempt = 0
+        while True:
+            try:
+                request = self.client.build_request("POST", f"/{endpoint}", json=payload)
+                response = await self.client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.logger.warning(f"Retrying {endpoint} after error: {str(e)}")
+                await asyncio.sleep(retry_delay(attempt, self.backoff))
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    if response.is_error:
+                        await response.aclose()
+                    response.raise_for_status()
+                    return response
+                await response.aclose()
+                self.logger.warning(f"Retrying {endpoint} after HTTP {response.status_code}")
+                await asyncio.sleep(retry_delay(attempt, self.backoff, response.headers.get("Retry-After")))
+            attempt += 1
+
+    async def generate_text(self, prompt=None, dialogue_history=None, system_prompt=None, max_length=50, temperature=1.0, streamer=False, generation_kwargs=None, request_id=None, timeout=None):
+        payload = build_payload(prompt, dialogue_history, system_prompt, max_length, temperature, generation_kwargs,
+                                request_id, timeout)
+        try:
+            if streamer:
+                payload["stream_format"] = "ndjson"
+                response = await self._post("generate_stream", payload, stream=True)
+                self.last_request_id = response.headers.get("X-Request-ID")
+                return self._handle_streaming_response(response)
+            else:
+                response = await self._post("generate", payload)
+                self.last_request_id = response.headers.get("X-Request-ID")
+                return response.json()["generated_text"]
+        except httpx.HTTPError as e:
+            self.logger.error(f"Error in generate_text: {str(e)}")
+            raise
+
+    async def generate_batch(self, prompts, concurrency=8, return_exceptions=False, **kwargs):
+        return [result async for result in self.map(prompts, concurrency=concurrency,
+                                                    return_exceptions=return_exceptions, **kwargs)]
+
+    async def map(self, prompts, concurrency=8, ordered=True, return_exceptions=False, **kwargs):
+        # Same contract as ShareLMClient.map, with tasks instead of threads.
+        kwargs["streamer"] = False
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with semaphore:
+                try:
+                    return await self.generate_text(**batch_kwargs(item, kwargs))
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    return e
+
+        window = deque()
+        running = {}
+        try:
+            if ordered:
+                for item in prompts:
+                    window.append(asyncio.ensure_future(run(item)))
+                    if len(window) >= 2 * concurrency:
+                        yield await window.popleft()
+                while window:
+                    yield await window.popleft()
+            else:
+                for index, item in enumerate(prompts):
+                    running[asyncio.ensure_future(run(item))] = index
+                    if len(running) >= concurrency:
+                        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield running.pop(task), task.result()
+                while running:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield running.pop(task), task.result()
+        finally:
+            # Stop outstanding requests if the caller stops iterating or a request failed, and wait for them
+            # so none outlives the iteration.
+            pending = [*window, *running]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def cancel(self, request_id=None):
+        request_id = request_id or self.last_request_id
+        try:
+            response = await self.client.post("/cancel", json={"request_id": request_id})
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            return True
+        except httpx.HTTPError as e:
+            self.logger.error(f"Error in cancel: {str(e)}")
+            raise
+
+    async def _handle_streaming_response(self, response):
+        self.last_stream_info = None
+        try:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                event = parse_event(line)
+                if event["type"] == "token":
+                    yield event["text"]
+                elif event["type"] == "done":
+                    self.last_stream_info = event
+        finally:
+            await response.aclose()
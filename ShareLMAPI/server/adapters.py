@@ -0,0 +1,113 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.ipc import AdapterNotFoundError
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rows of a mixed batch that should run on the plain base model.
+BASE_ADAPTER = "__base__"
+
+# LoRA adapters attached to one resident base model. Adapters load on first use and the least
+# recently used idle ones are unloaded once more than `max_loaded` are attached.
+class AdapterCache:
+    def __init__(self, model_loader, paths, max_loaded=8):
+        self.model_loader = model_loader
+        self.paths = dict(paths)
+        self.max_loaded = max(1, max_loaded)
+        # Held around every forward pass: attaching or deleting an adapter rewrites the model's layers.
+        self.lock = threading.RLock()
+        self._leases_lock = threading.Lock()
+        # name -> requests using it, least recently used first.
+        self._leases = OrderedDict()
+        self._wrapped = False
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def acquire(self, name):
+        # Blocks while an adapter loads or a forward pass runs, so call it from a worker thread.
+        if name not in self.paths:
+            raise AdapterNotFoundError(name)
+        with self._leases_lock:
+            if name in self._leases:
+                self._leases[name] += 1
+                self._leases.move_to_end(name)
+                self.hits += 1
+                return
+        with self.lock:
+            if name not in self._leases:
+                self._load(name)
+            with self._leases_lock:
+                self._leases[name] = self._leases.get(name, 0) + 1
+                self._leases.move_to_end(name)
+            self._evict()
+
+    def release(self, name):
+        with self._leases_lock:
+            self._leases[name] -= 1
+
+    def _load(self, name):
+        started_at = time.monotonic()
+        model = self.model_loader.model
+        if self._wrapped:
+            model.load_adapter(self.paths[name], adapter_name=name)
+        else:
+            # The first adapter wraps the base model; later ones are added to the same wrapper.
+            from peft import PeftModel
+            self.model_loader.model = PeftModel.from_pretrained(model, self.paths[name], adapter_name=name)
+            self._wrapped = True
+        self.model_loader.model.eval()
+        self.loads += 1
+        logger.info(f"Loaded adapter {name} in {time.monotonic() - started_at:.2f}s")
+
+    def _evict(self):
+        model = self.model_loader.model
+        while len(self._leases) > self.max_loaded:
+            with self._leases_lock:
+                idle = [name for name, leases in self._leases.items() if leases == 0]
+                if not idle:
+                    logger.warning(f"{len(self._leases)} adapters are in use, above adapters.max_loaded "
+                                   f"({self.max_loaded})")
+                    return
+                victim = idle[0]
+                del self._leases[victim]
+            logger.info(f"Evicting least recently used adapter {victim}")
+            model.delete_adapter(victim)
+            if model.active_adapter not in model.peft_config:
+                model.set_adapter(next(iter(model.peft_config)))
+            self.evictions += 1
+
+    def forward_kwargs(self, names):
+        # Per-row adapters for one forward pass; call with `lock` held.
+        if not self._wrapped:
+            return {}
+        return {"adapter_names": [name or BASE_ADAPTER for name in names]}
+
+    def stats(self):
+        with self._leases_lock:
+            loaded = dict(self._leases)
+        return {"loaded": loaded, "available": len(self.paths), "max_loaded": self.max_loaded,
+                "hits": self.hits, "loads": self.loads, "evictions": self.evictions}
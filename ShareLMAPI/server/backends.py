@@ -0,0 +1,110 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def load(self):
+        return self.in_flight + self.queue_depth
+
+    def available(self, now=None):
+        return self.healthy and (now or time.monotonic()) >= self.ejected_until
+
+class BackendPool:
+    def __init__(self, urls, health_check_interval=5, health_check_timeout=2, failure_threshold=3,
+                 ejection_time=30, session_affinity=True):
+        self.backends = [Backend(url) for url in urls]
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.failure_threshold = failure_threshold
+        self.ejection_time = ejection_time
+        self.session_affinity = session_affinity
+
+    @classmethod
+    def from_config(cls, model_server_config):
+        urls = model_server_config.get("model_server_urls") or [model_server_config["model_server_url"]]
+        return cls(
+            urls,
+            health_check_interval=model_server_config.get("health_check_interval", 5),
+            health_check_timeout=model_server_config.get("health_check_timeout", 2),
+            failure_threshold=model_server_config.get("failure_threshold", 3),
+            ejection_time=model_server_config.get("ejection_time", 30),
+            session_affinity=model_server_config.get("session_affinity", True)
+        )
+
+    def choose(self, session_id=None, exclude=()):
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        available = [backend for backend in candidates if backend.available(now)]
+        # With every backend down, keep trying them rather than failing outright.
+        candidates = available or candidates
+        if session_id and self.session_affinity:
+            # Rendezvous hashing keeps a session on the same backend while it stays available.
+            return max(candidates, key=lambda backend: hashlib.sha1(f"{session_id}|{backend.url}".encode()).digest())
+        return min(candidates, key=lambda backend: backend.load)
+
+    def record_success(self, backend):
+        backend.consecutive_failures = 0
+
+    def record_failure(self, backend):
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.failure_threshold and backend.available():
+            logger.warning(f"Ejecting model server {backend.url} after {backend.consecutive_failures} failures")
+            backend.ejected_until = time.monotonic() + self.ejection_time
+
+    async def check(self, http_client, backend):
+        try:
+            # /ready, not /health: a model server that is still loading or warming up gets no traffic.
+            response = await http_client.get(f"{backend.url}/ready", timeout=self.health_check_timeout)
+            response.raise_for_status()
+            backend.queue_depth = response.json().get("queue_depth", 0)
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"Model server {backend.url} failed health check: {str(e)}")
+            backend.healthy = False
+            self.record_failure(backend)
+            return
+        if not backend.healthy:
+            logger.info(f"Model server {backend.url} is healthy again")
+        backend.healthy = True
+        if time.monotonic() >= backend.ejected_until:
+            backend.consecutive_failures = 0
+
+    async def run_health_checks(self, http_client):
+        while True:
+            await asyncio.gather(*(self.check(http_client, backend) for backend in self.backends))
+            await asyncio.sleep(self.health_check_interval)
@@ -0,0 +1,200 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.config import DEFAULT_CONFIG_PATH
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.schemas import GenerateRequest
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Each output line is {"line": <input line number>, ...result} or {"line": ..., "error": ...}. Results are
+# written as they finish, so they are not in input order.
+
+def prompt_length(record):
+    # Characters are a cheap stand-in for tokens when grouping prompts of similar length.
+    if not isinstance(record, dict):
+        return 0
+    if record.get("input_ids"):
+        return len(record["input_ids"])
+    return sum(len(message.get("content", "")) for message in record.get("dialogue_history", []))
+
+def checkpoint_path(output_path):
+    return f"{output_path}.checkpoint"
+
+def read_checkpoint(output_path):
+    try:
+        with open(checkpoint_path(output_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_checkpoint(output_path, state):
+    path = checkpoint_path(output_path)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+def engine_generate(engine, priority="bulk"):
+    async def generate(record):
+        request = GenerateRequest.model_validate({**record, "streamer": False, "priority": priority})
+        return await engine.generate(request)
+    return generate
+
+def http_generate(client, priority="bulk"):
+    async def generate(record):
+        response = await client.post("/generate", json={**record, "streamer": False, "priority": priority})
+        if response.status_code in (429, 503):
+            raise QueueFullError(retry_after=float(response.headers.get("Retry-After", 1)))
+        response.raise_for_status()
+        return response.json()
+    return generate
+
+class BulkJob:
+    def __init__(self, generate, input_path, output_path, window_size=1024, concurrency=16):
+        self.generate = generate
+        self.input_path = input_path
+        self.output_path = output_path
+        self.window_size = max(1, window_size)
+        self.concurrency = max(1, concurrency)
+        # "line"/"offset" point at the first input line of the window that has not fully completed.
+        self.state = {"line": 0, "offset": 0, "completed": 0, "errors": 0, "done": False}
+
+    async def run(self):
+        self.state = read_checkpoint(self.output_path) or self.state
+        if self.state["done"]:
+            return self.state
+        finished = self._resume_output()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with open(self.input_path, "rb") as source, open(self.output_path, "ab") as sink:
+            source.seek(self.state["offset"])
+            while window := self._read_window(source):
+                # Requests that run together have similar lengths, which keeps padding in each batch low.
+                todo = sorted((item for item in window if item[0] not in finished), key=lambda item: prompt_length(item[1]))
+                await asyncio.gather(*(self._process(line, record, sink, semaphore) for line, record in todo))
+                sink.flush()
+                os.fsync(sink.fileno())
+                self.state["line"] += len(window)
+                self.state["offset"] = source.tell()
+                write_checkpoint(self.output_path, self.state)
+                finished = set()
+        self.state["done"] = True
+        write_checkpoint(self.output_path, self.state)
+        return self.state
+
+    def _resume_output(self):
+        # Drop a line torn by a crash and find which lines of the interrupted window were already written.
+        finished = set()
+        if not os.path.exists(self.output_path):
+            return finished
+        with open(self.output_path, "r+b") as sink:
+            valid_end = 0
+            for raw in iter(sink.readline, b""):
+                if not raw.endswith(b"\n"):
+                    break
+                valid_end += len(raw)
+                result = json.loads(raw)
+                if result["line"] >= self.state["line"]:
+                    finished.add(result["line"])
+                    self.state["errors" if "error" in result else "completed"] += 1
+            sink.truncate(valid_end)
+        return finished
+
+    def _read_window(self, source):
+        window = []
+        line = self.state["line"]
+        while len(window) < self.window_size and (raw := source.readline()):
+            if raw.strip():
+                try:
+                    window.append((line, json.loads(raw)))
+                except json.JSONDecodeError as e:
+                    window.append((line, e))
+            else:
+                window.append((line, None))
+            line += 1
+        return window
+
+    async def _process(self, line, record, sink, semaphore):
+        if record is None:
+            return
+        if isinstance(record, Exception):
+            result = {"error": f"Invalid JSON: {str(record)}"}
+        elif not isinstance(record, dict):
+            result = {"error": "Invalid request: expected a JSON object"}
+        else:
+            async with semaphore:
+                result = await self._generate(record)
+            if record.get("request_id"):
+                result["request_id"] = record["request_id"]
+        self.state["errors" if "error" in result else "completed"] += 1
+        sink.write((json.dumps({"line": line, **result}, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    async def _generate(self, record):
+        while True:
+            try:
+                return await self.generate(record)
+            except QueueFullError as e:
+                # Back-pressure is expected when interactive traffic is busy; wait rather than fail.
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Error in bulk request: {str(e)}")
+                return {"error": str(e)}
+
+async def run_job(args):
+    if args.url:
+        import httpx
+        async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+            job = BulkJob(http_generate(client), args.input, args.output, args.window_size, args.concurrency)
+            return await job.run()
+
+    from ShareLMAPI.server.registry import ModelRegistry
+    engine = ModelRegistry(args.config)
+    try:
+        # The engine serves nothing else here, so let the job use every batch slot.
+        job = BulkJob(engine_generate(engine, priority="interactive"), args.input, args.output, args.window_size,
+                      args.concurrency or 2 * engine.config.get("scheduler", {}).get("max_batch_size", 8))
+        return await job.run()
+    finally:
+        await engine.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of generate requests through ShareLMAPI")
+    parser.add_argument("input", help="JSONL file with one GenerateRequest per line")
+    parser.add_argument("output", help="JSONL results file; rerun the same command to resume")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="Load the model in-process from this config")
+    parser.add_argument("--url", default=None, help="Send requests to a running model server or gateway instead")
+    parser.add_argument("--window-size", type=int, default=1024, help="Lines read, sorted and checkpointed together")
+    parser.add_argument("--concurrency", type=int, default=None, help="Requests in flight (default: 16 with --url, "
+                                                                       "twice the batch size in-process)")
+    args = parser.parse_args()
+    if args.url and args.concurrency is None:
+        args.concurrency = 16
+
+    logging.basicConfig(level=logging.INFO)
+    state = asyncio.run(run_job(args))
+    logger.info(f"Bulk job finished: {state['completed']} completed, {state['errors']} errors")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,722 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from starlette.concurrency import iterate_in_threadpool
+from ShareLMAPI.server.load_model import ModelLoader
+from ShareLMAPI.server.config import DEFAULT_CONFIG_PATH
+from ShareLMAPI.server.executor import InferenceExecutor, QueueFullError
+from ShareLMAPI.server.scheduler import BatchScheduler, SamplingParams, GENERATED_TOKENS, STOPPED_REQUESTS
+from ShareLMAPI.server.prefix_cache import PrefixCache
+from ShareLMAPI.server.response_cache import ResponseCache
+from ShareLMAPI.server.adapters import AdapterCache
+from ShareLMAPI.server.tokenization import TokenizationStage
+from ShareLMAPI.server.tenants import TenantPolicy
+from ShareLMAPI.server.speculative import SpeculativeDecoder
+from ShareLMAPI.server.memory import MemoryEstimator, build_budget, CAPPED_REQUESTS
+from ShareLMAPI.server.schemas import GenerateRequest
+from ShareLMAPI.server.metrics import REGISTRY, Gauge, Histogram
+from ShareLMAPI.server import ipc
+import argparse
+import asyncio
+import logging
+import os
+import time
+import torch
+import uuid
+import weakref
+
+logger = logging.getLogger(__name__)
+
+_engines = weakref.WeakSet()
+
+def _collect(*path):
+    values = {}
+    for engine in list(_engines):
+        value = engine.snapshot()
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            values[engine.model_identity] = value
+    return values
+
+TOKENIZATION_TIME = Histogram("sharelmapi_tokenization_time_seconds", "Time spent applying the chat template and tokenizing")
+Gauge("sharelmapi_queue_depth", "Requests waiting for the scheduler or an inference worker", ("model",),
+      function=lambda: _collect("queue_depth"))
+Gauge("sharelmapi_engine_in_flight", "Requests being decoded or run by an inference worker", ("model",),
+      function=lambda: _collect("in_flight"))
+Gauge("sharelmapi_batch_occupancy", "Sequences in the current decode batch", ("model",),
+      function=lambda: _collect("batch_size"))
+Gauge("sharelmapi_prefix_cache_hits", "Prefix cache lookups that reused cached KV", ("model",),
+      function=lambda: _collect("prefix_cache", "hits"))
+Gauge("sharelmapi_prefix_cache_misses", "Prefix cache lookups without a usable prefix", ("model",),
+      function=lambda: _collect("prefix_cache", "misses"))
+Gauge("sharelmapi_prefix_cache_bytes", "Memory held by the prefix cache", ("model",),
+      function=lambda: _collect("prefix_cache", "bytes"))
+Gauge("sharelmapi_response_cache_hits", "Requests answered from the response cache", ("model",),
+      function=lambda: _collect("response_cache", "hits"))
+Gauge("sharelmapi_response_cache_misses", "Cacheable requests that had to be generated", ("model",),
+      function=lambda: _collect("response_cache", "misses"))
+Gauge("sharelmapi_tokenization_cache_hits", "Prompts that reused memoized token ids of a conversation prefix",
+      ("model",), function=lambda: _collect("tokenization_cache", "hits"))
+Gauge("sharelmapi_speculative_acceptance_rate", "Share of draft tokens accepted by the model", ("model",),
+      function=lambda: _collect("speculative", "acceptance_rate"))
+Gauge("sharelmapi_memory_reserved_bytes", "Memory reserved by admitted requests", ("model",),
+      function=lambda: _collect("memory", "reserved_bytes"))
+Gauge("sharelmapi_memory_free_bytes", "Memory budget left for new requests", ("model",),
+      function=lambda: _collect("memory", "free_bytes"))
+Gauge("sharelmapi_tokenization_cache_reused_tokens", "Prompt tokens taken from the tokenization cache",
+      ("model",), function=lambda: _collect("tokenization_cache", "reused_tokens"))
+
+def _usage(prompt_tokens, completion_tokens):
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+def _finish_reason(completion_tokens, generation_kwargs):
+    return "length" if completion_tokens >= generation_kwargs["max_new_tokens"] else "stop"
+
+def _done_event(finish_reason, prompt_tokens, completion_tokens, timing):
+    return {"type": "done", "finish_reason": finish_reason,
+            "usage": _usage(prompt_tokens, completion_tokens), "timing": timing}
+
+class _CountingStreamer(TextIteratorStreamer):
+    # Counts generated tokens so the non-batched path can report usage like the scheduler does.
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.completion_tokens = 0
+        self.error = None
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.completion_tokens += value.numel()
+        super().put(value)
+
+class _StopCriteria(StoppingCriteria):
+    # Gives model.generate the same cancel/deadline handle as a scheduled GenerationSequence.
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self._cancel_reason = None
+
+    def cancel(self, reason="cancelled"):
+        self._cancel_reason = reason
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.reason is None:
+            if self._cancel_reason is not None:
+                self.reason = self._cancel_reason
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.reason = "timeout"
+            if self.reason is not None:
+                STOPPED_REQUESTS.labels(reason=self.reason).inc()
+        return torch.full((input_ids.shape[0],), self.reason is not None, dtype=torch.bool, device=input_ids.device)
+
+def _sequence_timings(sequence):
+    timings = {}
+    if sequence.prefill_started_at is not None:
+        timings["queue"] = sequence.prefill_started_at - sequence.submitted_at
+    if sequence.first_token_at is not None:
+        timings["ttft"] = sequence.first_token_at - sequence.submitted_at
+    return timings
+
+class InferenceEngine:
+    def __init__(self, config_path=DEFAULT_CONFIG_PATH, config=None):
+        self.model_loader = ModelLoader(config_path, config)
+        self.config = self.model_loader.config
+        self.memory_bytes = self.model_loader.memory_bytes()
+        # Requests currently using this engine; the model registry closes retired engines once this drops to 0.
+        self.leases = 0
+
+        executor_config = self.config.get("executor", {})
+        self.executor = InferenceExecutor(
+            max_workers=executor_config.get("max_workers", 2),
+            max_queue_size=executor_config.get("max_queue_size", 16),
+            retry_after=executor_config.get("retry_after", 1)
+        )
+
+        prefix_cache_config = self.config.get("prefix_cache", {})
+        self.prefix_cache = None
+        if prefix_cache_config.get("enabled", True):
+            self.prefix_cache = PrefixCache(
+                max_bytes=int(prefix_cache_config.get("max_memory_mb", 1024) * 1024 * 1024),
+                min_prefix_tokens=prefix_cache_config.get("min_prefix_tokens", 16),
+                block_size=prefix_cache_config.get("block_size", 16)
+            )
+
+        response_cache_config = self.config.get("response_cache", {})
+        self.response_cache = None
+        if response_cache_config.get("enabled", False):
+            self.response_cache = ResponseCache(
+                max_entries=response_cache_config.get("max_entries", 1024),
+                ttl=response_cache_config.get("ttl", 3600),
+                disk_path=response_cache_config.get("disk_path"),
+                max_disk_entries=response_cache_config.get("max_disk_entries", 100000),
+                max_disk_mb=response_cache_config.get("max_disk_mb", 1024)
+            )
+        tokenization_config = self.config.get("tokenization", {})
+        self.tokenization = TokenizationStage(
+            self.model_loader.tokenizer,
+            max_workers=tokenization_config.get("max_workers", 2),
+            max_entries=tokenization_config.get("cache_max_entries", 1024),
+            max_tokens=tokenization_config.get("cache_max_tokens", 1_000_000)
+        )
+
+        # Only used for the tenants' fair-queuing weights; the HTTP layer identifies tenants and applies rate limits.
+        self.tenants = TenantPolicy(self.config)
+
+        # Every request reserves an estimate of its KV cache and activations before it runs. The model
+        # registry replaces this budget with one shared by all of its models.
+        self.memory_estimator = MemoryEstimator(self.model_loader.model)
+        self.memory = build_budget(self.config, self.model_loader.model, self.memory_estimator,
+                                   reserved_bytes=self.prefix_cache.max_bytes if self.prefix_cache is not None else 0,
+                                   retry_after=executor_config.get("retry_after", 1))
+        limits_config = self.config.get("limits", {})
+        self.request_timeout = limits_config.get("request_timeout", 0)
+        self.max_request_timeout = limits_config.get("max_request_timeout", 0)
+        # request_id -> GenerationSequences or _StopCriteria, for /cancel. Client-chosen ids are not
+        # guaranteed to be unique, so every running request with the id is kept.
+        self._requests = {}
+
+        streaming_config = self.config.get("streaming", {})
+        self.flush_tokens = max(1, streaming_config.get("flush_tokens", 1))
+        self.flush_interval = streaming_config.get("flush_interval_ms", 0) / 1000
+
+        model_config = self.config["model"]
+        self.model_identity = f'{model_config["name"]}:{model_config["loading_method"]}'
+
+        adapters_config = model_config.get("adapters", {})
+        self.adapters = None
+        if adapters_config.get("paths"):
+            self.adapters = AdapterCache(
+                self.model_loader,
+                adapters_config["paths"],
+                max_loaded=adapters_config.get("max_loaded", 8)
+            )
+
+        speculative_config = model_config.get("speculative", {})
+        self.speculative = None
+        if self.model_loader.draft_model is not None:
+            self.speculative = SpeculativeDecoder(
+                self.model_loader.draft_model,
+                num_speculative_tokens=speculative_config.get("num_speculative_tokens", 4)
+            )
+
+        scheduler_config = self.config.get("scheduler", {})
+        self.scheduler = None
+        if scheduler_config.get("enabled", True):
+            self.scheduler = BatchScheduler(
+                self.model_loader,
+                max_batch_size=scheduler_config.get("max_batch_size", 8),
+                max_wait_ms=scheduler_config.get("max_wait_ms", 10),
+                max_queue_size=scheduler_config.get("max_queue_size", 64),
+                retry_after=executor_config.get("retry_after", 1),
+                prefix_cache=self.prefix_cache,
+                interactive_reserved_slots=scheduler_config.get("interactive_reserved_slots"),
+                adapters=self.adapters,
+                speculative=self.speculative
+            )
+        _engines.add(self)
+
+    async def _tokenize(self, request: GenerateRequest, timings):
+        # Returns the prompt token ids and the prefix lengths worth caching on their own.
+        if request.input_ids is not None:
+            vocab_size = len(self.model_loader.tokenizer)
+            if any(token_id < 0 or token_id >= vocab_size for token_id in request.input_ids):
+                raise ipc.EngineError(400, f"input_ids must be between 0 and {vocab_size - 1}")
+            return list(request.input_ids), []
+        started_at = time.monotonic()
+        messages = [{"role": msg.role, "content": msg.content} for msg in request.dialogue_history]
+        prompt_ids, system_length = await self.tokenization.encode(messages)
+        timings["tokenize"] = time.monotonic() - started_at
+        TOKENIZATION_TIME.observe(timings["tokenize"])
+        # A leading system prompt is shared by many conversations, so cache its KV as its own prefix.
+        if self.prefix_cache is None or system_length is None:
+            return prompt_ids, []
+        return prompt_ids, [system_length]
+
+    def _sampling_params(self, request: GenerateRequest):
+        if self.scheduler is None:
+            return None
+        return SamplingParams.from_request(
+            request.max_length,
+            request.temperature,
+            request.generation_kwargs,
+            self.model_loader.model.generation_config
+        )
+
+    def _generation_kwargs(self, request: GenerateRequest, prompt_ids, criteria):
+        inputs = torch.tensor([prompt_ids], dtype=torch.long, device=self.model_loader.model.device)
+        return {
+            "inputs": inputs,
+            # A single unpadded prompt: every position is attended to.
+            "attention_mask": torch.ones_like(inputs),
+            "max_new_tokens": request.max_length,
+            "temperature": request.temperature,
+            "do_sample": True,
+            **request.generation_kwargs,
+            "stopping_criteria": StoppingCriteriaList([criteria]),
+            "adapter": request.adapter
+        }
+
+    def _deadline(self, request: GenerateRequest, started_at):
+        timeout = request.timeout or self.request_timeout
+        if self.max_request_timeout:
+            timeout = min(timeout or self.max_request_timeout, self.max_request_timeout)
+        return started_at + timeout if timeout else None
+
+    def _cap_max_length(self, request: GenerateRequest, params, limit, reason):
+        if request.generation_kwargs.get("max_new_tokens", request.max_length) <= limit:
+            return
+        CAPPED_REQUESTS.labels(reason=reason).inc()
+        request.max_length = limit
+        if "max_new_tokens" in request.generation_kwargs:
+            request.generation_kwargs["max_new_tokens"] = limit
+        if params is not None:
+            params.max_new_tokens = limit
+
+    async def _reserve_memory(self, request: GenerateRequest, params, prompt_length):
+        # Lowers max_length to what the context window and the memory budget allow, then waits until the
+        # request's estimate fits next to the requests already running. Returns the bytes reserved.
+        estimator = self.memory_estimator
+        if estimator.max_positions:
+            if prompt_length >= estimator.max_positions:
+                raise ipc.EngineError(400, f"Prompt of {prompt_length} tokens does not fit the context window "
+                                           f"of {estimator.max_positions} tokens")
+            self._cap_max_length(request, params, estimator.max_positions - prompt_length, "context")
+        if self.memory is None:
+            return 0
+        rows = estimator.rows(request.generation_kwargs)
+        fits = estimator.max_new_tokens(prompt_length, self.memory.budget_bytes, rows)
+        if fits < 1:
+            raise ipc.EngineError(400, "Request needs more memory than the server's budget allows")
+        self._cap_max_length(request, params, fits, "memory")
+        max_new_tokens = request.generation_kwargs.get("max_new_tokens", request.max_length)
+        nbytes = estimator.estimate(prompt_length, max_new_tokens, rows)
+        await self.memory.reserve(nbytes)
+        return nbytes
+
+    def _release_memory(self, reserved):
+        if reserved:
+            self.memory.release(reserved)
+
+    async def _admit(self, request: GenerateRequest, params, prompt_length):
+        # Memory first, so a request waiting for it does not keep an adapter from being unloaded.
+        # Returns the bytes reserved, which the caller hands back through _release_resources.
+        reserved = await self._reserve_memory(request, params, prompt_length)
+        try:
+            await self._acquire_adapter(request)
+        except BaseException:
+            self._release_memory(reserved)
+            raise
+        return reserved
+
+    async def _acquire_adapter(self, request: GenerateRequest):
+        if request.adapter is None:
+            return
+        if self.adapters is None:
+            raise ipc.AdapterNotFoundError(request.adapter)
+        # Loading an adapter reads it from disk and waits for the current forward pass.
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.adapters.acquire, request.adapter))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(
+                lambda task: task.exception() is None and self.adapters.release(request.adapter))
+            raise
+
+    def _release_adapter(self, request: GenerateRequest):
+        if request.adapter is not None:
+            self.adapters.release(request.adapter)
+
+    def _release_resources(self, request: GenerateRequest, reserved):
+        self._release_adapter(request)
+        self._release_memory(reserved)
+
+    def _submit(self, request: GenerateRequest, prompt_ids, cache_boundaries, params, deadline, reserved):
+        try:
+            return self.scheduler.submit(prompt_ids, params, request_id=request.request_id, deadline=deadline,
+                                         priority=request.priority, adapter=request.adapter,
+                                         tenant=request.tenant, weight=self.tenants.weight(request.tenant),
+                                         cache_boundaries=cache_boundaries)
+        except BaseException:
+            self._release_resources(request, reserved)
+            raise
+
+    def _register(self, request: GenerateRequest, handle):
+        self._requests.setdefault(request.request_id, []).append(handle)
+
+    def _release(self, request: GenerateRequest, handle, reserved):
+        handles = self._requests.get(request.request_id, [])
+        if handle in handles:
+            handles.remove(handle)
+            if not handles:
+                del self._requests[request.request_id]
+        # A no-op when generation already finished; otherwise the caller went away.
+        handle.cancel()
+        self._release_resources(request, reserved)
+
+    async def cancel(self, request_id):
+        handles = self._requests.get(request_id)
+        if not handles:
+            return False
+        for handle in handles:
+            handle.cancel()
+        return True
+
+    def _response_cache_key(self, endpoint, request: GenerateRequest, params):
+        if self.response_cache is None:
+            return None
+        # Only cache requests whose output is fully determined by the request itself.
+        if params is not None:
+            if not params.deterministic:
+                return None
+        elif request.generation_kwargs.get("do_sample", True):
+            return None
+        # `adapter` stays in the key: the same prompt gives different text under different adapters.
+        payload = request.model_dump(exclude={"streamer", "stream_format", "request_id", "timeout", "priority", "model",
+                                              "tenant"})
+        if params is not None and not params.do_sample:
+            payload.pop("temperature")
+        return self.response_cache.key(endpoint, self.model_identity, payload)
+
+    async def generate(self, request: GenerateRequest, timings=None):
+        timings = {} if timings is None else timings
+        started_at = time.monotonic()
+        if request.request_id is None:
+            request.request_id = uuid.uuid4().hex
+        params = self._sampling_params(request)
+        cache_key = self._response_cache_key("generate", request, params)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                timings["cache"] = time.monotonic() - started_at
+                return cached
+
+        tokenizer = self.model_loader.tokenizer
+        prompt_ids, cache_boundaries = await self._tokenize(request, timings)
+        deadline = self._deadline(request, started_at)
+        reserved = await self._admit(request, params, len(prompt_ids))
+        if params is not None:
+            sequence = self._submit(request, prompt_ids, cache_boundaries, params, deadline, reserved)
+            self._register(request, sequence)
+            try:
+                output_ids = await sequence.result()
+            finally:
+                self._release(request, sequence, reserved)
+            timings.update(_sequence_timings(sequence))
+            result = {
+                "generated_text": tokenizer.decode(prompt_ids + output_ids, skip_special_tokens=True),
+                "finish_reason": sequence.finish_reason,
+                "usage": _usage(len(prompt_ids), len(output_ids))
+            }
+        else:
+            criteria = _StopCriteria(deadline)
+            generation_kwargs = self._generation_kwargs(request, prompt_ids, criteria)
+            self._register(request, criteria)
+            try:
+                outputs = await self.executor.run(self._run_generate, generation_kwargs)
+            finally:
+                self._release(request, criteria, reserved)
+            completion_tokens = outputs.shape[1] - len(prompt_ids)
+            GENERATED_TOKENS.inc(completion_tokens)
+            result = {
+                "generated_text": tokenizer.decode(outputs[0], skip_special_tokens=True),
+                "finish_reason": criteria.reason or _finish_reason(completion_tokens, generation_kwargs),
+                "usage": _usage(len(prompt_ids), completion_tokens)
+            }
+        timings["generate"] = time.monotonic() - started_at
+
+        if cache_key is not None and result["finish_reason"] in ("stop", "length"):
+            self.response_cache.put(cache_key, result)
+        return result
+
+    async def generate_stream(self, request: GenerateRequest):
+        started_at = time.monotonic()
+        if request.request_id is None:
+            request.request_id = uuid.uuid4().hex
+        params = self._sampling_params(request)
+        cache_key = self._response_cache_key("generate_stream", request, params)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return self._replay(cached, started_at)
+
+        tokenizer = self.model_loader.tokenizer
+        prompt_ids, cache_boundaries = await self._tokenize(request, {})
+        deadline = self._deadline(request, started_at)
+        reserved = await self._admit(request, params, len(prompt_ids))
+        if params is not None:
+            sequence = self._submit(request, prompt_ids, cache_boundaries, params, deadline, reserved)
+            self._register(request, sequence)
+            stream = self._track(request, sequence, reserved, self._stream_sequence(sequence, started_at))
+        else:
+            criteria = _StopCriteria(deadline)
+            streamer = _CountingStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            generation_kwargs = self._generation_kwargs(request, prompt_ids, criteria)
+            generation_kwargs["streamer"] = streamer
+            try:
+                self.executor.submit(self._run_streaming_generate, streamer, generation_kwargs)
+            except BaseException:
+                self._release_resources(request, reserved)
+                raise
+            self._register(request, criteria)
+            stream = self._track(request, criteria, reserved,
+                                 self._stream_streamer(streamer, criteria, len(prompt_ids), generation_kwargs, started_at))
+
+        if cache_key is not None:
+            return self._record(cache_key, stream)
+        return stream
+
+    async def _track(self, request: GenerateRequest, handle, reserved, stream):
+        # Runs when the stream completes, fails or is closed because the client disconnected.
+        try:
+            async for event in stream:
+                yield event
+        finally:
+            self._release(request, handle, reserved)
+
+    async def _replay(self, cached, started_at):
+        yield {"type": "token", "text": cached["text"]}
+        elapsed = time.monotonic() - started_at
+        yield {**cached["done"], "timing": {"cache": elapsed, "total": elapsed}}
+
+    async def _record(self, cache_key, stream):
+        chunks = []
+        async for event in stream:
+            if event["type"] == "token":
+                chunks.append(event["text"])
+            elif event["finish_reason"] in ("stop", "length"):
+                # Only reached when the stream ran to completion.
+                self.response_cache.put(cache_key, {"text": "".join(chunks), "done": event})
+            yield event
+
+    async def _token_events(self, pieces):
+        # Coalesce per-token text into one event every `flush_tokens` tokens or `flush_interval_ms`,
+        # whichever comes first.
+        pending = []
+        flushed_at = time.monotonic()
+        async for text in pieces:
+            pending.append(text)
+            now = time.monotonic()
+            if len(pending) >= self.flush_tokens or (self.flush_interval and now - flushed_at >= self.flush_interval):
+                chunk = "".join(pending)
+                if chunk:
+                    yield {"type": "token", "text": chunk}
+                    pending = []
+                    flushed_at = now
+        if "".join(pending):
+            yield {"type": "token", "text": "".join(pending)}
+
+    async def _sequence_text(self, sequence):
+        tokenizer = self.model_loader.tokenizer
+        token_ids = []
+        offset = 0
+        async for token_id in sequence:
+            token_ids.append(token_id)
+            text = tokenizer.decode(token_ids, skip_special_tokens=True)
+            # Hold back incomplete multi-byte characters until the next token completes them.
+            if len(text) > offset and not text.endswith("\ufffd"):
+                yield text[offset:]
+                offset = len(text)
+            else:
+                yield ""
+        text = tokenizer.decode(token_ids, skip_special_tokens=True)
+        if len(text) > offset:
+            yield text[offset:]
+
+    async def _stream_sequence(self, sequence, started_at):
+        async for event in self._token_events(self._sequence_text(sequence)):
+            yield event
+        timing = {**_sequence_timings(sequence), "total": time.monotonic() - started_at}
+        yield _done_event(sequence.finish_reason, len(sequence.input_ids), len(sequence.output_ids), timing)
+
+    async def _stream_streamer(self, streamer, criteria, prompt_tokens, generation_kwargs, started_at):
+        first_token_at = None
+        async for event in self._token_events(iterate_in_threadpool(streamer)):
+            first_token_at = first_token_at or time.monotonic()
+            yield event
+        if streamer.error is not None:
+            raise streamer.error
+        GENERATED_TOKENS.inc(streamer.completion_tokens)
+        finish_reason = criteria.reason or _finish_reason(streamer.completion_tokens, generation_kwargs)
+        timing = {"ttft": (first_token_at or time.monotonic()) - started_at, "total": time.monotonic() - started_at}
+        yield _done_event(finish_reason, prompt_tokens, streamer.completion_tokens, timing)
+
+    def _run_generate(self, generation_kwargs):
+        seed = generation_kwargs.pop("seed", None)
+        adapter = generation_kwargs.pop("adapter", None)
+        if seed is not None:
+            torch.manual_seed(seed)
+        if self.adapters is None:
+            return self.model_loader.model.generate(**generation_kwargs)
+        # Holds the adapter lock for the whole call, so unbatched requests on an adapter model run one at a time.
+        with self.adapters.lock:
+            return self.model_loader.model.generate(**generation_kwargs, **self.adapters.forward_kwargs([adapter]))
+
+    def _run_streaming_generate(self, streamer, generation_kwargs):
+        try:
+            self._run_generate(generation_kwargs)
+        except Exception as e:
+            logger.error(f"Error in streaming generation: {str(e)}")
+            streamer.error = e
+            # Unblock the response iterator instead of leaving the client hanging.
+            streamer.end()
+
+    async def warmup(self, prompt_lengths, max_new_tokens=2):
+        # Runs each prompt length through the whole request path, so the first real requests do not pay for
+        # lazy kernel initialisation and allocator growth.
+        started_at = time.monotonic()
+        config = self.model_loader.model.config
+        max_positions = getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None)
+        word_tokens = max(1, len(self.model_loader.tokenizer.encode(" hello", add_special_tokens=False)))
+        for length in prompt_lengths:
+            if max_positions:
+                length = min(length, max_positions // 2)
+            content = " ".join(["hello"] * max(1, length // word_tokens))
+            await self.generate(GenerateRequest(dialogue_history=[{"role": "user", "content": content}],
+                                                max_length=max_new_tokens))
+        # The synthetic prompts would only take space from real prefixes.
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+        return time.monotonic() - started_at
+
+    async def stats(self):
+        return self.snapshot()
+
+    def snapshot(self):
+        stats = {"queue_depth": self.executor.queue_depth, "in_flight": self.executor.in_flight}
+        if self.scheduler is not None:
+            scheduler_stats = self.scheduler.stats()
+            stats["queue_depth"] += scheduler_stats.pop("queue_depth")
+            stats["in_flight"] += scheduler_stats["batch_size"]
+            stats.update(scheduler_stats)
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.stats()
+        if self.adapters is not None:
+            stats["adapters"] = self.adapters.stats()
+        if self.memory is not None:
+            stats["memory"] = self.memory.stats()
+        stats["tokenization_cache"] = self.tokenization.stats()
+        return stats
+
+    async def aclose(self):
+        _engines.discard(self)
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.executor.shutdown()
+        self.tokenization.shutdown()
+        if self.response_cache is not None:
+            self.response_cache.close()
+
+class EngineServer:
+    # `engine` is a ModelRegistry.
+    def __init__(self, engine, socket_path):
+        self.engine = engine
+        self.socket_path = socket_path
+
+    async def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        logger.info(f"Inference engine listening on {self.socket_path}")
+        # Listen first so model servers can report "starting" while the models load and warm up.
+        startup = asyncio.ensure_future(self.engine.start())
+        async with server:
+            await server.serve_forever()
+        startup.cancel()
+
+    async def _handle_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                message = await ipc.read_frame(reader)
+                if message is None:
+                    break
+                task = asyncio.create_task(self._dispatch(message, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except Exception as e:
+            logger.error(f"Error reading from engine client: {str(e)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _dispatch(self, message, writer):
+        request_id = message.get("id")
+        try:
+            if message["op"] == "stats":
+                await ipc.write_frame(writer, {"id": request_id, "type": "result", "data": await self.engine.stats()})
+                return
+            if message["op"] == "metrics":
+                await ipc.write_frame(writer, {"id": request_id, "type": "result", "data": REGISTRY.render()})
+                return
+            if message["op"] == "cancel":
+                data = await self.engine.cancel(message["request_id"])
+                await ipc.write_frame(writer, {"id": request_id, "type": "result", "data": data})
+                return
+            if message["op"] in ("models", "load", "reload"):
+                if message["op"] == "models":
+                    data = await self.engine.models()
+                elif message["op"] == "load":
+                    data = await self.engine.load(message["model"])
+                else:
+                    data = await self.engine.reload(message["model"], message.get("settings"))
+                await ipc.write_frame(writer, {"id": request_id, "type": "result", "data": data})
+                return
+            request = GenerateRequest.model_validate(message["request"])
+            if message["op"] == "generate":
+                timings = {}
+                data = await self.engine.generate(request, timings)
+                await ipc.write_frame(writer, {"id": request_id, "type": "result", "data": data, "timings": timings})
+            else:
+                stream = await self.engine.generate_stream(request)
+                await ipc.write_frame(writer, {"id": request_id, "type": "accepted"})
+                async for event in stream:
+                    await ipc.write_frame(writer, {"id": request_id, "type": "chunk", "event": event})
+                await ipc.write_frame(writer, {"id": request_id, "type": "end"})
+        except QueueFullError as e:
+            await ipc.write_frame(writer, {"id": request_id, "type": "error", "status": 503,
+                                           "detail": str(e), "retry_after": e.retry_after})
+        except ipc.EngineError as e:
+            await ipc.write_frame(writer, {"id": request_id, "type": "error", "status": e.status_code, "detail": e.detail})
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            logger.error(f"Error in engine request: {str(e)}")
+            await ipc.write_frame(writer, {"id": request_id, "type": "error", "status": 500,
+                                           "detail": "Error generating text"})
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the shared ShareLMAPI inference engine")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH)
+    parser.add_argument("--socket", default=None, help="Unix socket path (defaults to engine.socket_path)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from ShareLMAPI.server.registry import ModelRegistry
+    registry = ModelRegistry(args.config)
+    socket_path = args.socket or os.environ.get(
+        "SHARELMAPI_ENGINE_SOCKET", registry.config.get("engine", {}).get("socket_path", ipc.DEFAULT_SOCKET_PATH))
+    asyncio.run(EngineServer(registry, socket_path).serve_forever())
+
+if __name__ == "__main__":
+    main()
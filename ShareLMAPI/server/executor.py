@@ -0,0 +1,86 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ShareLMAPI.server.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_QUEUE_TIME = Histogram("sharelmapi_executor_queue_time_seconds",
+                                "Time unbatched requests wait for an inference worker")
+
+class QueueFullError(Exception):
+    def __init__(self, message="Server is busy", retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class InferenceExecutor:
+    def __init__(self, max_workers=2, max_queue_size=16, retry_after=1):
+        self.max_workers = max(1, max_workers)
+        self.max_queue_size = max(0, max_queue_size)
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        return max(0, self._in_flight - self.max_workers)
+
+    def _admit(self):
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue_size:
+                raise QueueFullError(retry_after=self.retry_after)
+            self._in_flight += 1
+
+    def _release(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        self._admit()
+        try:
+            future = self._executor.submit(self._timed, time.monotonic(), fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    @staticmethod
+    def _timed(submitted_at, fn, *args, **kwargs):
+        EXECUTOR_QUEUE_TIME.observe(time.monotonic() - submitted_at)
+        return fn(*args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(partial(fn, *args, **kwargs)))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,200 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.executor import QueueFullError
+import asyncio
+import itertools
+import json
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/sharelmapi-engine.sock"
+
+# Frames are a 4-byte big-endian length followed by a JSON document.
+HEADER = struct.Struct(">I")
+
+class EngineError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class ModelNotFoundError(EngineError):
+    def __init__(self, name):
+        super().__init__(404, f"Unknown model: {name}")
+
+class AdapterNotFoundError(EngineError):
+    def __init__(self, name):
+        super().__init__(404, f"Unknown adapter: {name}")
+
+async def read_frame(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+async def write_frame(writer, message):
+    payload = json.dumps(message).encode("utf-8")
+    writer.write(HEADER.pack(len(payload)) + payload)
+    await writer.drain()
+
+# Used by HTTP workers in "shared" engine mode; all requests share one connection.
+class EngineClient:
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        self.socket_path = socket_path
+        self._writer = None
+        self._lock = None
+        self._ids = itertools.count()
+        self._streams = {}
+        self._background = set()
+
+    async def _connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+                asyncio.create_task(self._read_loop(reader, self._writer))
+        return self._writer
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                queue = self._streams.get(message.get("id"))
+                if queue is not None:
+                    queue.put_nowait(message)
+        except Exception as e:
+            logger.error(f"Error reading from inference engine: {str(e)}")
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            for queue in self._streams.values():
+                queue.put_nowait({"type": "error", "status": 502, "detail": "Lost connection to inference engine"})
+
+    async def _send(self, op, request=None, **fields):
+        request_id = next(self._ids)
+        queue = asyncio.Queue()
+        self._streams[request_id] = queue
+        try:
+            writer = await self._connect()
+            await write_frame(writer, {"id": request_id, "op": op,
+                                       "request": request.model_dump() if request is not None else None, **fields})
+        except Exception:
+            self._streams.pop(request_id, None)
+            raise
+        return request_id, queue
+
+    @staticmethod
+    def _check(message):
+        if message["type"] == "error":
+            if message["status"] == 503:
+                raise QueueFullError(message["detail"], retry_after=message.get("retry_after", 1))
+            raise EngineError(message["status"], message["detail"])
+        return message
+
+    async def _call(self, op, request=None, **fields):
+        request_id, queue = await self._send(op, request, **fields)
+        try:
+            return self._check(await queue.get())
+        finally:
+            self._streams.pop(request_id, None)
+
+    async def stats(self):
+        return (await self._call("stats"))["data"]
+
+    async def metrics(self):
+        return (await self._call("metrics"))["data"]
+
+    async def models(self):
+        return (await self._call("models"))["data"]
+
+    async def load(self, name):
+        return (await self._call("load", model=name))["data"]
+
+    async def reload(self, name, settings=None):
+        return (await self._call("reload", model=name, settings=settings))["data"]
+
+    async def cancel(self, request_id):
+        return (await self._call("cancel", request_id=request_id))["data"]
+
+    def _abandon(self, request):
+        # The HTTP caller went away; tell the engine so it stops generating for nobody.
+        task = asyncio.create_task(self._cancel_quietly(request.request_id))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _cancel_quietly(self, request_id):
+        try:
+            await self.cancel(request_id)
+        except Exception as e:
+            logger.error(f"Error cancelling request {request_id}: {str(e)}")
+
+    async def generate(self, request, timings=None):
+        try:
+            message = await self._call("generate", request)
+        except asyncio.CancelledError:
+            self._abandon(request)
+            raise
+        if timings is not None:
+            timings.update(message.get("timings", {}))
+        return message["data"]
+
+    async def generate_stream(self, request):
+        request_id, queue = await self._send("generate_stream", request)
+        try:
+            self._check(await queue.get())
+        except asyncio.CancelledError:
+            self._streams.pop(request_id, None)
+            self._abandon(request)
+            raise
+        except BaseException:
+            self._streams.pop(request_id, None)
+            raise
+        return self._iterate(request, request_id, queue)
+
+    async def _iterate(self, request, request_id, queue):
+        finished = False
+        try:
+            while True:
+                message = self._check(await queue.get())
+                if message["type"] == "end":
+                    finished = True
+                    return
+                yield message["event"]
+        except EngineError:
+            finished = True
+            raise
+        finally:
+            self._streams.pop(request_id, None)
+            if not finished:
+                self._abandon(request)
+
+    async def aclose(self):
+        if self._writer is not None:
+            self._writer.close()
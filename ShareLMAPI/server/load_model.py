@@ -19,49 +19,145 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-from peft import PeftModel
-import yaml
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from ShareLMAPI.server.config import load_config, DEFAULT_CONFIG_PATH
+from ShareLMAPI.server.metrics import Gauge
+import hashlib
+import json
 import logging
+import os
+import re
+import shutil
+import time
 
 logger = logging.getLogger(__name__)
 
+MODEL_LOAD_SECONDS = Gauge("sharelmapi_model_load_seconds", "Time taken by the last model and tokenizer load")
+
+# Loading methods whose weights can be saved and reloaded as a plain safetensors checkpoint.
+WEIGHT_CACHE_METHODS = ("default", "fake")
+
 class ModelLoader:
-    def __init__(self, config_path="configs/model_config.yaml"):
-        self.config = self.load_config(config_path)
+    def __init__(self, config_path=DEFAULT_CONFIG_PATH, config=None):
+        self.config = config if config is not None else self.load_config(config_path)
         self.model = None
         self.tokenizer = None
+        # Small model proposing tokens for speculative decoding, if `model.speculative` enables it.
+        self.draft_model = None
+        self.load_duration = None
+        # Seconds per load phase, plus whether the weight cache was used.
+        self.load_timings = {}
         self.load_model_and_tokenizer()
 
     def load_config(self, config_path):
-        try:
-            with open(config_path, "r") as file:
-                return yaml.safe_load(file)
-        except Exception as e:
-            logger.error(f"Error loading config: {str(e)}")
-            raise
+        return load_config(config_path)
 
     def load_model_and_tokenizer(self):
         try:
+            started_at = time.monotonic()
             model_name = self.config["model"]["name"]
             loading_method = self.config["model"]["loading_method"]
+            cache_path = self._weight_cache_path()
+            self.load_timings = {"weight_cache": "disabled" if cache_path is None else "miss"}
 
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-            if loading_method == "default":
-                self.model = self._load_default_model(model_name)
-            elif loading_method == "bitsandbytes":
-                self.model = self._load_bitsandbytes_model(model_name)
-            elif loading_method == "peft":
-                self.model = self._load_peft_model(model_name)
+            if cache_path is not None and os.path.isdir(cache_path):
+                self.load_timings["weight_cache"] = "hit"
+                self.tokenizer = AutoTokenizer.from_pretrained(cache_path)
+                self.load_timings["tokenizer"] = time.monotonic() - started_at
+                self.model = self._load_cached_model(cache_path)
             else:
-                raise ValueError(f"Unsupported loading method: {loading_method}")
+                if loading_method == "fake":
+                    from ShareLMAPI.server.fake_model import build_fake_tokenizer
+                    self.tokenizer = build_fake_tokenizer()
+                else:
+                    self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+                self.load_timings["tokenizer"] = time.monotonic() - started_at
+
+                if loading_method == "fake":
+                    self.model = self._load_fake_model()
+                elif loading_method == "default":
+                    self.model = self._load_default_model(model_name)
+                elif loading_method == "bitsandbytes":
+                    self.model = self._load_bitsandbytes_model(model_name)
+                elif loading_method == "peft":
+                    self.model = self._load_peft_model(model_name)
+                else:
+                    raise ValueError(f"Unsupported loading method: {loading_method}")
 
             self.model.eval()
+            self.load_timings["weights"] = time.monotonic() - started_at - self.load_timings["tokenizer"]
+            self.draft_model = self._load_draft_model()
+            if cache_path is not None and self.load_timings["weight_cache"] == "miss":
+                written_at = time.monotonic()
+                self._write_weight_cache(cache_path)
+                self.load_timings["weight_cache_write"] = time.monotonic() - written_at
+            self.load_duration = time.monotonic() - started_at
+            MODEL_LOAD_SECONDS.set(self.load_duration)
+            logger.info(f"Loaded {model_name} in {self.load_duration:.2f}s (weight cache: {self.load_timings['weight_cache']})")
         except Exception as e:
             logger.error(f"Error loading model and tokenizer: {str(e)}")
             raise
 
+    def _weight_cache_path(self):
+        directory = self.config.get("weight_cache", {}).get("directory")
+        model_config = self.config["model"]
+        loading_method = model_config["loading_method"]
+        if not directory or loading_method not in WEIGHT_CACHE_METHODS:
+            return None
+        # Any change to the settings that shape the weights gets its own entry.
+        settings = {"name": model_config["name"], "loading_method": loading_method,
+                    "settings": model_config.get(loading_method, {})}
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return os.path.join(directory, f'{re.sub(r"[^A-Za-z0-9_.-]+", "--", model_config["name"])}-{digest}')
+
+    def _load_cached_model(self, cache_path):
+        # safetensors files are memory-mapped, so this skips the download, conversion and random init.
+        device = self.config["model"].get(self.config["model"]["loading_method"], {}).get("device", "cpu")
+        return AutoModelForCausalLM.from_pretrained(
+            cache_path,
+            device_map="auto" if device == "cuda" else None,
+            torch_dtype="auto",
+            low_cpu_mem_usage=True
+        )
+
+    def _write_weight_cache(self, cache_path):
+        # Written to a temporary directory and renamed, so a crash never leaves a partial entry behind.
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        try:
+            self.model.save_pretrained(tmp_path, safe_serialization=True)
+            self.tokenizer.save_pretrained(tmp_path)
+            os.replace(tmp_path, cache_path)
+            logger.info(f"Wrote weight cache {cache_path}")
+        except OSError as e:
+            # Another process may have written the same entry first.
+            logger.warning(f"Could not write weight cache {cache_path}: {str(e)}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _load_draft_model(self):
+        speculative_config = self.config["model"].get("speculative", {})
+        if not speculative_config.get("enabled", False):
+            return None
+        started_at = time.monotonic()
+        # The draft section has the same shape as `model:` and loads through the same methods.
+        draft = ModelLoader(config={**self.config, "model": speculative_config["draft_model"]})
+        if draft.tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError("The draft model must use the same tokenizer as the model")
+        self.load_timings["draft_model"] = time.monotonic() - started_at
+        return draft.model
+
+    def _load_fake_model(self):
+        from ShareLMAPI.server.fake_model import build_fake_model
+        fake_config = self.config["model"].get("fake", {})
+        model = build_fake_model(
+            self.tokenizer,
+            n_layer=fake_config.get("n_layer", 2),
+            n_head=fake_config.get("n_head", 4),
+            n_embd=fake_config.get("n_embd", 64),
+            max_positions=fake_config.get("max_positions", 2048),
+            seed=fake_config.get("seed", 0)
+        )
+        return model.to(fake_config.get("device", "cpu"))
+
     def _load_default_model(self, model_name):
         return AutoModelForCausalLM.from_pretrained(
             model_name,
@@ -70,6 +166,7 @@ class ModelLoader:
         )
 
     def _load_bitsandbytes_model(self, model_name):
+        from transformers import BitsAndBytesConfig
         quant_config = BitsAndBytesConfig(
             quant_type=self.config["model"]["bitsandbytes"]["quantization_config"]["quant_type"]
         )
@@ -81,6 +178,7 @@ class ModelLoader:
         )
 
     def _load_peft_model(self, model_name):
+        from peft import PeftModel
         base_model = AutoModelForCausalLM.from_pretrained(
             model_name,
             device_map="auto" if self.config["model"]["peft"]["device"] == "cuda" else None,
@@ -96,6 +194,12 @@ class ModelLoader:
         else:
             raise ValueError(f"Unsupported PEFT type: {peft_type}")
 
+    def memory_bytes(self):
+        tensors = list(self.model.parameters()) + list(self.model.buffers())
+        if self.draft_model is not None:
+            tensors += list(self.draft_model.parameters()) + list(self.draft_model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
     def update_model_settings(self, new_settings: dict):
         try:
             self.config["model"].update(new_settings)
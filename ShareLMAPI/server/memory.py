@@ -0,0 +1,198 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.metrics import Counter, Histogram
+from collections import deque
+import asyncio
+import logging
+import os
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+MEMORY_WAIT_TIME = Histogram("sharelmapi_memory_wait_seconds", "Time requests wait for their share of the memory budget")
+MEMORY_REJECTED_REQUESTS = Counter("sharelmapi_memory_rejected_requests_total",
+                                   "Requests turned away because the memory budget stayed full", ("reason",))
+CAPPED_REQUESTS = Counter("sharelmapi_capped_requests_total",
+                          "Requests whose max_length was lowered to fit the context window or memory budget",
+                          ("reason",))
+
+def _config_value(config, *names, default=None):
+    for name in names:
+        value = getattr(config, name, None)
+        if value is not None:
+            return value
+    return default
+
+# Rough upper bound on the memory one request needs beyond the weights: its KV cache at full length, plus
+# the largest activations of its prefill, which for long prompts are the full-vocabulary logits and the
+# attention scores of one layer.
+class MemoryEstimator:
+    def __init__(self, model):
+        config = model.config
+        self.max_positions = _config_value(config, "max_position_embeddings", "n_positions")
+        self.num_layers = _config_value(config, "num_hidden_layers", "n_layer", default=1)
+        self.hidden_size = _config_value(config, "hidden_size", "n_embd", default=0)
+        self.num_heads = _config_value(config, "num_attention_heads", "n_head", default=1)
+        num_kv_heads = _config_value(config, "num_key_value_heads", default=self.num_heads)
+        head_dim = _config_value(config, "head_dim", default=self.hidden_size // self.num_heads)
+        self.vocab_size = _config_value(config, "vocab_size", default=0)
+        dtype = next(model.parameters()).dtype
+        # Quantized weights still keep activations and KV in a floating point dtype.
+        self.dtype_bytes = dtype.itemsize if dtype.is_floating_point else torch.float16.itemsize
+        # Keys and values for every layer.
+        self.kv_bytes_per_token = 2 * self.num_layers * num_kv_heads * head_dim * self.dtype_bytes
+
+    @staticmethod
+    def rows(generation_kwargs):
+        # Beam search and num_return_sequences decode several copies of the prompt side by side.
+        return max(generation_kwargs.get("num_beams", 1) or 1, generation_kwargs.get("num_return_sequences", 1) or 1)
+
+    def estimate(self, prompt_tokens, max_new_tokens, rows=1):
+        kv = rows * (prompt_tokens + max_new_tokens) * self.kv_bytes_per_token
+        # Logits are upcast to float32; attention scores are float32 for the eager kernels.
+        activations = rows * prompt_tokens * (self.vocab_size * 4 + 4 * self.hidden_size * self.dtype_bytes)
+        attention = rows * self.num_heads * prompt_tokens * prompt_tokens * 4
+        return kv + activations + attention
+
+    def max_new_tokens(self, prompt_tokens, budget, rows=1):
+        # Largest max_new_tokens whose estimate fits `budget`; below 1 the prompt alone does not fit.
+        spare = budget - self.estimate(prompt_tokens, 0, rows)
+        return spare // (rows * self.kv_bytes_per_token) if self.kv_bytes_per_token else spare
+
+def available_ram():
+    # MemAvailable counts page cache the kernel can reclaim; free pages alone understate it badly on a warm host.
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def detect_budget(model, fraction=0.9):
+    # Bytes free for requests once the weights are loaded: device memory on CUDA, available RAM on CPU.
+    try:
+        if model.device.type == "cuda":
+            free, _ = torch.cuda.mem_get_info(model.device)
+        else:
+            free = available_ram()
+    except (AttributeError, ValueError, OSError, RuntimeError) as e:
+        logger.warning(f"Could not detect free memory, memory admission is disabled: {str(e)}")
+        return None
+    return int(free * fraction)
+
+def prefix_cache_bytes(config):
+    prefix_cache_config = config.get("prefix_cache", {})
+    if not prefix_cache_config.get("enabled", True):
+        return 0
+    return int(prefix_cache_config.get("max_memory_mb", 1024) * 2**20)
+
+def check_budget(budget_bytes, estimator):
+    # A detected budget too small for any request would answer every client with 400; refuse to start instead.
+    if budget_bytes < estimator.estimate(1, 1):
+        raise ValueError(f"Only {budget_bytes / 2**20:.0f}MB of memory is left for requests, less than a single "
+                         "request needs; set memory.budget_mb or lower prefix_cache.max_memory_mb")
+    if estimator.max_positions and budget_bytes < estimator.estimate(estimator.max_positions, 0):
+        logger.warning(f"The request memory budget of {budget_bytes / 2**20:.0f}MB cannot hold a prompt that "
+                       "fills the context window; long prompts will be rejected")
+
+def build_budget(config, model, estimator, reserved_bytes=0, retry_after=1):
+    # The `memory` section's budget, or the memory free after loading `model` less `reserved_bytes` that
+    # other structures (the prefix cache) may still fill. None disables memory admission.
+    memory_config = config.get("memory", {})
+    if not memory_config.get("enabled", True):
+        return None
+    budget = memory_config.get("budget_mb")
+    if budget:
+        budget = int(budget * 2**20)
+    else:
+        budget = detect_budget(model, memory_config.get("budget_fraction", 0.9))
+        if budget is None:
+            return None
+        budget = max(0, budget - reserved_bytes)
+        check_budget(budget, estimator)
+    return MemoryBudget(
+        budget,
+        max_wait=memory_config.get("max_wait", 30),
+        max_waiting=memory_config.get("max_waiting", 64),
+        retry_after=retry_after
+    )
+
+# Reservations against a fixed number of bytes. Requests that do not fit wait in arrival order, so a large
+# request is not overtaken indefinitely by smaller ones. Only used from the event loop.
+class MemoryBudget:
+    def __init__(self, budget_bytes, max_wait=30, max_waiting=64, retry_after=1):
+        self.budget_bytes = budget_bytes
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.retry_after = retry_after
+        self.reserved_bytes = 0
+        self._waiters = deque()
+
+    @property
+    def free_bytes(self):
+        return self.budget_bytes - self.reserved_bytes
+
+    async def reserve(self, nbytes):
+        if not self._waiters and nbytes <= self.free_bytes:
+            self.reserved_bytes += nbytes
+            return
+        if len(self._waiters) >= self.max_waiting:
+            MEMORY_REJECTED_REQUESTS.labels(reason="queue_full").inc()
+            raise QueueFullError("Memory budget is full", retry_after=self.retry_after)
+        waiter = (nbytes, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), self.max_wait or None)
+        except BaseException as e:
+            if waiter[1].done():
+                # Granted just as the wait ended.
+                self.release(nbytes)
+            else:
+                self._waiters.remove(waiter)
+                waiter[1].cancel()
+                # Requests queued behind this one may fit now.
+                self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                MEMORY_REJECTED_REQUESTS.labels(reason="timeout").inc()
+                raise QueueFullError("Timed out waiting for memory", retry_after=self.retry_after)
+            raise
+        finally:
+            MEMORY_WAIT_TIME.observe(time.monotonic() - started_at)
+
+    def release(self, nbytes):
+        self.reserved_bytes -= nbytes
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._waiters[0][0] <= self.free_bytes:
+            nbytes, future = self._waiters.popleft()
+            self.reserved_bytes += nbytes
+            future.set_result(None)
+
+    def stats(self):
+        return {"budget_bytes": self.budget_bytes, "reserved_bytes": self.reserved_bytes,
+                "free_bytes": self.free_bytes, "waiting": len(self._waiters)}
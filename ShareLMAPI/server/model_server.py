@@ -19,83 +19,324 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from fastapi import FastAPI, HTTPException
-from transformers import TextIteratorStreamer
-from threading import Thread
-from ShareLMAPI.server.load_model import ModelLoader
-from pydantic import BaseModel
-from typing import List, Dict, Optional
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from ShareLMAPI.server.config import load_config, DEFAULT_CONFIG_PATH
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.ipc import EngineClient, EngineError, DEFAULT_SOCKET_PATH
+from ShareLMAPI.server.schemas import GenerateRequest, CancelRequest, BulkJobRequest, ReloadRequest
+from ShareLMAPI.server.bulk import BulkJob, engine_generate, read_checkpoint
+from ShareLMAPI.server.cancellation import cancel_on_disconnect
+from ShareLMAPI.server.metrics import REGISTRY, CONTENT_TYPE, HTTPMetrics, MetricsMiddleware, server_timing
+from ShareLMAPI.server.tenants import TenantPolicy, RateLimitError, UnknownTenantError, estimate_tokens, request_api_key
+from ShareLMAPI.server.wire import CompressionMiddleware, DEFAULT_LEVEL, DEFAULT_MIN_BYTES
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+import asyncio
+import json
 import logging
+import math
+import os
+import secrets
+import uuid
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
-model_loader = ModelLoader()
+CONFIG_PATH = DEFAULT_CONFIG_PATH
 
-class DialogueMessage(BaseModel):
-    role: str
-    content: str
+config = load_config(CONFIG_PATH)
+engine_config = config.get("engine", {})
+TIMING_HEADERS = config.get("metrics", {}).get("timing_headers", True)
+STREAM_FORMAT = config.get("streaming", {}).get("format", "ndjson")
+bulk_config = config.get("bulk", {})
+BULK_DIRECTORY = bulk_config.get("directory")
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream", "text": "text/plain"}
+tenant_policy = TenantPolicy(config)
+registry_config = config.get("registry", {})
+# Model management changes what every tenant is served, so it needs an admin key rather than a tenant key.
+ADMIN_API_KEYS = registry_config.get("admin_api_keys") or []
+RELOADABLE_SETTINGS = set(registry_config.get("reloadable_settings") or [])
 
-class GenerateRequest(BaseModel):
-    dialogue_history: List[DialogueMessage]
-    max_length: int = 50
-    temperature: float = 1.0
-    streamer: Optional[bool] = True
-    generation_kwargs: Optional[Dict] = {}
+app.add_middleware(MetricsMiddleware, metrics=HTTPMetrics("sharelmapi_http"), endpoints=("/generate", "/generate_stream"))
+# Compressed request bodies from the gateway are always accepted; responses are only compressed when enabled.
+compression_config = config.get("model_server", {}).get("compression", {})
+app.add_middleware(CompressionMiddleware, enabled=compression_config.get("enabled", False),
+                   min_bytes=compression_config.get("min_bytes", DEFAULT_MIN_BYTES),
+                   level=compression_config.get("level", DEFAULT_LEVEL))
+# "local" loads the model in this process; "shared" forwards to `python -m ShareLMAPI.server.engine`.
+ENGINE_MODE = os.environ.get("SHARELMAPI_ENGINE_MODE", engine_config.get("mode", "local"))
+
+if ENGINE_MODE == "shared":
+    engine = EngineClient(os.environ.get("SHARELMAPI_ENGINE_SOCKET", engine_config.get("socket_path", DEFAULT_SOCKET_PATH)))
+else:
+    # Imported lazily so shared-mode workers never load torch or the model weights.
+    from ShareLMAPI.server.registry import ModelRegistry
+    engine = ModelRegistry(CONFIG_PATH)
+
+# Output path -> task for bulk jobs started by this worker.
+bulk_jobs = {}
+startup_tasks = set()
+
+def busy_exception(error: QueueFullError):
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+def rate_limit_exception(error: RateLimitError):
+    return HTTPException(status_code=429, detail=str(error),
+                         headers={"Retry-After": str(math.ceil(error.retry_after)), **error.tenant.headers()})
+
+def admit_tenant(request: GenerateRequest, http_request: Request):
+    # Returns the caller's tenant (None when tenants are disabled) and the tokens reserved for the request.
+    try:
+        tenant = tenant_policy.identify(http_request.headers)
+    except UnknownTenantError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    if tenant is None:
+        return None, 0
+    request.tenant = tenant.name
+    request.priority = tenant.apply_priority(request.priority)
+    reserved = estimate_tokens(request.model_dump())
+    try:
+        tenant.reserve(reserved)
+    except RateLimitError as e:
+        raise rate_limit_exception(e)
+    return tenant, reserved
+
+def require_admin(http_request: Request):
+    if not ADMIN_API_KEYS:
+        raise HTTPException(status_code=403, detail="Model reloads are disabled; set registry.admin_api_keys")
+    api_key = request_api_key(http_request.headers)
+    if api_key is None or not any(secrets.compare_digest(api_key, key) for key in ADMIN_API_KEYS):
+        raise HTTPException(status_code=401, detail="Invalid admin API key")
+
+def refund(tenant, reserved):
+    # For requests that failed or were abandoned before generating anything.
+    if tenant is not None:
+        tenant.settle(reserved, 0)
+
+async def charge_stream(events, tenant, reserved):
+    # Settles the reservation with the usage in the done event; a stream cut short keeps its reservation.
+    used = reserved
+    try:
+        async for event in events:
+            if event["type"] == "done":
+                used = event["usage"]["total_tokens"]
+            yield event
+    finally:
+        tenant.settle(reserved, used)
+
+def assign_request_id(request: GenerateRequest, http_request: Request):
+    request.request_id = request.request_id or http_request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    return request.request_id
+
+def negotiate_stream_format(request: GenerateRequest, accept):
+    if request.stream_format is not None:
+        return request.stream_format
+    for stream_format, media_type in STREAM_MEDIA_TYPES.items():
+        if media_type in accept:
+            return stream_format
+    return STREAM_FORMAT
+
+def encode_event(event, stream_format):
+    data = json.dumps(event, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+async def encode_stream(events, stream_format):
+    try:
+        async for event in events:
+            if stream_format != "text":
+                yield encode_event(event, stream_format)
+            elif event["type"] == "token":
+                yield event["text"]
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band.
+        logger.error(f"Error in generate_stream: {str(e)}")
+        if stream_format != "text":
+            yield encode_event({"type": "error", "detail": "Error generating text"}, stream_format)
+
+@app.on_event("startup")
+async def start_engine():
+    # Load and warm up in the background so /health answers straight away; /ready reports when it is done.
+    # In shared mode the engine process does this itself.
+    if ENGINE_MODE != "shared":
+        task = asyncio.ensure_future(engine.start())
+        startup_tasks.add(task)
+        task.add_done_callback(startup_tasks.discard)
+
+@app.on_event("shutdown")
+async def shutdown_engine():
+    # Interrupted jobs resume from their checkpoint when restarted.
+    for task in bulk_jobs.values():
+        task.cancel()
+    await engine.aclose()
+
+@app.get("/health")
+async def health():
+    try:
+        return {"status": "ok", **await engine.stats()}
+    except Exception as e:
+        logger.error(f"Error in health: {str(e)}")
+        raise HTTPException(status_code=503, detail="Inference engine unavailable")
+
+@app.get("/ready")
+async def ready():
+    try:
+        stats = await engine.stats()
+    except Exception as e:
+        logger.error(f"Error in ready: {str(e)}")
+        raise HTTPException(status_code=503, detail="Inference engine unavailable")
+    if not stats["ready"]:
+        detail = "Startup failed" if "error" in stats["startup"] else "Loading and warming up models"
+        raise HTTPException(status_code=503, detail=detail)
+    return {"status": "ready", "queue_depth": stats["queue_depth"], "startup": stats["startup"]}
+
+@app.get("/metrics")
+async def metrics():
+    text = REGISTRY.render()
+    if ENGINE_MODE == "shared":
+        try:
+            text += await engine.metrics()
+        except Exception as e:
+            logger.error(f"Error collecting engine metrics: {str(e)}")
+    return Response(content=text, media_type=CONTENT_TYPE)
 
 @app.post("/generate_stream")
-async def generate_stream(request: GenerateRequest):
+async def generate_stream(request: GenerateRequest, http_request: Request):
+    tenant, reserved = admit_tenant(request, http_request)
+    settled = False
     try:
-        tokenizer = model_loader.tokenizer
-        model = model_loader.model
-        
-        messages = [{"role": msg.role, "content": msg.content} for msg in request.dialogue_history]
-        
-        inputs = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(model.device)
-
-        generation_kwargs = {
-            "inputs": inputs,
-            "attention_mask": (inputs != tokenizer.pad_token_id).long(),
-            "max_new_tokens": request.max_length,
-            "temperature": request.temperature,
-            "do_sample": True,
-            **request.generation_kwargs
-        }
-
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-        generation_kwargs["streamer"] = streamer
-
-        thread = Thread(target=model.generate, kwargs=generation_kwargs)
-        thread.start()
-
-        return StreamingResponse(streamer, media_type="text/plain")
+        request_id = assign_request_id(request, http_request)
+        stream_format = negotiate_stream_format(request, http_request.headers.get("accept", ""))
+        stream = await engine.generate_stream(request)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id}
+        if tenant is not None:
+            stream = charge_stream(stream, tenant, reserved)
+            headers.update(tenant.headers())
+        settled = True
+        # Starlette closes the stream when the client disconnects, which cancels the generation.
+        return StreamingResponse(encode_stream(stream, stream_format), media_type=STREAM_MEDIA_TYPES[stream_format],
+                                 headers=headers)
+    except QueueFullError as e:
+        raise busy_exception(e)
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except Exception as e:
         logger.error(f"Error in generate_stream: {str(e)}")
         raise HTTPException(status_code=500, detail="Error generating text")
+    finally:
+        # Streams settle through charge_stream; anything that fails before one starts is refunded.
+        if not settled:
+            refund(tenant, reserved)
     
 @app.post("/generate")
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request):
+    tenant, reserved = admit_tenant(request, http_request)
+    settled = False
     try:
-        tokenizer = model_loader.tokenizer
-        model = model_loader.model
-        
-        messages = [{"role": msg.role, "content": msg.content} for msg in request.dialogue_history]
-        
-        inputs = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(model.device)
-
-        generation_kwargs = {
-            "inputs": inputs,
-            "attention_mask": (inputs != tokenizer.pad_token_id).long(),
-            "max_new_tokens": request.max_length,
-            "temperature": request.temperature,
-            "do_sample": True,
-            **request.generation_kwargs
-        }
-
-        outputs = model.generate(**generation_kwargs)
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return JSONResponse(content={"generated_text": generated_text})
+        request_id = assign_request_id(request, http_request)
+        timings = {}
+        result = await cancel_on_disconnect(http_request, engine.generate(request, timings))
+        headers = {"X-Request-ID": request_id}
+        if tenant is not None:
+            tenant.settle(reserved, result["usage"]["total_tokens"])
+            headers.update(tenant.headers())
+        settled = True
+        if TIMING_HEADERS:
+            headers["Server-Timing"] = server_timing(timings)
+        return JSONResponse(content=result, headers=headers)
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise busy_exception(e)
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except Exception as e:
         logger.error(f"Error in generate: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error generating text")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Error generating text")
+    finally:
+        # Failed, rejected and abandoned requests give their reservation back.
+        if not settled:
+            refund(tenant, reserved)
+
+@app.post("/cancel")
+async def cancel(request: CancelRequest):
+    try:
+        cancelled = await engine.cancel(request.request_id)
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    if not cancelled:
+        raise HTTPException(status_code=404, detail="Unknown or finished request")
+    return {"request_id": request.request_id, "cancelled": True}
+
+def resolve_bulk_path(name):
+    if not BULK_DIRECTORY:
+        raise HTTPException(status_code=404, detail="Bulk jobs are disabled; set bulk.directory")
+    root = os.path.realpath(BULK_DIRECTORY)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise HTTPException(status_code=400, detail="Path must be inside bulk.directory")
+    return path
+
+def bulk_status(output_path):
+    state = read_checkpoint(output_path) or {"line": 0, "completed": 0, "errors": 0, "done": False}
+    task = bulk_jobs.get(output_path)
+    return {**state, "running": task is not None and not task.done()}
+
+def log_bulk_result(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Bulk job failed: {str(task.exception())}")
+
+@app.post("/bulk")
+async def start_bulk_job(request: BulkJobRequest):
+    input_path = resolve_bulk_path(request.input)
+    output_path = resolve_bulk_path(request.output)
+    if not os.path.isfile(input_path):
+        raise HTTPException(status_code=404, detail="Input file not found")
+    task = bulk_jobs.get(output_path)
+    if task is not None and not task.done():
+        raise HTTPException(status_code=409, detail="A bulk job is already writing to this output")
+    # Requests run in the bulk priority lane; restarting a job with the same output resumes it.
+    job = BulkJob(engine_generate(engine), input_path, output_path,
+                  window_size=bulk_config.get("window_size", 1024), concurrency=bulk_config.get("concurrency", 16))
+    bulk_jobs[output_path] = asyncio.create_task(job.run())
+    bulk_jobs[output_path].add_done_callback(log_bulk_result)
+    return {"output": request.output, **bulk_status(output_path)}
+
+@app.get("/bulk/status")
+async def get_bulk_status(output: str):
+    output_path = resolve_bulk_path(output)
+    if output_path not in bulk_jobs and read_checkpoint(output_path) is None:
+        raise HTTPException(status_code=404, detail="Unknown bulk job")
+    return {"output": output, **bulk_status(output_path)}
+
+@app.get("/models")
+async def list_models():
+    return await engine.models()
+
+@app.post("/models/{name}/load")
+async def load_model(name: str):
+    try:
+        return await engine.load(name)
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        logger.error(f"Error loading model {name}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error loading model")
+
+@app.post("/models/{name}/reload")
+async def reload_model(name: str, http_request: Request, request: ReloadRequest = ReloadRequest()):
+    require_admin(http_request)
+    # Only settings the config opts into can be overridden, so a reload cannot point the server at arbitrary
+    # checkpoints, loading methods or paths.
+    disallowed = sorted(set(request.settings or {}) - RELOADABLE_SETTINGS)
+    if disallowed:
+        raise HTTPException(status_code=400, detail=f"Settings cannot be changed by a reload: {', '.join(disallowed)}")
+    try:
+        return await engine.reload(name, request.settings)
+    except QueueFullError as e:
+        raise busy_exception(e)
+    except EngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        logger.error(f"Error reloading model {name}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error reloading model")
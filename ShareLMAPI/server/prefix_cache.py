@@ -0,0 +1,115 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def block_hashes(token_ids, block_size):
+    # One hash per whole block, each chained on the previous one, so hashing every block-aligned prefix of a
+    # prompt costs a single pass over it.
+    hashes = []
+    digest = b""
+    for end in range(block_size, len(token_ids) + 1, block_size):
+        digest = hashlib.blake2b(digest + array("q", token_ids[end - block_size:end]).tobytes(),
+                                 digest_size=16).digest()
+        hashes.append(digest)
+    return hashes
+
+# Prefixes are cached and looked up in whole blocks of `block_size` tokens.
+class PrefixCache:
+    def __init__(self, max_bytes, min_prefix_tokens=16, block_size=16):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.block_size = max(1, block_size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def aligned_length(self, length):
+        return length - length % self.block_size
+
+    def lookup(self, token_ids, namespace=None):
+        # Hashed outside the lock, then checked longest first. At least one token must be left to prefill so
+        # the model produces next-token logits.
+        hashes = block_hashes(token_ids, self.block_size)
+        with self._lock:
+            for blocks in range(len(hashes), 0, -1):
+                length = blocks * self.block_size
+                if length < self.min_prefix_tokens:
+                    break
+                # KV depends on the weights too, so prefixes computed under different LoRA adapters never match.
+                key = (namespace, hashes[blocks - 1])
+                if length < len(token_ids) and key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.reused_tokens += length
+                    return length, self._entries[key][1]
+            self.misses += 1
+            return 0, None
+
+    def insert(self, token_ids, past_key_values, namespace=None):
+        # `token_ids` must be whole blocks; see aligned_length.
+        if len(token_ids) < self.min_prefix_tokens or len(token_ids) % self.block_size:
+            return
+        nbytes = sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+        if nbytes > self.max_bytes:
+            return
+        key = (namespace, block_hashes(token_ids, self.block_size)[-1])
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            while self._entries and self.bytes + nbytes > self.max_bytes:
+                self._evict()
+            self._entries[key] = (len(token_ids), past_key_values, nbytes)
+            self.bytes += nbytes
+
+    def _evict(self):
+        _, (_, _, nbytes) = self._entries.popitem(last=False)
+        self.bytes -= nbytes
+        self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,312 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.config import load_config, DEFAULT_CONFIG_PATH
+from ShareLMAPI.server.engine import InferenceEngine
+from ShareLMAPI.server.ipc import ModelNotFoundError
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.schemas import GenerateRequest
+from ShareLMAPI.server.memory import check_budget, prefix_cache_bytes
+from ShareLMAPI.server.metrics import Gauge
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge("sharelmapi_startup_phase_seconds", "Time spent in each startup phase of each preloaded model",
+                        ("model", "phase"))
+
+class ModelEntry:
+    def __init__(self, name, model_config):
+        self.name = name
+        self.model_config = model_config
+        # The engine serving new requests; None until first use or after eviction.
+        self.engine = None
+        self.version = 0
+        self.last_used = 0.0
+        self.loading = None
+        self.swapping = False
+        # Measured after the first load; `memory_mb` in the model config is a hint until then.
+        self.memory_bytes = int(model_config.get("memory_mb", 0) * 2**20)
+        # Seconds per phase of the last load: tokenizer, weights, engine and warmup.
+        self.load_timings = {}
+
+# Serves the named models from `models:` (or just `model:`) with the same interface as InferenceEngine.
+class ModelRegistry:
+    def __init__(self, config_path=DEFAULT_CONFIG_PATH):
+        self.config = load_config(config_path)
+        registry_config = self.config.get("registry", {})
+        models = self.config.get("models") or {self.config["model"]["name"]: self.config["model"]}
+        self.entries = {name: ModelEntry(name, model_config) for name, model_config in models.items()}
+        self.default_model = registry_config.get("default_model", next(iter(self.entries)))
+        self.max_memory = int(registry_config.get("max_memory_mb", 0) * 1024 * 1024)
+        # Request memory budget shared by every model, taken from the first engine that loads.
+        self.memory = None
+        # Engines replaced by a hot swap or evicted while requests were still using them.
+        self._retiring = set()
+        self._closing = set()
+        self.preload = registry_config.get("preload", [self.default_model])
+        for name in self.preload:
+            self._entry(name)
+        warmup_config = self.config.get("warmup", {})
+        self.warmup_prompt_lengths = warmup_config.get("prompt_lengths", [16, 256]) \
+            if warmup_config.get("enabled", True) else []
+        self.warmup_max_new_tokens = warmup_config.get("max_new_tokens", 2)
+        # Set by start() once the preloaded models are loaded and warmed up.
+        self.ready = False
+        self.startup = {}
+
+    def _entry(self, name):
+        entry = self.entries.get(name or self.default_model)
+        if entry is None:
+            raise ModelNotFoundError(name)
+        return entry
+
+    def _build(self, model_config):
+        return InferenceEngine(config={**self.config, "model": model_config})
+
+    def _share_memory(self, engine):
+        # All models draw on the same device memory, so their requests reserve against one budget.
+        if engine.memory is None:
+            return
+        if self.memory is not None:
+            engine.memory = self.memory
+            return
+        budget = engine.memory
+        others = len(self.entries) - 1
+        if others and not self.config.get("memory", {}).get("budget_mb"):
+            # Sized from the memory free after loading this model; the other models' prefix caches come out of
+            # it as well, but their weights can only be accounted for by setting memory.budget_mb.
+            budget.budget_bytes = max(0, budget.budget_bytes - others * prefix_cache_bytes(self.config))
+            check_budget(budget.budget_bytes, engine.memory_estimator)
+            logger.warning("memory.budget_mb is not set; the request memory budget was sized after loading "
+                           f"{engine.model_identity} and does not leave room for models loaded later")
+        self.memory = budget
+
+    def _engines(self):
+        return [entry.engine for entry in self.entries.values() if entry.engine is not None] + list(self._retiring)
+
+    def memory_used(self):
+        return sum(engine.memory_bytes for engine in self._engines())
+
+    async def _acquire(self, name):
+        entry = self._entry(name)
+        # Loop because another load may evict this model before we get to lease it.
+        while entry.engine is None:
+            if entry.loading is None:
+                entry.loading = asyncio.ensure_future(self._load(entry))
+            # Concurrent first requests share one load.
+            await asyncio.shield(entry.loading)
+        engine = entry.engine
+        engine.leases += 1
+        entry.last_used = time.monotonic()
+        return engine
+
+    def _release(self, engine):
+        engine.leases -= 1
+        if engine.leases == 0 and engine in self._retiring:
+            self._retiring.discard(engine)
+            self._close(engine)
+
+    def _retire(self, engine):
+        if engine.leases == 0:
+            self._close(engine)
+        else:
+            # In-flight requests drain against the old engine; the last one to finish closes it.
+            self._retiring.add(engine)
+
+    def _close(self, engine):
+        task = asyncio.ensure_future(engine.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _load(self, entry):
+        try:
+            started_at = time.monotonic()
+            self._make_room(exclude=entry, needed=entry.memory_bytes)
+            engine = await asyncio.to_thread(self._build, entry.model_config)
+            try:
+                self._share_memory(engine)
+            except Exception:
+                await engine.aclose()
+                raise
+            entry.load_timings = self._load_timings(engine, time.monotonic() - started_at)
+            entry.engine = engine
+            entry.memory_bytes = engine.memory_bytes
+            entry.version += 1
+            # The real size is only known after loading.
+            self._make_room(exclude=entry)
+            logger.info(f"Loaded model {entry.name} in {time.monotonic() - started_at:.2f}s")
+        finally:
+            entry.loading = None
+
+    def _load_timings(self, engine, elapsed):
+        timings = dict(engine.model_loader.load_timings)
+        # Everything after the weights: scheduler, caches and worker threads.
+        timings["engine"] = elapsed - engine.model_loader.load_duration
+        return timings
+
+    async def _warmup(self, engine):
+        # A reload always runs at least one request, to check the new version works before swapping it in.
+        return await engine.warmup(self.warmup_prompt_lengths or [1], self.warmup_max_new_tokens)
+
+    async def start(self):
+        # Loads and warms up the preloaded models; other models still load on first use.
+        started_at = time.monotonic()
+        try:
+            for name in self.preload:
+                entry = self._entry(name)
+                engine = await self._acquire(name)
+                try:
+                    if self.warmup_prompt_lengths:
+                        entry.load_timings["warmup"] = await self._warmup(engine)
+                finally:
+                    self._release(engine)
+                for phase, seconds in entry.load_timings.items():
+                    if isinstance(seconds, float):
+                        STARTUP_SECONDS.labels(model=name, phase=phase).set(seconds)
+                self.startup.setdefault("models", {})[name] = entry.load_timings
+        except Exception as e:
+            logger.error(f"Error during startup: {str(e)}")
+            self.startup["error"] = str(e)
+            return
+        self.startup["total"] = time.monotonic() - started_at
+        self.ready = True
+        logger.info(f"Ready in {self.startup['total']:.2f}s: {self.startup}")
+
+    def _make_room(self, exclude=None, needed=0):
+        if not self.max_memory:
+            return
+        while self.memory_used() + needed > self.max_memory:
+            idle = [entry for entry in self.entries.values()
+                    if entry is not exclude and entry.engine is not None and entry.engine.leases == 0]
+            if not idle:
+                logger.warning(f"Model memory {self.memory_used() / 2**20:.0f}MB exceeds the "
+                               f"{self.max_memory / 2**20:.0f}MB budget but every loaded model is in use")
+                return
+            victim = min(idle, key=lambda entry: entry.last_used)
+            logger.info(f"Evicting least recently used model {victim.name}")
+            self._retire(victim.engine)
+            victim.engine = None
+
+    async def load(self, name):
+        self._release(await self._acquire(name))
+        return self.model_info(name)
+
+    async def reload(self, name, settings=None):
+        # Zero-downtime swap: the new version loads and warms up while the old one keeps serving.
+        entry = self._entry(name)
+        if entry.swapping:
+            raise QueueFullError("Model is already being reloaded")
+        model_config = {**entry.model_config, **(settings or {})}
+        if entry.engine is None and entry.loading is None:
+            entry.model_config = model_config
+            return await self.load(name)
+        entry.swapping = True
+        try:
+            started_at = time.monotonic()
+            engine = await asyncio.to_thread(self._build, model_config)
+            try:
+                self._share_memory(engine)
+                load_timings = self._load_timings(engine, time.monotonic() - started_at)
+                load_timings["warmup"] = await self._warmup(engine)
+            except Exception:
+                await engine.aclose()
+                raise
+        finally:
+            entry.swapping = False
+        old, entry.engine = entry.engine, engine
+        entry.model_config = model_config
+        entry.memory_bytes = engine.memory_bytes
+        entry.load_timings = load_timings
+        entry.version += 1
+        entry.last_used = time.monotonic()
+        if old is not None:
+            self._retire(old)
+        self._make_room(exclude=entry)
+        logger.info(f"Swapped in version {entry.version} of model {name}")
+        return self.model_info(name)
+
+    async def generate(self, request: GenerateRequest, timings=None):
+        engine = await self._acquire(request.model)
+        try:
+            return await engine.generate(request, timings)
+        finally:
+            self._release(engine)
+
+    async def generate_stream(self, request: GenerateRequest):
+        engine = await self._acquire(request.model)
+        try:
+            stream = await engine.generate_stream(request)
+        except BaseException:
+            self._release(engine)
+            raise
+        return self._leased(engine, stream)
+
+    async def _leased(self, engine, stream):
+        try:
+            async for event in stream:
+                yield event
+        finally:
+            self._release(engine)
+
+    async def cancel(self, request_id):
+        for engine in self._engines():
+            if await engine.cancel(request_id):
+                return True
+        return False
+
+    def model_info(self, name):
+        entry = self._entry(name)
+        info = {"loaded": entry.engine is not None, "reloading": entry.swapping, "version": entry.version,
+                "loading_method": entry.model_config.get("loading_method")}
+        if entry.engine is not None:
+            info.update(entry.engine.snapshot())
+            info["load_timings"] = entry.load_timings
+            info["in_use"] = entry.engine.leases
+            info["memory_mb"] = entry.engine.memory_bytes / 2**20
+        return info
+
+    async def models(self):
+        return {"default_model": self.default_model,
+                "models": {name: self.model_info(name) for name in self.entries}}
+
+    async def stats(self):
+        stats = {"queue_depth": 0, "in_flight": 0}
+        for engine in self._engines():
+            snapshot = engine.snapshot()
+            stats["queue_depth"] += snapshot["queue_depth"]
+            stats["in_flight"] += snapshot["in_flight"]
+        stats["memory"] = {"used_mb": self.memory_used() / 2**20, "max_mb": self.max_memory / 2**20 or None}
+        # Request memory reserved against the shared budget, on top of the weights above.
+        if self.memory is not None:
+            stats["memory"]["requests_reserved_mb"] = self.memory.reserved_bytes / 2**20
+            stats["memory"]["requests_free_mb"] = self.memory.free_bytes / 2**20
+        stats["ready"] = self.ready
+        stats["startup"] = self.startup
+        stats.update(await self.models())
+        return stats
+
+    async def aclose(self):
+        for engine in self._engines():
+            await engine.aclose()
+        self._retiring.clear()
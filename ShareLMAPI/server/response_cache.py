@@ -0,0 +1,145 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=3600, disk_path=None, max_disk_entries=100000, max_disk_mb=1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # 0 leaves the on-disk tier unbounded.
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = int(max_disk_mb * 2**20) if max_disk_mb else 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(responses)")}
+            if columns and "used" not in columns:
+                # Written by a version that could not trim it; it is only a cache, so start over.
+                self._db.execute("DROP TABLE responses")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL, size INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+            self._db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self._disk_entries, self._disk_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            self._trim_disk()
+            self._db.commit()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < now:
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM responses WHERE key = ? AND expires >= ?",
+                                       (key, now)).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+                    self._store(key, entry)
+                    try:
+                        self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                    except sqlite3.Error as e:
+                        logger.error(f"Error writing response cache: {str(e)}")
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        now = time.time()
+        entry = (value, now + self.ttl)
+        with self._lock:
+            self._store(key, entry)
+            if self._db is not None:
+                try:
+                    payload = json.dumps(value, ensure_ascii=False)
+                    size = len(key) + len(payload.encode("utf-8"))
+                    old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                    self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                     (key, payload, entry[1], now, size))
+                    self._disk_entries += old is None
+                    self._disk_bytes += size - (old[0] if old is not None else 0)
+                    self._trim_disk()
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing response cache: {str(e)}")
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _trim_disk(self):
+        # Least recently used rows go first, as in memory, until the table is within both limits.
+        excess_entries = self._disk_entries - self.max_disk_entries if self.max_disk_entries else 0
+        excess_bytes = self._disk_bytes - self.max_disk_bytes if self.max_disk_bytes else 0
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+        evicted = []
+        cursor = self._db.execute("SELECT key, size FROM responses ORDER BY used")
+        for key, size in cursor:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            evicted.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+            self._disk_entries -= 1
+            self._disk_bytes -= size
+        cursor.close()
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
@@ -0,0 +1,550 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.metrics import Counter, Histogram
+from collections import deque
+import asyncio
+import logging
+import threading
+import time
+import torch
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUE_TIME = Histogram("sharelmapi_scheduler_queue_time_seconds", "Time requests wait before their prefill starts")
+PREFILL_TIME = Histogram("sharelmapi_prefill_time_seconds", "Duration of prefill forward passes")
+DECODE_STEP_TIME = Histogram("sharelmapi_decode_step_seconds", "Duration of batched decode steps")
+BATCH_SIZE = Histogram("sharelmapi_batch_size", "Number of sequences in each decode step",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+TIME_TO_FIRST_TOKEN = Histogram("sharelmapi_time_to_first_token_seconds", "Time from submission to the first generated token")
+INTER_TOKEN_LATENCY = Histogram("sharelmapi_inter_token_latency_seconds", "Time between consecutive generated tokens",
+                                buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+PROMPT_TOKENS = Counter("sharelmapi_prompt_tokens_total", "Prompt tokens processed")
+GENERATED_TOKENS = Counter("sharelmapi_generated_tokens_total", "Tokens generated")
+STOPPED_REQUESTS = Counter("sharelmapi_stopped_requests_total", "Requests stopped early by cancellation or their deadline",
+                           ("reason",))
+
+# generation_kwargs the batched decode loop knows how to honour; anything else
+# (beam search, logits processors, ...) is served by model.generate instead.
+BATCHABLE_KWARGS = {"do_sample", "temperature", "top_k", "top_p", "max_new_tokens", "seed",
+                    "eos_token_id", "pad_token_id", "use_cache", "num_beams", "num_return_sequences"}
+
+# Interactive requests are always admitted first; bulk requests only use the remaining batch slots.
+PRIORITIES = ("interactive", "bulk")
+
+# Tenants whose start-time fair queuing tags are older than this are forgotten.
+MAX_TRACKED_TENANTS = 1024
+
+class SamplingParams:
+    def __init__(self, max_new_tokens=50, temperature=1.0, do_sample=True, top_k=50, top_p=1.0, eos_token_id=None,
+                 seed=None):
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.do_sample = do_sample and temperature > 0
+        self.top_k = top_k or 0
+        self.top_p = 1.0 if top_p is None else top_p
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = eos_token_id
+        self.seed = seed
+
+    @property
+    def deterministic(self):
+        return not self.do_sample or self.seed is not None
+
+    @classmethod
+    def from_request(cls, max_new_tokens, temperature, generation_kwargs=None, generation_config=None):
+        kwargs = dict(generation_kwargs or {})
+        if any(key not in BATCHABLE_KWARGS for key in kwargs):
+            return None
+        if kwargs.get("num_beams", 1) != 1 or kwargs.get("num_return_sequences", 1) != 1:
+            return None
+        return cls(
+            max_new_tokens=kwargs.get("max_new_tokens", max_new_tokens),
+            temperature=kwargs.get("temperature", temperature),
+            do_sample=kwargs.get("do_sample", True),
+            top_k=kwargs.get("top_k", getattr(generation_config, "top_k", 50)),
+            top_p=kwargs.get("top_p", getattr(generation_config, "top_p", 1.0)),
+            eos_token_id=kwargs.get("eos_token_id"),
+            seed=kwargs.get("seed"),
+        )
+
+class GenerationSequence:
+    def __init__(self, input_ids, params, request_id=None, cache_boundaries=None, deadline=None, adapter=None,
+                 tenant=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.input_ids = list(input_ids)
+        self.params = params
+        # LoRA adapter applied to this row of the batch; None runs the base model.
+        self.adapter = adapter
+        self.tenant = tenant
+        # Start tag for fair queuing between tenants; lower tags join a batch first.
+        self.fair_start = 0.0
+        # Prompt lengths (e.g. the end of the system prompt) worth caching on their own.
+        self.cache_boundaries = list(cache_boundaries or [])
+        self.generator = None
+        self.output_ids = []
+        self.finish_reason = None
+        self.submitted_at = time.monotonic()
+        self.prefill_started_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        # time.monotonic() after which the sequence is stopped with finish_reason "timeout".
+        self.deadline = deadline
+        self._cancel_reason = None
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+
+    @property
+    def finished(self):
+        return self.finish_reason is not None
+
+    def cancel(self, reason="cancelled"):
+        # Safe from any thread; the scheduler stops the sequence before its next decode step.
+        self._cancel_reason = reason
+
+    def _stop_reason(self, now):
+        if self._cancel_reason is not None:
+            return self._cancel_reason
+        if self.deadline is not None and now >= self.deadline:
+            return "timeout"
+        return None
+
+    def _generator(self, device):
+        # Seeded requests draw from their own generator, so their samples do not depend on the rest of the batch.
+        if self.params.seed is not None and self.generator is None:
+            self.generator = torch.Generator(device=device).manual_seed(self.params.seed)
+        return self.generator
+
+    def _emit(self, event):
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def _append(self, token_id, max_positions=None):
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+            TIME_TO_FIRST_TOKEN.observe(now - self.submitted_at)
+        else:
+            INTER_TOKEN_LATENCY.observe(now - self.last_token_at)
+        self.last_token_at = now
+        GENERATED_TOKENS.inc()
+        self.output_ids.append(token_id)
+        self._emit(("token", token_id))
+        if self.params.eos_token_id and token_id in self.params.eos_token_id:
+            self._finish("stop")
+        elif len(self.output_ids) >= self.params.max_new_tokens:
+            self._finish("length")
+        elif max_positions and len(self.input_ids) + len(self.output_ids) >= max_positions:
+            self._finish("length")
+
+    def _finish(self, reason):
+        self.finish_reason = reason
+        self._emit(("done", reason))
+
+    def _fail(self, error):
+        self.finish_reason = "error"
+        self._emit(("error", error))
+
+    async def __aiter__(self):
+        while True:
+            kind, value = await self._events.get()
+            if kind == "token":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    async def result(self):
+        async for _ in self:
+            pass
+        return self.output_ids
+
+def warp_logits(row, params):
+    # Temperature, top-k and top-p applied to one row of next-token logits.
+    row = row / params.temperature
+    if params.top_k:
+        kth = torch.topk(row, min(params.top_k, row.shape[-1])).values[-1]
+        row = row.masked_fill(row < kth, float("-inf"))
+    if params.top_p < 1.0:
+        sorted_logits, sorted_index = row.sort(descending=True)
+        cumulative = sorted_logits.softmax(-1).cumsum(-1)
+        remove = cumulative > params.top_p
+        remove[1:] = remove[:-1].clone()
+        remove[0] = False
+        row = row.masked_fill(remove.scatter(0, sorted_index, remove), float("-inf"))
+    return row
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def _left_pad(tensor, length, dim):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class BatchScheduler:
+    def __init__(self, model_loader, max_batch_size=8, max_wait_ms=10, max_queue_size=64, retry_after=1,
+                 prefix_cache=None, interactive_reserved_slots=None, adapters=None, speculative=None):
+        self.model_loader = model_loader
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        # SpeculativeDecoder used while only one sequence is decoding.
+        self.speculative = speculative
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        # Batch slots bulk requests may not take, so interactive requests never wait behind a full bulk batch.
+        if interactive_reserved_slots is None:
+            interactive_reserved_slots = self.max_batch_size // 4
+        self.bulk_batch_size = max(1, self.max_batch_size - interactive_reserved_slots)
+        self._pending = {priority: deque() for priority in PRIORITIES}
+        # Start-time fair queuing: the virtual time and each tenant's last finish tag.
+        self._virtual_time = 0.0
+        self._finish_tags = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._reset()
+        self._thread = threading.Thread(target=self._run, name="BatchScheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids, params, request_id=None, cache_boundaries=None, deadline=None, priority="interactive",
+               adapter=None, tenant=None, weight=1.0):
+        sequence = GenerationSequence(input_ids, params, request_id=request_id, cache_boundaries=cache_boundaries,
+                                      deadline=deadline, adapter=adapter, tenant=tenant)
+        if sequence.params.eos_token_id is None:
+            sequence.params.eos_token_id = self._default_eos_token_id()
+        with self._cond:
+            pending = self._pending[priority]
+            if len(pending) >= self.max_queue_size:
+                raise QueueFullError(retry_after=self.retry_after)
+            self._tag(sequence, weight)
+            pending.append(sequence)
+            self._cond.notify()
+        return sequence
+
+    def _tag(self, sequence, weight):
+        # A tenant's requests are spaced by their cost over its weight, so a tenant with a deep backlog
+        # only delays others by its fair share. Without tenants this is first come, first served.
+        if len(self._finish_tags) > MAX_TRACKED_TENANTS:
+            self._finish_tags = {tenant: tag for tenant, tag in self._finish_tags.items() if tag > self._virtual_time}
+        sequence.fair_start = max(self._virtual_time, self._finish_tags.get(sequence.tenant, 0.0))
+        cost = len(sequence.input_ids) + sequence.params.max_new_tokens
+        self._finish_tags[sequence.tenant] = sequence.fair_start + cost / weight
+
+    def _next_pending(self, pending):
+        sequence = min(pending, key=lambda sequence: sequence.fair_start)
+        pending.remove(sequence)
+        self._virtual_time = max(self._virtual_time, sequence.fair_start)
+        return sequence
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    @property
+    def batch_size(self):
+        return len(self._active)
+
+    @property
+    def queue_depth(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    def stats(self):
+        stats = {"batch_size": self.batch_size, "queue_depth": self.queue_depth,
+                 "bulk_queue_depth": len(self._pending["bulk"])}
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        if self.speculative is not None:
+            stats["speculative"] = self.speculative.stats()
+        return stats
+
+    def _default_eos_token_id(self):
+        eos_token_id = getattr(self.model_loader.model.generation_config, "eos_token_id", None)
+        if eos_token_id is None:
+            eos_token_id = self.model_loader.tokenizer.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        return eos_token_id or []
+
+    def _max_positions(self):
+        config = self.model_loader.model.config
+        return getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None)
+
+    def _reset(self):
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        if self.speculative is not None:
+            self.speculative.reset()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.queue_depth and not self._active and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                if not self._active:
+                    # Give concurrent requests a short window to arrive so they share the first step.
+                    deadline = time.monotonic() + self.max_wait
+                    while self.queue_depth < self.max_batch_size and not self._stopped:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                self._stop_pending()
+                joining = []
+                for priority, limit in (("interactive", self.max_batch_size), ("bulk", self.bulk_batch_size)):
+                    pending = self._pending[priority]
+                    while pending and len(self._active) + len(joining) < limit:
+                        joining.append(self._next_pending(pending))
+            try:
+                with torch.inference_mode():
+                    if joining:
+                        self._prefill(joining)
+                    self._stop_active()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                logger.error(f"Error in batch scheduler: {str(e)}")
+                for sequence in self._active + joining:
+                    if not sequence.finished:
+                        sequence._fail(e)
+                self._reset()
+        for sequence in self._active + [sequence for pending in self._pending.values() for sequence in pending]:
+            sequence._fail(RuntimeError("Scheduler stopped"))
+        self._reset()
+        for pending in self._pending.values():
+            pending.clear()
+
+    def _stop_pending(self):
+        now = time.monotonic()
+        for pending in self._pending.values():
+            for sequence in [sequence for sequence in pending if sequence._stop_reason(now) is not None]:
+                pending.remove(sequence)
+                self._stop(sequence, sequence._stop_reason(now))
+
+    def _stop_active(self):
+        now = time.monotonic()
+        for sequence in self._active:
+            reason = sequence._stop_reason(now)
+            if reason is not None and not sequence.finished:
+                self._stop(sequence, reason)
+        # Frees the slot and its KV columns before the next decode step.
+        self._evict_finished()
+
+    def _stop(self, sequence, reason):
+        STOPPED_REQUESTS.labels(reason=reason).inc()
+        sequence._finish(reason)
+
+    def _prefill(self, sequences):
+        misses = sequences
+        if self.prefix_cache is not None:
+            misses = []
+            for sequence in sequences:
+                length, past_key_values = self.prefix_cache.lookup(sequence.input_ids, namespace=sequence.adapter)
+                if past_key_values is None:
+                    misses.append(sequence)
+                else:
+                    # Only the uncached suffix of the prompt has to be prefilled.
+                    self._prefill_batch([sequence], past_key_values, length)
+        if misses:
+            self._prefill_batch(misses)
+        self._evict_finished()
+
+    def _prefill_batch(self, sequences, past_key_values=None, past_length=0):
+        model = self.model_loader.model
+        started_at = time.monotonic()
+        for sequence in sequences:
+            sequence.prefill_started_at = started_at
+            QUEUE_TIME.observe(started_at - sequence.submitted_at)
+            PROMPT_TOKENS.inc(len(sequence.input_ids))
+        if past_key_values is not None:
+            input_ids = torch.tensor([sequences[0].input_ids[past_length:]], dtype=torch.long)
+            attention_mask = torch.ones((1, len(sequences[0].input_ids)), dtype=torch.long)
+            position_ids = torch.arange(past_length, len(sequences[0].input_ids), dtype=torch.long).unsqueeze(0)
+        else:
+            max_len = max(len(sequence.input_ids) for sequence in sequences)
+            input_ids = torch.zeros((len(sequences), max_len), dtype=torch.long)
+            attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+            for i, sequence in enumerate(sequences):
+                length = len(sequence.input_ids)
+                input_ids[i, max_len - length:] = torch.tensor(sequence.input_ids, dtype=torch.long)
+                attention_mask[i, max_len - length:] = 1
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        input_ids = input_ids.to(model.device)
+        attention_mask = attention_mask.to(model.device)
+        position_ids = position_ids.to(model.device)
+
+        outputs = self._forward(sequences, input_ids=input_ids, attention_mask=attention_mask,
+                                position_ids=position_ids, past_key_values=past_key_values)
+        next_tokens = self._sample(outputs.logits[:, -1, :], sequences)
+        PREFILL_TIME.observe(time.monotonic() - started_at)
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None:
+            for i, sequence in enumerate(sequences):
+                for length in sequence.cache_boundaries + [len(sequence.input_ids)]:
+                    self._cache_prefix(sequence, sequence.input_ids[:length], past_key_values, attention_mask, i)
+        self._merge(sequences, past_key_values, attention_mask)
+
+        max_positions = self._max_positions()
+        for sequence, token_id in zip(sequences, next_tokens):
+            sequence._append(token_id, max_positions)
+
+    def _forward(self, sequences, **inputs):
+        if self.adapters is None:
+            return self.model_loader.model(**inputs, use_cache=True)
+        # Sequences for different adapters share the batch; each row runs through its own LoRA weights.
+        with self.adapters.lock:
+            return self.model_loader.model(**inputs, **self.adapters.forward_kwargs(
+                [sequence.adapter for sequence in sequences]), use_cache=True)
+
+    def _cache_prefix(self, sequence, token_ids, past_key_values, attention_mask, row):
+        # Only whole blocks are cached; a prompt's last partial block is prefilled again on reuse.
+        token_ids = token_ids[:self.prefix_cache.aligned_length(len(token_ids))]
+        if len(token_ids) < self.prefix_cache.min_prefix_tokens:
+            return
+        # Rows are left padded, so a row's tokens are the last `mask.sum()` columns.
+        start = attention_mask.shape[1] - int(attention_mask[row].sum())
+        end = start + len(token_ids)
+        self.prefix_cache.insert(token_ids, tuple(
+            tuple(tensor[row:row + 1, :, start:end].clone() for tensor in layer) for layer in past_key_values
+        ), namespace=sequence.adapter)
+
+    def _merge(self, sequences, past_key_values, attention_mask):
+        if not self._active:
+            self._active = list(sequences)
+            self._past = past_key_values
+            self._attention_mask = attention_mask
+            return
+        length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        self._past = tuple(
+            tuple(torch.cat([_left_pad(old, length, 2), _left_pad(new, length, 2)], dim=0)
+                  for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self._past, past_key_values)
+        )
+        self._attention_mask = torch.cat(
+            [_left_pad(self._attention_mask, length, 1), _left_pad(attention_mask, length, 1)], dim=0
+        )
+        self._active.extend(sequences)
+
+    def _decode_step(self):
+        if self.speculative is not None and len(self._active) == 1:
+            k = self.speculative.lookahead(self._active[0], self._max_positions())
+            if k:
+                return self._speculative_step(k)
+        model = self.model_loader.model
+        started_at = time.monotonic()
+        BATCH_SIZE.observe(len(self._active))
+        input_ids = torch.tensor([[sequence.output_ids[-1]] for sequence in self._active],
+                                 dtype=torch.long, device=model.device)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))], dim=1)
+        position_ids = attention_mask.sum(-1, keepdim=True) - 1
+
+        outputs = self._forward(self._active, input_ids=input_ids, attention_mask=attention_mask,
+                                position_ids=position_ids, past_key_values=self._past)
+        self._past = _to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        DECODE_STEP_TIME.observe(time.monotonic() - started_at)
+        max_positions = self._max_positions()
+        for sequence, token_id in zip(self._active, next_tokens):
+            sequence._append(token_id, max_positions)
+        self._evict_finished()
+
+    def _speculative_step(self, k):
+        # One forward pass verifies k draft tokens and yields between 1 and k + 1 tokens.
+        model = self.model_loader.model
+        sequence = self._active[0]
+        started_at = time.monotonic()
+        BATCH_SIZE.observe(1)
+        draft_tokens, draft_probs = self.speculative.propose(sequence, k, model.config.vocab_size)
+        input_ids = torch.tensor([[sequence.output_ids[-1]] + draft_tokens], dtype=torch.long, device=model.device)
+        past_length = self._attention_mask.shape[1]
+        context = int(self._attention_mask.sum())
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones((1, k + 1))], dim=1)
+        position_ids = torch.arange(context, context + k + 1, dtype=torch.long, device=model.device).unsqueeze(0)
+
+        outputs = self._forward(self._active, input_ids=input_ids, attention_mask=attention_mask,
+                                position_ids=position_ids, past_key_values=self._past)
+        tokens = self.speculative.verify(sequence, outputs.logits[0], draft_tokens, draft_probs)
+        # Keep the KV of the last context token and the accepted draft tokens; the final token is fed next step.
+        keep = past_length + len(tokens)
+        self._past = tuple(tuple(tensor[:, :, :keep] for tensor in layer)
+                           for layer in _to_legacy_cache(outputs.past_key_values))
+        self._attention_mask = attention_mask[:, :keep]
+        self.speculative.rewind(len(sequence.input_ids) + len(sequence.output_ids) + len(tokens) - 1)
+        DECODE_STEP_TIME.observe(time.monotonic() - started_at)
+
+        max_positions = self._max_positions()
+        for token_id in tokens:
+            sequence._append(token_id, max_positions)
+            if sequence.finished:
+                break
+        self._evict_finished()
+
+    def _evict_finished(self):
+        keep = [i for i, sequence in enumerate(self._active) if not sequence.finished]
+        if len(keep) == len(self._active):
+            return
+        if self.prefix_cache is not None:
+            for i, sequence in enumerate(self._active):
+                if sequence.finished and sequence.finish_reason != "error":
+                    # The cache holds every token fed to the model: the prompt and all but the last output.
+                    token_ids = sequence.input_ids + sequence.output_ids[:-1]
+                    self._cache_prefix(sequence, token_ids, self._past, self._attention_mask, i)
+        if not keep:
+            self._reset()
+            return
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        self._active = [self._active[i] for i in keep]
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        # Drop leading columns that are padding for every remaining row.
+        start = int(self._attention_mask.any(dim=0).nonzero()[0])
+        self._attention_mask = self._attention_mask[:, start:]
+        self._past = tuple(
+            tuple(tensor.index_select(0, index.to(tensor.device))[:, :, start:] for tensor in layer)
+            for layer in self._past
+        )
+
+    def _sample(self, logits, sequences):
+        logits = logits.float()
+        next_tokens = []
+        for row, sequence in zip(logits, sequences):
+            params = sequence.params
+            if not params.do_sample:
+                next_tokens.append(int(row.argmax()))
+                continue
+            probs = warp_logits(row, params).softmax(-1)
+            next_tokens.append(int(torch.multinomial(probs, 1, generator=sequence._generator(row.device))))
+        return next_tokens
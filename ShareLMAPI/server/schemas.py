@@ -0,0 +1,68 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from pydantic import BaseModel, model_validator
+from typing import List, Dict, Literal, Optional
+
+class DialogueMessage(BaseModel):
+    role: str
+    content: str
+
+class GenerateRequest(BaseModel):
+    dialogue_history: List[DialogueMessage] = []
+    # Pre-tokenized prompt, chat template already applied; used instead of dialogue_history when given.
+    input_ids: Optional[List[int]] = None
+    # Name of a model under `models:` in the config; the default model when omitted.
+    model: Optional[str] = None
+    # Name of a LoRA adapter under the model's `adapters.paths`; the base model when omitted.
+    adapter: Optional[str] = None
+    max_length: int = 50
+    temperature: float = 1.0
+    streamer: Optional[bool] = True
+    generation_kwargs: Optional[Dict] = {}
+    # Streaming wire format; falls back to the Accept header, then `streaming.format`.
+    stream_format: Optional[Literal["ndjson", "sse", "text"]] = None
+    # Used by /cancel; assigned by the server when omitted.
+    request_id: Optional[str] = None
+    # Seconds before generation stops with finish_reason "timeout"; defaults to limits.request_timeout.
+    timeout: Optional[float] = None
+    # "bulk" requests only use batch capacity that interactive traffic leaves free.
+    priority: Literal["interactive", "bulk"] = "interactive"
+    # Set by the server from the caller's API key when tenants are enabled; used for fair queuing.
+    tenant: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_prompt(self):
+        if not self.dialogue_history and not self.input_ids:
+            raise ValueError("Either dialogue_history or input_ids must be provided")
+        return self
+
+class CancelRequest(BaseModel):
+    request_id: str
+
+class BulkJobRequest(BaseModel):
+    # Paths are relative to `bulk.directory` on the model server.
+    input: str
+    output: str
+
+class ReloadRequest(BaseModel):
+    # Overrides for the model's config section, e.g. a new `name` to swap in another checkpoint.
+    settings: Optional[Dict] = None
@@ -19,62 +19,297 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import requests
+import httpx
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, Response
+from starlette.background import BackgroundTask
+from ShareLMAPI.server.config import load_config
+from ShareLMAPI.server.backends import BackendPool
+from ShareLMAPI.server.cancellation import cancel_on_disconnect
+from ShareLMAPI.server.schemas import CancelRequest
+from ShareLMAPI.server.tenants import TenantPolicy, RateLimitError, UnknownTenantError, estimate_tokens
+from ShareLMAPI.server.wire import compress_body, DEFAULT_LEVEL, DEFAULT_MIN_BYTES
+from ShareLMAPI.server.metrics import REGISTRY, CONTENT_TYPE, Gauge, Histogram, HTTPMetrics, MetricsMiddleware, server_timing
+import asyncio
+import json
 import logging
-import yaml
+import math
+import time
+import uuid
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
-def load_config(config_path="configs/model_config.yaml"):
+config = load_config()
+backend_pool = BackendPool.from_config(config["model_server"])
+TIMING_HEADERS = config.get("metrics", {}).get("timing_headers", True)
+tenant_policy = TenantPolicy(config)
+compression_config = config["model_server"].get("compression", {})
+# Client-error headers worth passing back from a model server.
+FORWARDED_ERROR_HEADERS = ("retry-after", "x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens",
+                           "x-ratelimit-reset-tokens")
+
+app.add_middleware(MetricsMiddleware, metrics=HTTPMetrics("sharelmapi_gateway"), endpoints=("/generate", "/generate_stream"))
+UPSTREAM_LATENCY = Histogram("sharelmapi_gateway_upstream_response_seconds",
+                             "Time until a model server returns response headers", ("backend",))
+Gauge("sharelmapi_gateway_backend_in_flight", "Requests outstanding at each model server", ("backend",),
+      function=lambda: {backend.url: backend.in_flight for backend in backend_pool.backends})
+Gauge("sharelmapi_gateway_backend_available", "Whether each model server is currently receiving traffic", ("backend",),
+      function=lambda: {backend.url: int(backend.available()) for backend in backend_pool.backends})
+
+http_client = None
+health_check_task = None
+
+def create_http_client(model_server_config):
+    limits = httpx.Limits(
+        max_connections=model_server_config.get("max_connections", 100),
+        max_keepalive_connections=model_server_config.get("max_keepalive_connections", 20),
+        keepalive_expiry=model_server_config.get("keepalive_expiry", 30)
+    )
+    timeout = httpx.Timeout(
+        model_server_config.get("read_timeout", 300),
+        connect=model_server_config.get("connect_timeout", 5),
+        pool=model_server_config.get("pool_timeout", 10)
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+@app.on_event("startup")
+async def open_http_client():
+    global http_client, health_check_task
+    http_client = create_http_client(config["model_server"])
+    health_check_task = asyncio.create_task(backend_pool.run_health_checks(http_client))
+
+@app.on_event("shutdown")
+async def close_http_client():
+    health_check_task.cancel()
+    await http_client.aclose()
+
+def get_session_id(request: Request, body):
+    return request.headers.get("X-Session-ID") or body.get("session_id")
+
+def routing_fields(request: Request, raw):
+    # The request body is forwarded to the model server byte for byte. It is only parsed when the gateway
+    # needs a field from it: the tenant's token estimate or a session id given in the body.
+    if not tenant_policy.enabled and ("x-session-id" in request.headers or b'"session_id"' not in raw):
+        return {}
     try:
-        with open(config_path, "r") as file:
-            return yaml.safe_load(file)
-    except Exception as e:
-        logger.error(f"Error loading config: {str(e)}")
-        raise
+        body = json.loads(raw)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return body
 
-config = load_config()
-MODEL_SERVER_URL = config["model_server"]["model_server_url"]
+def upstream_request(request: Request, raw):
+    # The body to send to the model server and its headers. The request id is assigned here so /cancel on the
+    # gateway can find the request on whichever backend serves it; a request_id in the body still wins.
+    content, headers = compress_body(raw, enabled=compression_config.get("enabled", False),
+                                     min_bytes=compression_config.get("min_bytes", DEFAULT_MIN_BYTES),
+                                     level=compression_config.get("level", DEFAULT_LEVEL))
+    headers["Content-Type"] = "application/json"
+    headers["X-Request-ID"] = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    return content, {**headers, **upstream_headers(request)}
+
+def admit_tenant(request: Request, body):
+    # Rejects callers over their token rate limit here, before they take a connection to a model server.
+    try:
+        tenant = tenant_policy.identify(request.headers)
+    except UnknownTenantError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    if tenant is None:
+        return None, 0
+    # The model server applies the tenant's priority itself; it identifies the tenant from the same API key.
+    reserved = estimate_tokens(body)
+    try:
+        tenant.reserve(reserved)
+    except RateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(math.ceil(e.retry_after)), **tenant.headers()})
+    return tenant, reserved
+
+def refund(tenant, reserved):
+    # For requests that were refused or failed before the model server generated anything.
+    if tenant is not None:
+        tenant.settle(reserved, 0)
+
+def upstream_headers(request: Request):
+    # The model server identifies the tenant from the same API key for its fair queuing and rate limits.
+    return {name: request.headers[name] for name in ("accept", "x-api-key", "authorization") if name in request.headers}
+
+def stream_usage(tail):
+    # Total tokens from the done event at the end of an NDJSON or SSE stream.
+    for line in reversed(tail.decode("utf-8", "ignore").splitlines()):
+        try:
+            event = json.loads(line.removeprefix("data: "))
+        except ValueError:
+            continue
+        if isinstance(event, dict) and event.get("type") == "done":
+            return event["usage"]["total_tokens"]
+    return None
 
-def call_model_server(endpoint, payload, stream=False):
+def stream_closer(response, backend):
+    # Closes the upstream response and frees its backend slot once, whether the stream finishes, fails partway
+    # or is never started because the client left first.
+    closed = False
+
+    async def close():
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        backend.in_flight -= 1
+        await response.aclose()
+    return close
+
+async def forward_stream(response, close, tenant, reserved):
+    tail = b""
+    used = reserved
     try:
-        response = requests.post(f"{MODEL_SERVER_URL}/{endpoint}", json=payload, stream=stream)
-        response.raise_for_status()
-        return response
-    except requests.RequestException as e:
-        logger.error(f"Error calling model server: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error calling model server")
+        async for chunk in response.aiter_raw():
+            if tenant is not None:
+                tail = (tail + chunk)[-4096:]
+            yield chunk
+        if tenant is not None:
+            usage = stream_usage(tail)
+            used = reserved if usage is None else usage
+    finally:
+        if tenant is not None:
+            tenant.settle(reserved, used)
+        await close()
+
+async def call_model_server(endpoint, content, stream=False, session_id=None, headers=None):
+    tried = set()
+    retry_after = None
+    # Nothing has been streamed to the client yet, so a failed or busy backend can be retried elsewhere.
+    while (backend := backend_pool.choose(session_id, exclude=tried)) is not None:
+        tried.add(backend)
+        backend.in_flight += 1
+        request = http_client.build_request("POST", f"{backend.url}/{endpoint}", content=content, headers=headers)
+        started_at = time.monotonic()
+        try:
+            response = await http_client.send(request, stream=stream)
+            UPSTREAM_LATENCY.labels(backend=backend.url).observe(time.monotonic() - started_at)
+        except httpx.HTTPError as e:
+            backend.in_flight -= 1
+            backend_pool.record_failure(backend)
+            logger.error(f"Error calling model server {backend.url}: {str(e)}")
+            continue
+        except asyncio.CancelledError:
+            backend.in_flight -= 1
+            raise
+        if response.is_client_error:
+            # The request itself was refused (unknown model, rate limit, ...); another backend would do the same.
+            backend.in_flight -= 1
+            await response.aread()
+            await response.aclose()
+            backend_pool.record_success(backend)
+            try:
+                detail = response.json().get("detail")
+            except ValueError:
+                detail = response.text
+            raise HTTPException(status_code=response.status_code, detail=detail,
+                                headers={name: value for name, value in response.headers.items()
+                                         if name in FORWARDED_ERROR_HEADERS})
+        if response.is_error:
+            backend.in_flight -= 1
+            await response.aclose()
+            logger.error(f"Error calling model server {backend.url}: {response.status_code}")
+            if response.status_code == 503:
+                retry_after = response.headers.get("Retry-After", "1")
+            else:
+                backend_pool.record_failure(backend)
+            continue
+        backend_pool.record_success(backend)
+        if not stream:
+            backend.in_flight -= 1
+        return response, backend
+    if retry_after is not None:
+        # Pass back-pressure from the model servers through to the client.
+        raise HTTPException(status_code=503, detail="Model server is busy", headers={"Retry-After": retry_after})
+    raise HTTPException(status_code=500, detail="Error calling model server")
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
 
 @app.post("/generate_stream")
 async def generate_stream(request: Request):
+    tenant, reserved = None, 0
+    settled = False
     try:
-        body = await request.json()
-        payload = {
-            "dialogue_history": body.get("dialogue_history", []),
-            "max_length": body.get("max_length", 50),
-            "temperature": body.get("temperature", 1.0),
-            "generation_kwargs": body.get("generation_kwargs", {})
-        }
-        response = call_model_server("generate_stream", payload, stream=True)
-        return StreamingResponse(response.iter_content(chunk_size=1024), media_type="text/plain")
+        raw = await request.body()
+        body = routing_fields(request, raw)
+        tenant, reserved = admit_tenant(request, body)
+        content, upstream = upstream_request(request, raw)
+        response, backend = await call_model_server("generate_stream", content, stream=True,
+                                                     session_id=get_session_id(request, body), headers=upstream)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                   "X-Request-ID": response.headers.get("X-Request-ID", upstream["X-Request-ID"])}
+        if tenant is not None:
+            headers.update(tenant.headers())
+        # Events are forwarded byte-for-byte in the format the model server negotiated. If the client
+        # disconnects, closing the upstream connection makes the model server cancel generation.
+        close = stream_closer(response, backend)
+        stream = forward_stream(response, close, tenant, reserved)
+        settled = True
+        return StreamingResponse(stream, media_type=response.headers.get("content-type", "text/plain"),
+                                 headers=headers, background=BackgroundTask(close))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in generate_stream: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        # forward_stream settles streams that start; anything that fails before is refunded.
+        if not settled:
+            refund(tenant, reserved)
 
 @app.post("/generate")
 async def generate(request: Request):
+    started_at = time.monotonic()
+    tenant, reserved = None, 0
+    settled = False
     try:
-        body = await request.json()
-        payload = {
-            "dialogue_history": body.get("dialogue_history", []),
-            "max_length": body.get("max_length", 50),
-            "temperature": body.get("temperature", 1.0),
-            "generation_kwargs": body.get("generation_kwargs", {})
-        }
-        response = call_model_server("generate", payload)
-        return JSONResponse(content=response.json())
+        raw = await request.body()
+        body = routing_fields(request, raw)
+        tenant, reserved = admit_tenant(request, body)
+        content, upstream = upstream_request(request, raw)
+        response, _ = await cancel_on_disconnect(
+            request, call_model_server("generate", content, session_id=get_session_id(request, body),
+                                       headers=upstream))
+        headers = {"X-Request-ID": response.headers.get("X-Request-ID", upstream["X-Request-ID"])}
+        if tenant is not None:
+            usage = json.loads(response.content).get("usage", {})
+            tenant.settle(reserved, usage.get("total_tokens", reserved))
+            headers.update(tenant.headers())
+        settled = True
+        if TIMING_HEADERS:
+            timing = server_timing({"gateway": time.monotonic() - started_at})
+            upstream_timing = response.headers.get("Server-Timing")
+            headers["Server-Timing"] = f"{upstream_timing}, {timing}" if upstream_timing else timing
+        # Passed through as the model server sent it (after httpx undoes any compression).
+        return Response(content=response.content, media_type="application/json", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in generate: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        # Refused, failed and abandoned requests give their reservation back.
+        if not settled:
+            refund(tenant, reserved)
+
+@app.post("/cancel")
+async def cancel(request: CancelRequest):
+    # The gateway does not track which backend serves a request, so ask all of them.
+    async def cancel_on(backend):
+        try:
+            response = await http_client.post(f"{backend.url}/cancel", json={"request_id": request.request_id})
+            return response.status_code == 200
+        except httpx.HTTPError as e:
+            logger.error(f"Error cancelling on model server {backend.url}: {str(e)}")
+            return False
+
+    results = await asyncio.gather(*(cancel_on(backend) for backend in backend_pool.backends))
+    if not any(results):
+        raise HTTPException(status_code=404, detail="Unknown or finished request")
+    return {"request_id": request.request_id, "cancelled": True}
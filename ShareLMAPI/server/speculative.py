@@ -0,0 +1,154 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.metrics import Counter, Histogram
+from ShareLMAPI.server.scheduler import warp_logits, _to_legacy_cache
+import torch
+
+DRAFT_TOKENS = Counter("sharelmapi_speculative_draft_tokens_total", "Tokens proposed by the draft model")
+ACCEPTED_TOKENS = Counter("sharelmapi_speculative_accepted_tokens_total",
+                          "Draft tokens the model accepted during verification")
+TOKENS_PER_STEP = Histogram("sharelmapi_speculative_tokens_per_step",
+                            "Tokens generated by each verification pass of the model",
+                            buckets=(1, 2, 3, 4, 5, 6, 8, 12, 16))
+
+def speculative_sample(target_probs, draft_probs, draft_tokens, generator=None):
+    # Speculative sampling: draft token i is kept with probability min(1, p_i / q_i). The first rejected
+    # position is resampled from max(0, p - q), and if every draft token is kept one more token comes from
+    # the model's last distribution. The output follows the model's distribution exactly. Returns the
+    # accepted draft tokens followed by one token from the model.
+    for i, token in enumerate(draft_tokens):
+        p = target_probs[i]
+        q = draft_probs[i]
+        if float(torch.rand((), generator=generator, device=p.device)) * q[token] < p[token]:
+            continue
+        residual = (p - q).clamp(min=0)
+        if residual.sum() <= 0:
+            residual = p
+        return draft_tokens[:i] + [int(torch.multinomial(residual / residual.sum(), 1, generator=generator))]
+    return draft_tokens + [int(torch.multinomial(target_probs[len(draft_tokens)], 1, generator=generator))]
+
+def _match_vocab(logits, vocab_size):
+    # Embedding matrices are often padded past the tokenizer, so the two models' logits can differ in width.
+    if logits.shape[-1] >= vocab_size:
+        return logits[..., :vocab_size]
+    return torch.cat([logits, logits.new_full(logits.shape[:-1] + (vocab_size - logits.shape[-1],), float("-inf"))], -1)
+
+def _crop(past_key_values, length):
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values)
+
+# Proposes tokens with a small draft model for the batch scheduler to verify in one forward pass of the
+# model. Used while a single sequence is decoding, where each step is bound by latency rather than compute.
+# The draft model keeps its own KV cache for that sequence.
+class SpeculativeDecoder:
+    def __init__(self, draft_model, num_speculative_tokens=4):
+        self.draft_model = draft_model
+        self.num_speculative_tokens = max(1, num_speculative_tokens)
+        config = draft_model.config
+        self.max_positions = getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None)
+        self.steps = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.reset()
+
+    def reset(self):
+        self._sequence = None
+        self._past = None
+        self._length = 0
+
+    def lookahead(self, sequence, max_positions=None):
+        # Draft tokens worth proposing for `sequence`; 0 means a plain decode step.
+        context = len(sequence.input_ids) + len(sequence.output_ids)
+        k = min(self.num_speculative_tokens, sequence.params.max_new_tokens - len(sequence.output_ids) - 1)
+        for limit in (max_positions, self.max_positions):
+            if limit:
+                k = min(k, limit - context - 1)
+        return max(k, 0)
+
+    def propose(self, sequence, k, vocab_size):
+        # Returns k draft tokens and, when sampling, the distributions they were drawn from.
+        if self._sequence is not sequence:
+            self.reset()
+            self._sequence = sequence
+        device = self.draft_model.device
+        # Everything the draft model has not seen yet: the whole context on the first step, then the
+        # tokens accepted or resampled by the last verification.
+        new_ids = (sequence.input_ids + sequence.output_ids)[self._length:]
+        tokens = []
+        probs = []
+        for _ in range(k):
+            length = self._length + len(new_ids)
+            outputs = self.draft_model(
+                input_ids=torch.tensor([new_ids], dtype=torch.long, device=device),
+                attention_mask=torch.ones((1, length), dtype=torch.long, device=device),
+                position_ids=torch.arange(self._length, length, dtype=torch.long, device=device).unsqueeze(0),
+                past_key_values=self._past,
+                use_cache=True
+            )
+            self._past = _to_legacy_cache(outputs.past_key_values)
+            self._length = length
+            logits = _match_vocab(outputs.logits[0, -1].float(), vocab_size)
+            if sequence.params.do_sample:
+                q = warp_logits(logits, sequence.params).softmax(-1)
+                token = int(torch.multinomial(q, 1, generator=sequence._generator(q.device)))
+                probs.append(q)
+            else:
+                token = int(logits.argmax())
+            tokens.append(token)
+            new_ids = [token]
+        return tokens, probs
+
+    def verify(self, sequence, logits, draft_tokens, draft_probs):
+        # `logits` are the model's logits for the last context token and each draft token.
+        logits = logits.float()
+        if sequence.params.do_sample:
+            target_probs = torch.stack([warp_logits(row, sequence.params) for row in logits]).softmax(-1)
+            draft_probs = [q.to(target_probs.device) for q in draft_probs]
+            tokens = speculative_sample(target_probs, draft_probs, draft_tokens, sequence._generator(logits.device))
+        else:
+            # Greedy decoding keeps draft tokens while they match the model's own argmax.
+            targets = logits.argmax(-1).tolist()
+            accepted = 0
+            while accepted < len(draft_tokens) and draft_tokens[accepted] == targets[accepted]:
+                accepted += 1
+            tokens = draft_tokens[:accepted] + [targets[accepted]]
+        self.steps += 1
+        self.draft_tokens += len(draft_tokens)
+        self.accepted_tokens += len(tokens) - 1
+        DRAFT_TOKENS.inc(len(draft_tokens))
+        ACCEPTED_TOKENS.inc(len(tokens) - 1)
+        TOKENS_PER_STEP.observe(len(tokens))
+        return tokens
+
+    def rewind(self, length):
+        # Drops draft KV past the first `length` tokens, i.e. the rejected proposals.
+        if self._past is not None and self._length > length:
+            self._past = _crop(self._past, length)
+            self._length = length
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.accepted_tokens / self.draft_tokens if self.draft_tokens else None,
+            "tokens_per_step": (self.accepted_tokens + self.steps) / self.steps if self.steps else None
+        }
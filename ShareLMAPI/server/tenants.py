@@ -0,0 +1,162 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from ShareLMAPI.server.metrics import Counter
+import math
+import threading
+import time
+
+RATE_LIMITED_REQUESTS = Counter("sharelmapi_rate_limited_requests_total", "Requests rejected by a tenant's token rate limit",
+                                ("tenant",))
+TENANT_TOKENS = Counter("sharelmapi_tenant_tokens_total", "Prompt and completion tokens charged to each tenant",
+                        ("tenant",))
+
+# Rough prompt size before tokenization; the real usage is settled once the request finishes.
+CHARS_PER_TOKEN = 4
+
+class UnknownTenantError(Exception):
+    pass
+
+class RateLimitError(Exception):
+    def __init__(self, tenant, retry_after):
+        super().__init__(f"Token rate limit exceeded for tenant {tenant.name}")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, tokens_per_minute, burst_tokens=None):
+        self.tokens_per_minute = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = burst_tokens or tokens_per_minute
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        # Returns 0 when admitted, otherwise the seconds until `amount` tokens will be available. Requests larger
+        # than the whole bucket are admitted once it is full, so they are slow rather than impossible.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            needed = min(amount, self.capacity)
+            if self.tokens < needed:
+                return (needed - self.tokens) / self.rate
+            self.tokens -= amount
+            return 0
+
+    def settle(self, reserved, used):
+        # The balance may go negative when a request used more than it reserved; later requests wait for it.
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + reserved - used)
+
+    def headers(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            remaining = max(0, int(self.tokens))
+            reset = (self.capacity - self.tokens) / self.rate
+        return {"X-RateLimit-Limit-Tokens": str(self.tokens_per_minute),
+                "X-RateLimit-Remaining-Tokens": str(remaining),
+                "X-RateLimit-Reset-Tokens": f"{math.ceil(reset)}s"}
+
+class Tenant:
+    def __init__(self, name, weight=1.0, priority=None, tokens_per_minute=0, burst_tokens=None):
+        self.name = name
+        # Share of the batch under contention, relative to other tenants.
+        self.weight = max(float(weight), 1e-6)
+        # "bulk" forces every request from this tenant into the bulk lane.
+        self.priority = priority
+        self.bucket = TokenBucket(tokens_per_minute, burst_tokens) if tokens_per_minute else None
+
+    def apply_priority(self, priority):
+        return "bulk" if self.priority == "bulk" else priority
+
+    def reserve(self, tokens):
+        if self.bucket is None:
+            return
+        retry_after = self.bucket.reserve(tokens)
+        if retry_after:
+            RATE_LIMITED_REQUESTS.labels(tenant=self.name).inc()
+            raise RateLimitError(self, retry_after)
+
+    def settle(self, reserved, used):
+        TENANT_TOKENS.labels(tenant=self.name).inc(used)
+        if self.bucket is not None:
+            self.bucket.settle(reserved, used)
+
+    def headers(self):
+        return self.bucket.headers() if self.bucket is not None else {}
+
+def estimate_tokens(body):
+    # Upper bound on what a request can cost: its prompt plus every token it may generate.
+    if body.get("input_ids"):
+        prompt_tokens = len(body["input_ids"])
+    else:
+        characters = sum(len(message.get("content", "")) for message in body.get("dialogue_history") or [])
+        prompt_tokens = math.ceil(characters / CHARS_PER_TOKEN)
+    generation_kwargs = body.get("generation_kwargs") or {}
+    return prompt_tokens + generation_kwargs.get("max_new_tokens", body.get("max_length", 50))
+
+def request_api_key(headers):
+    # API key from X-API-Key or "Authorization: Bearer <key>".
+    api_key = headers.get("x-api-key")
+    authorization = headers.get("authorization", "")
+    if api_key is None and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    return api_key
+
+class TenantPolicy:
+    def __init__(self, config):
+        tenants_config = config.get("tenants", {})
+        self.enabled = tenants_config.get("enabled", False)
+        self.api_keys = tenants_config.get("api_keys", {})
+        self.anonymous_tenant = tenants_config.get("anonymous_tenant")
+        self.default_limits = tenants_config.get("default_limits", {})
+        self.limits = tenants_config.get("limits", {})
+        self._tenants = {}
+
+    def tenant(self, name):
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            tenant = self._tenants[name] = Tenant(name, **{**self.default_limits, **self.limits.get(name, {})})
+        return tenant
+
+    def weight(self, name):
+        if not self.enabled or name is None:
+            return 1.0
+        return self.tenant(name).weight
+
+    def identify(self, headers):
+        # None when tenants are disabled.
+        if not self.enabled:
+            return None
+        api_key = request_api_key(headers)
+        if api_key is None:
+            if self.anonymous_tenant is None:
+                raise UnknownTenantError("Missing API key")
+            return self.tenant(self.anonymous_tenant)
+        name = self.api_keys.get(api_key)
+        if name is None:
+            raise UnknownTenantError("Invalid API key")
+        return self.tenant(name)
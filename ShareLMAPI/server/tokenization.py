@@ -0,0 +1,154 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+def _text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def _message_prefix_keys(messages):
+    # keys[k] identifies messages[:k]; computed incrementally so long conversations are hashed once.
+    digest = hashlib.blake2b(digest_size=16)
+    keys = [None]
+    for message in messages:
+        digest.update(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\0")
+        keys.append(digest.copy().digest())
+    return keys
+
+# Applies the chat template off the event loop and memoizes the token ids of conversation prefixes.
+#
+# The rendered prompt is tokenized in pieces, split where the text that follows starts with an added token
+# (<|im_start|>, <s>, <|start_header_id|>, ...). Tokenizers split on added tokens before anything else, so
+# pieces split there tokenize exactly as the whole prompt would. The system prompt and everything before
+# the last message are memoized, so a shared system prompt or an earlier turn of the same conversation is
+# only tokenized once.
+class TokenizationStage:
+    def __init__(self, tokenizer, max_workers=2, max_entries=1024, max_tokens=1_000_000):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="tokenize")
+        self._added_tokens = tuple(tokenizer.get_added_vocab())
+        # message prefix key -> (rendered length, rendered text hash, token ids)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    async def encode(self, messages):
+        # Returns the prompt token ids and the token length of a leading system prompt (or None).
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, messages)
+
+    def _encode(self, messages):
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        keys = _message_prefix_keys(messages)
+        token_ids, offset, start = self._lookup(text, keys)
+        system_length = None
+        if start and messages[0]["role"] == "system":
+            system_length = len(token_ids) if start == 1 else self._cached_length(keys[1], text)
+        for k in sorted({1, len(messages) - 1}):
+            if k <= start or k >= len(messages):
+                continue
+            try:
+                prefix = self.tokenizer.apply_chat_template(messages[:k], tokenize=False)
+            except Exception:
+                # Some templates reject conversations that do not end on a user turn.
+                continue
+            if len(prefix) <= offset or not text.startswith(prefix) or not self._splittable(text, len(prefix)):
+                continue
+            token_ids = token_ids + self._tokenize(text[offset:len(prefix)])
+            offset = len(prefix)
+            self._insert(keys[k], offset, _text_hash(prefix), token_ids)
+            if k == 1 and messages[0]["role"] == "system":
+                system_length = len(token_ids)
+        token_ids = token_ids + self._tokenize(text[offset:])
+        if system_length is None and len(messages) > 1 and messages[0]["role"] == "system":
+            system_length = self._system_length(messages[0], token_ids)
+        return token_ids, system_length
+
+    def _system_length(self, system, token_ids):
+        # Without an added token to split on, check whether the system prompt tokenizes to a prefix anyway.
+        try:
+            system_ids = self.tokenizer.apply_chat_template([system])
+        except Exception:
+            return None
+        return len(system_ids) if token_ids[:len(system_ids)] == system_ids else None
+
+    def _tokenize(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False) if text else []
+
+    def _splittable(self, text, offset):
+        return offset == len(text) or text.startswith(self._added_tokens, offset)
+
+    def _lookup(self, text, keys):
+        with self._lock:
+            for k in range(len(keys) - 2, 0, -1):
+                entry = self._entries.get(keys[k])
+                if entry is None:
+                    continue
+                length, text_hash, token_ids = entry
+                # The template may render a prefix differently once more messages follow it.
+                if _text_hash(text[:length]) != text_hash or not self._splittable(text, length):
+                    continue
+                self._entries.move_to_end(keys[k])
+                self.hits += 1
+                self.reused_tokens += len(token_ids)
+                return list(token_ids), length, k
+            self.misses += 1
+            return [], 0, 0
+
+    def _cached_length(self, key, text):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or _text_hash(text[:entry[0]]) != entry[1]:
+            return None
+        return len(entry[2])
+
+    def _insert(self, key, length, text_hash, token_ids):
+        if len(token_ids) > self.max_tokens:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (length, text_hash, tuple(token_ids))
+            self.tokens += len(token_ids)
+            while len(self._entries) > self.max_entries or self.tokens > self.max_tokens:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.tokens -= len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "tokens": self.tokens, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "reused_tokens": self.reused_tokens}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from starlette.datastructures import Headers, MutableHeaders
+import gzip
+import zlib
+
+# Request and response bodies between the gateway and the model servers. Conversations are mostly
+# repetitive text, so gzip at a low level shrinks them severalfold for little CPU.
+DEFAULT_MIN_BYTES = 4096
+DEFAULT_LEVEL = 1
+
+def compress_body(body, enabled=False, min_bytes=DEFAULT_MIN_BYTES, level=DEFAULT_LEVEL):
+    # Returns the body to send and the headers that describe it.
+    if not enabled or len(body) < min_bytes:
+        return body, {}
+    return gzip.compress(body, compresslevel=level), {"Content-Encoding": "gzip"}
+
+class CompressionMiddleware:
+    # Plain ASGI middleware: gzip request bodies are inflated as they arrive, and complete responses are
+    # gzipped for callers that accept it. Streamed responses pass through untouched, since a compressor
+    # would hold tokens back until it had enough to emit.
+    def __init__(self, app, enabled=False, min_bytes=DEFAULT_MIN_BYTES, level=DEFAULT_LEVEL,
+                 max_body_bytes=64 * 1024 * 1024):
+        self.app = app
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.level = level
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if headers.get("content-encoding") == "gzip":
+            scope = {**scope, "headers": [(name, value) for name, value in scope["headers"]
+                                          if name not in (b"content-encoding", b"content-length")]}
+            receive = self._inflate(receive)
+        if self.enabled and "gzip" in headers.get("accept-encoding", ""):
+            send = self._deflate(send)
+        await self.app(scope, receive, send)
+
+    def _inflate(self, receive):
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        received = 0
+
+        async def receive_inflated():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                body = decompressor.decompress(message.get("body", b""), self.max_body_bytes - received + 1)
+                if not message.get("more_body", False):
+                    body += decompressor.flush()
+                received += len(body)
+                # FastAPI answers 400 when reading the body fails.
+                if received > self.max_body_bytes or decompressor.unconsumed_tail:
+                    raise ValueError("Decompressed request body is too large")
+                message = {**message, "body": body}
+            return message
+        return receive_inflated
+
+    def _deflate(self, send):
+        start = None
+
+        async def send_deflated(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held until the first body message shows whether the response is streamed.
+                start = message
+                return
+            if start is not None and message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                headers = MutableHeaders(raw=start["headers"])
+                if not message.get("more_body", False) and len(body) >= self.min_bytes \
+                        and "content-encoding" not in headers:
+                    body = gzip.compress(body, compresslevel=self.level)
+                    headers["Content-Encoding"] = "gzip"
+                    headers["Content-Length"] = str(len(body))
+                    headers.add_vary_header("Accept-Encoding")
+                    message = {**message, "body": body}
+                await send(start)
+                start = None
+            await send(message)
+        return send_deflated
@@ -22,6 +22,7 @@ setup(
         "transformers",
         "pytest",
         "requests",
+        "httpx",
         "peft",
         "bitsandbytes", 
         "pydantic"
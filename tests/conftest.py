@@ -0,0 +1,47 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# conftest.py
+import importlib
+import os
+
+import pytest
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "configs", "benchmark_model_config.yaml")
+
+@pytest.fixture(scope="session")
+def model_server_app():
+    # Serve the fake model so end-to-end tests run on CPU without downloads
+    config = importlib.import_module("ShareLMAPI.server.config")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(config, "DEFAULT_CONFIG_PATH", CONFIG_PATH)
+        model_server = importlib.import_module("ShareLMAPI.server.model_server")
+    return model_server.app
+
+@pytest.fixture(scope="session")
+def gateway_module():
+    # The gateway module reads its config at import time, from load_config's default path
+    config = importlib.import_module("ShareLMAPI.server.config")
+    load_config = config.load_config
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(config, "load_config", lambda config_path=CONFIG_PATH: load_config(config_path))
+        return importlib.import_module("ShareLMAPI.server.server")
@@ -0,0 +1,104 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_adapters.py
+import asyncio
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+
+from ShareLMAPI.server.engine import InferenceEngine
+from ShareLMAPI.server.fake_model import build_fake_model, build_fake_tokenizer
+from ShareLMAPI.server.ipc import AdapterNotFoundError
+from ShareLMAPI.server.schemas import GenerateRequest
+
+@pytest.fixture(scope="module")
+def adapter_paths(tmp_path_factory):
+    # Random (not zero-initialised) LoRA weights so every adapter changes the output
+    directory = tmp_path_factory.mktemp("adapters")
+    tokenizer = build_fake_tokenizer()
+    paths = {}
+    for seed, name in enumerate(["support", "legal", "sql"], start=1):
+        torch.manual_seed(seed)
+        model = get_peft_model(build_fake_model(tokenizer, max_positions=256),
+                               LoraConfig(r=4, target_modules=["c_attn"], init_lora_weights=False))
+        model.save_pretrained(str(directory / name))
+        paths[name] = str(directory / name)
+    return paths
+
+def engine_config(adapter_paths, max_batch_size=8):
+    return {
+        "model": {"name": "fake", "loading_method": "fake", "fake": {"max_positions": 256},
+                  "adapters": {"paths": adapter_paths, "max_loaded": 2}},
+        "scheduler": {"max_batch_size": max_batch_size, "max_wait_ms": 50},
+        "prefix_cache": {"min_prefix_tokens": 4}
+    }
+
+def request(adapter=None):
+    # The system prompt is cached as its own prefix, so later requests look it up
+    return GenerateRequest(dialogue_history=[{"role": "system", "content": "You are a helpful assistant."},
+                                             {"role": "user", "content": "hello there"}], adapter=adapter,
+                           max_length=8, temperature=0.0)
+
+def generate_all(engine, adapters):
+    async def run():
+        try:
+            results = await asyncio.gather(*(engine.generate(request(adapter)) for adapter in adapters))
+            return [result["generated_text"] for result in results], engine.snapshot()
+        finally:
+            await engine.aclose()
+    return asyncio.run(run())
+
+def test_mixed_adapter_batch_matches_separate_runs(adapter_paths):
+    """Requests for different adapters share a batch and each gets its own adapter's output"""
+    alone = {}
+    for adapter in [None, "support", "legal"]:
+        texts, _ = generate_all(InferenceEngine(config=engine_config(adapter_paths, max_batch_size=1)), [adapter])
+        alone[adapter] = texts[0]
+    assert len(set(alone.values())) == 3
+
+    texts, stats = generate_all(InferenceEngine(config=engine_config(adapter_paths)), [None, "support", "legal"])
+    assert texts == [alone[None], alone["support"], alone["legal"]]
+    assert set(stats["adapters"]["loaded"]) == {"support", "legal"}
+
+def test_least_recently_used_adapter_is_evicted(adapter_paths):
+    """Only max_loaded adapters stay attached and unknown adapters are rejected"""
+    engine = InferenceEngine(config=engine_config(adapter_paths))
+
+    async def run():
+        try:
+            texts = [(await engine.generate(request(adapter)))["generated_text"]
+                     for adapter in ["support", "legal", "support", "sql"]]
+            with pytest.raises(AdapterNotFoundError):
+                await engine.generate(request("missing"))
+            return texts, engine.snapshot()
+        finally:
+            await engine.aclose()
+
+    texts, snapshot = asyncio.run(run())
+    assert texts[0] == texts[2] != texts[1]
+    # The system prompt's KV is only reused under the adapter that computed it
+    assert snapshot["prefix_cache"]["hits"] == 1
+    stats = snapshot["adapters"]
+    assert stats["loaded"] == {"support": 0, "sql": 0}
+    assert stats["loads"] == 3 and stats["evictions"] == 1
@@ -0,0 +1,91 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_backends.py
+import asyncio
+
+import httpx
+import pytest
+from ShareLMAPI.server.backends import BackendPool
+
+@pytest.fixture
+def pool():
+    return BackendPool(["http://a:5000", "http://b:5000", "http://c:5000"], failure_threshold=2, ejection_time=60)
+
+def test_least_outstanding_requests(pool):
+    """Requests go to the backend with the fewest outstanding requests"""
+    a, b, c = pool.backends
+    a.in_flight, b.in_flight, c.in_flight = 3, 1, 2
+    assert pool.choose() is b
+    b.queue_depth = 5
+    assert pool.choose() is c
+
+def test_failing_backend_is_ejected(pool):
+    """Consecutive failures eject a backend until it is re-admitted"""
+    a, b, c = pool.backends
+    b.in_flight = c.in_flight = 1
+    pool.record_failure(a)
+    assert pool.choose() is a
+    pool.record_failure(a)
+    assert pool.choose() is not a
+    a.ejected_until = 0
+    assert pool.choose() is a
+
+def test_session_affinity(pool):
+    """A session keeps its backend while it is available and moves when it is ejected"""
+    first = pool.choose("session-1")
+    assert all(pool.choose("session-1") is first for _ in range(5))
+    first.healthy = False
+    assert pool.choose("session-1") is not first
+
+class FailingStream(httpx.AsyncByteStream):
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        yield b'{"type": "token", "text": "hi"}\n'
+        raise httpx.ReadError("connection reset")
+
+    async def aclose(self):
+        self.closed = True
+
+def test_stream_failing_midway_frees_its_backend(gateway_module, monkeypatch):
+    """An upstream stream that breaks partway is closed and stops counting against its backend"""
+    gateway = gateway_module
+    upstream_stream = FailingStream()
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "application/x-ndjson"}, stream=upstream_stream)
+
+    async def run():
+        upstream = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(gateway, "http_client", upstream)
+        transport = httpx.ASGITransport(app=gateway.app, raise_app_exceptions=False)
+        async with upstream, httpx.AsyncClient(transport=transport, base_url="http://gateway") as client:
+            try:
+                await client.post("/generate_stream", json={"dialogue_history": [{"role": "user", "content": "hi"}]})
+            except httpx.HTTPError:
+                pass
+
+    asyncio.run(run())
+    assert [backend.in_flight for backend in gateway.backend_pool.backends] == [0] * len(gateway.backend_pool.backends)
+    assert upstream_stream.closed
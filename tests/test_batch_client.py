@@ -0,0 +1,109 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_batch_client.py
+import asyncio
+import random
+import time
+
+import httpx
+
+from ShareLMAPI.client import ShareLMClient, AsyncShareLMClient
+
+PROMPTS = [f"prompt {i}" for i in range(20)]
+
+def test_map_keeps_order_and_bounds_concurrency():
+    """map yields results in input order, or as completed with their index, never exceeding the concurrency"""
+    client = ShareLMClient("http://unused")
+    active = []
+    peak = []
+
+    def fake_generate_text(prompt=None, **kwargs):
+        active.append(prompt)
+        peak.append(len(active))
+        time.sleep(random.random() / 100)
+        active.remove(prompt)
+        return prompt.upper()
+
+    client.generate_text = fake_generate_text
+    assert client.generate_batch(PROMPTS, concurrency=4) == [prompt.upper() for prompt in PROMPTS]
+    assert max(peak) <= 4
+    unordered = list(client.map(iter(PROMPTS), concurrency=4, ordered=False))
+    assert sorted(unordered) == [(i, prompt.upper()) for i, prompt in enumerate(PROMPTS)]
+
+def test_async_client_against_fake_model(model_server_app):
+    """The async client batches real requests and streams NDJSON events"""
+    async def run():
+        async with AsyncShareLMClient("http://model-server", transport=httpx.ASGITransport(app=model_server_app)) as client:
+            texts = await client.generate_batch(PROMPTS[:6], concurrency=3, max_length=4, temperature=0.0)
+            chunks = [chunk async for chunk in await client.generate_text("hello", max_length=4, streamer=True)]
+            return texts, chunks, client.last_stream_info
+
+    texts, chunks, info = asyncio.run(run())
+    assert len(texts) == 6 and all(isinstance(text, str) for text in texts)
+    assert info["type"] == "done" and 0 < info["usage"]["completion_tokens"] <= 4
+
+def test_async_client_retries_busy_server():
+    """503 responses are retried after Retry-After, other errors are not"""
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        if len(calls) < 3:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        if request.url.path == "/cancel":
+            return httpx.Response(404)
+        return httpx.Response(200, json={"generated_text": "ok"}, headers={"X-Request-ID": "abc"})
+
+    async def run():
+        async with AsyncShareLMClient("http://model-server", transport=httpx.MockTransport(handler)) as client:
+            text = await client.generate_text("hello")
+            return text, client.last_request_id, await client.cancel()
+
+    assert asyncio.run(run()) == ("ok", "abc", False)
+    assert calls == ["/generate"] * 3 + ["/cancel"]
+
+def test_async_map_waits_for_cancelled_requests():
+    """Leaving map early cancels the outstanding requests and waits until they have stopped"""
+    started = []
+    stopped = []
+
+    async def fake_generate_text(prompt=None, **kwargs):
+        started.append(prompt)
+        try:
+            await asyncio.sleep(0 if prompt == PROMPTS[0] else 10)
+            return prompt.upper()
+        finally:
+            stopped.append(prompt)
+
+    async def run():
+        client = AsyncShareLMClient("http://unused")
+        client.generate_text = fake_generate_text
+        results = client.map(PROMPTS, concurrency=4)
+        first = await results.__anext__()
+        await results.aclose()
+        await client.aclose()
+        return first, list(started), list(stopped)
+
+    first, started_by_close, stopped_by_close = asyncio.run(run())
+    assert first == PROMPTS[0].upper()
+    assert len(started_by_close) > 1 and sorted(stopped_by_close) == sorted(started_by_close)
@@ -0,0 +1,58 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_benchmark.py
+import asyncio
+
+import httpx
+import pytest
+
+from ShareLMAPI import benchmark
+
+def test_percentiles_and_summary():
+    """Percentiles use the nearest-rank method and failed requests count towards the error rate"""
+    records = [{"ok": True, "ttft": i / 100, "latency": i / 10, "output_tokens": 10} for i in range(1, 101)]
+    records.append({"ok": False, "status": 503, "error": "HTTP 503"})
+    summary = benchmark.summarize(records, duration=10.0)
+    assert summary["latency_s"]["p50"] == pytest.approx(5.0)
+    assert summary["latency_s"]["p99"] == pytest.approx(9.9)
+    assert summary["error_rate"] == pytest.approx(1 / 101)
+    assert summary["errors"] == {"503": 1}
+    assert summary["tokens_per_s"] == pytest.approx(100.0)
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_benchmark_against_fake_model(model_server_app, stream):
+    """The harness drives the model server end to end and reports latency percentiles"""
+    result = asyncio.run(benchmark.run_benchmark(
+        "http://model-server",
+        num_requests=6,
+        concurrency=3,
+        prompt_words=(4, 16),
+        output_tokens=(4, 8),
+        stream=stream,
+        metrics_url="/metrics",
+        transport=httpx.ASGITransport(app=model_server_app)
+    ))
+    summary = result["summary"]
+    assert summary["succeeded"] == 6
+    assert summary["generated_tokens"] > 0
+    assert summary["latency_s"]["p50"] is not None
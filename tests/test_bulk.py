@@ -0,0 +1,109 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_bulk.py
+import asyncio
+import json
+
+import pytest
+
+from ShareLMAPI.server.bulk import BulkJob, read_checkpoint
+
+class Crash(BaseException):
+    pass
+
+def write_input(path, count):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({"dialogue_history": [{"role": "user", "content": "x" * ((i * 7) % 13 + 1)}]}) + "\n")
+        f.write("not json\n")
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_bulk_job_buckets_by_length_and_writes_every_line(tmp_path):
+    """Each window is sent shortest prompt first and every input line gets exactly one result"""
+    write_input(tmp_path / "in.jsonl", 10)
+    lengths = []
+
+    async def generate(record):
+        lengths.append(len(record["dialogue_history"][0]["content"]))
+        return {"generated_text": "ok"}
+
+    state = asyncio.run(BulkJob(generate, tmp_path / "in.jsonl", str(tmp_path / "out.jsonl"), window_size=5,
+                                concurrency=1).run())
+    assert lengths[:5] == sorted(lengths[:5]) and lengths[5:] == sorted(lengths[5:])
+    results = read_output(tmp_path / "out.jsonl")
+    assert sorted(result["line"] for result in results) == list(range(11))
+    assert state == read_checkpoint(str(tmp_path / "out.jsonl"))
+    assert state["done"] and state["completed"] == 10 and state["errors"] == 1
+
+def test_bulk_job_resumes_after_crash(tmp_path):
+    """A crashed job resumes from its checkpoint without repeating or losing lines"""
+    write_input(tmp_path / "in.jsonl", 12)
+    output = str(tmp_path / "out.jsonl")
+    calls = []
+
+    async def crashing(record):
+        calls.append(record)
+        if len(calls) == 7:
+            raise Crash()
+        return {"generated_text": "first run"}
+
+    with pytest.raises(Crash):
+        asyncio.run(BulkJob(crashing, tmp_path / "in.jsonl", output, window_size=4, concurrency=1).run())
+    assert read_checkpoint(output)["line"] == 4
+    with open(output, "a") as f:
+        f.write('{"line": 9, "generat')
+
+    async def generate(record):
+        return {"generated_text": "second run"}
+
+    state = asyncio.run(BulkJob(generate, tmp_path / "in.jsonl", output, window_size=4, concurrency=1).run())
+    results = read_output(output)
+    assert sorted(result["line"] for result in results) == list(range(13))
+    assert sum(result.get("generated_text") == "first run" for result in results) >= 4
+    assert state["completed"] == 12 and state["errors"] == 1
+
+def test_bulk_job_reports_lines_that_are_not_objects(tmp_path):
+    """Valid JSON that is not a request object gets an error result, and a resumed job carries on past it"""
+    request = json.dumps({"dialogue_history": [{"role": "user", "content": "hi"}]})
+    (tmp_path / "in.jsonl").write_text("\n".join([request, '"just a string"', "[1, 2]", request, request]) + "\n")
+    output = str(tmp_path / "out.jsonl")
+    calls = []
+
+    async def crashing(record):
+        calls.append(record)
+        if len(calls) == 2:
+            raise Crash()
+        return {"generated_text": "ok"}
+
+    with pytest.raises(Crash):
+        asyncio.run(BulkJob(crashing, tmp_path / "in.jsonl", output, window_size=3, concurrency=1).run())
+    assert read_checkpoint(output)["line"] == 3
+
+    state = asyncio.run(BulkJob(crashing, tmp_path / "in.jsonl", output, window_size=3, concurrency=1).run())
+    results = {result["line"]: result for result in read_output(output)}
+    assert sorted(results) == list(range(5))
+    assert results[1]["error"] == results[2]["error"] == "Invalid request: expected a JSON object"
+    assert state["done"] and state["completed"] == 3 and state["errors"] == 2
@@ -0,0 +1,73 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# test_executor.py
+import asyncio
+import importlib
+import threading
+
+import httpx
+import pytest
+
+from ShareLMAPI.server.executor import InferenceExecutor, QueueFullError
+
+def test_executor_rejects_requests_past_its_queue():
+    """Work beyond the workers and the queue is refused with a retry hint, and admitted again once it drains"""
+    executor = InferenceExecutor(max_workers=1, max_queue_size=1, retry_after=3)
+    release = threading.Event()
+    try:
+        running = executor.submit(release.wait)
+        queued = executor.submit(release.wait)
+        assert executor.in_flight == 2 and executor.queue_depth == 1
+        with pytest.raises(QueueFullError) as error:
+            executor.submit(release.wait)
+        assert error.value.retry_after == 3
+        release.set()
+        running.result(timeout=5)
+        queued.result(timeout=5)
+        assert executor.submit(lambda: 1).result(timeout=5) == 1
+    finally:
+        release.set()
+        executor.shutdown()
+
+def test_full_queue_answers_503_with_retry_after(model_server_app, gateway_module, monkeypatch):
+    """The model server maps a full scheduler queue to 503 with Retry-After, and the gateway passes it on"""
+    model_server = importlib.import_module("ShareLMAPI.server.model_server")
+    body = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 4, "temperature": 0.0}
+
+    async def run():
+        upstream = httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app))
+        monkeypatch.setattr(gateway_module, "http_client", upstream)
+        async with upstream, \
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app), base_url="http://model-server") as client, \
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway_module.app), base_url="http://gateway") as gateway:
+            assert (await client.post("/generate", json=body)).status_code == 200
+            # Leave no room in the scheduler's queue of the model that just loaded
+            registry = model_server.engine
+            scheduler = registry.entries[registry.default_model].engine.scheduler
+            monkeypatch.setattr(scheduler, "max_queue_size", 0)
+            monkeypatch.setattr(scheduler, "retry_after", 7)
+            return [await client.post("/generate", json=body), await client.post("/generate_stream", json=body),
+                    await gateway.post("/generate", json=body)]
+
+    for response in asyncio.run(run()):
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "7"
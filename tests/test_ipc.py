@@ -0,0 +1,85 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# test_ipc.py
+import asyncio
+
+import pytest
+import yaml
+
+from ShareLMAPI.server.engine import EngineServer
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.ipc import EngineClient, EngineError
+from ShareLMAPI.server.registry import ModelRegistry
+from ShareLMAPI.server.schemas import GenerateRequest
+
+def request(max_length=2, **fields):
+    return GenerateRequest(dialogue_history=[{"role": "user", "content": "hi"}], max_length=max_length,
+                           temperature=0.0, **fields)
+
+async def client_ready(client):
+    try:
+        await client.stats()
+    except OSError:
+        return False
+    return True
+
+def test_engine_client_round_trip(tmp_path):
+    """Generation, streaming, errors and cancellation all cross the Unix socket"""
+    # One sequence decodes and one waits, so a third is turned away
+    config = {"model": {"name": "fake", "loading_method": "fake", "fake": {"max_positions": 256}},
+              "scheduler": {"max_batch_size": 1, "max_queue_size": 1, "max_wait_ms": 0},
+              "memory": {"budget_mb": 256}, "warmup": {"enabled": False}}
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    socket_path = str(tmp_path / "engine.sock")
+    registry = ModelRegistry(str(config_path))
+
+    async def run():
+        server = asyncio.create_task(EngineServer(registry, socket_path).serve_forever())
+        client = EngineClient(socket_path)
+        try:
+            while not (await client_ready(client)):
+                await asyncio.sleep(0.05)
+            result = await client.generate(request())
+            events = [event async for event in await client.generate_stream(request())]
+            with pytest.raises(EngineError) as error:
+                await client.generate(request(model="missing"))
+
+            running = await client.generate_stream(request(max_length=200, request_id="running"))
+            first = await running.__anext__()
+            waiting = await client.generate_stream(request(max_length=200, request_id="waiting"))
+            with pytest.raises(QueueFullError):
+                await client.generate_stream(request())
+            cancelled = [await client.cancel("running"), await client.cancel("waiting")]
+            last = [[first, *[event async for event in running]][-1], [event async for event in waiting][-1]]
+            return result, events, error.value.status_code, cancelled, last
+        finally:
+            await client.aclose()
+            server.cancel()
+            await registry.aclose()
+
+    result, events, status_code, cancelled, last = asyncio.run(run())
+    assert result["usage"]["completion_tokens"] > 0
+    assert events[-1]["type"] == "done"
+    assert status_code == 404
+    assert all(cancelled)
+    assert [event["finish_reason"] for event in last] == ["cancelled", "cancelled"]
@@ -0,0 +1,159 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_memory.py
+import asyncio
+
+import pytest
+import yaml
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from ShareLMAPI.server.engine import InferenceEngine
+from ShareLMAPI.server.executor import QueueFullError
+from ShareLMAPI.server.ipc import EngineError
+from ShareLMAPI.server import memory
+from ShareLMAPI.server.memory import MemoryBudget, MemoryEstimator
+from ShareLMAPI.server.registry import ModelRegistry
+from ShareLMAPI.server.schemas import GenerateRequest
+
+FAKE_CONFIG = {"model": {"name": "fake", "loading_method": "fake",
+                         "fake": {"device": "cpu", "n_layer": 2, "n_head": 4, "n_embd": 64, "max_positions": 256}},
+               "memory": {"budget_mb": 1024, "max_wait": 5}}
+
+def test_estimate_grows_with_tokens_and_beams():
+    """KV memory is counted per token and per beam, and max_new_tokens inverts the estimate"""
+    estimator = MemoryEstimator(GPT2LMHeadModel(GPT2Config(n_layer=2, n_head=2, n_embd=32, vocab_size=128)))
+    assert estimator.kv_bytes_per_token == 2 * 2 * 32 * 4
+    assert estimator.rows({"num_beams": 4, "num_return_sequences": 2}) == 4
+    assert estimator.estimate(10, 20, rows=4) == 4 * estimator.estimate(10, 20)
+    budget = estimator.estimate(10, 20, rows=2) + 100
+    assert estimator.max_new_tokens(10, budget, rows=2) == 20
+
+def test_budget_queues_in_arrival_order():
+    """Requests wait for memory in arrival order and time out with a busy error"""
+    async def run():
+        budget = MemoryBudget(100, max_wait=0.2, max_waiting=2)
+        await budget.reserve(60)
+        large = asyncio.ensure_future(budget.reserve(80))
+        small = asyncio.ensure_future(budget.reserve(10))
+        await asyncio.sleep(0.01)
+        # The small request would fit, but does not overtake the large one.
+        assert not small.done() and budget.stats()["waiting"] == 2
+        with pytest.raises(QueueFullError):
+            await budget.reserve(1)
+        budget.release(60)
+        await asyncio.gather(large, small)
+        assert budget.reserved_bytes == 90
+        with pytest.raises(QueueFullError):
+            await budget.reserve(20)
+        budget.release(90)
+        return budget.stats()
+
+    stats = asyncio.run(run())
+    assert stats == {"budget_bytes": 100, "reserved_bytes": 0, "free_bytes": 100, "waiting": 0}
+
+def test_engine_caps_and_serialises_requests_over_budget():
+    """max_length is capped to the budget and context window, and requests that do not fit together take turns"""
+    async def run():
+        engine = InferenceEngine(config=FAKE_CONFIG)
+        try:
+            request = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 50,
+                       "temperature": 0.0}
+            prompt_length = len((await engine.tokenization.encode(request["dialogue_history"]))[0])
+            # Room for one request of 10 new tokens at a time.
+            engine.memory.budget_bytes = engine.memory_estimator.estimate(prompt_length, 10)
+            results = await asyncio.gather(*(engine.generate(GenerateRequest(**request)) for _ in range(3)))
+            reserved = engine.memory.reserved_bytes
+
+            engine.memory.budget_bytes = 1 << 30
+            capped = await engine.generate(GenerateRequest(input_ids=[1] * 250, max_length=50, temperature=0.0))
+            with pytest.raises(EngineError) as error:
+                await engine.generate(GenerateRequest(input_ids=[1] * 256, max_length=5))
+            return results, reserved, capped, error.value.status_code
+        finally:
+            await engine.aclose()
+
+    results, reserved, capped, status_code = asyncio.run(run())
+    assert all(result["usage"]["completion_tokens"] <= 10 for result in results)
+    assert reserved == 0
+    assert capped["usage"]["completion_tokens"] <= 6
+    assert status_code == 400
+
+def test_duplicate_request_ids_release_their_own_memory():
+    """Requests sharing a client-chosen id each release their reservation, and /cancel reaches all of them"""
+    async def run():
+        engine = InferenceEngine(config=FAKE_CONFIG)
+        try:
+            request = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 5,
+                       "temperature": 0.0, "request_id": "dup"}
+            await asyncio.gather(*(engine.generate(GenerateRequest(**request)) for _ in range(2)))
+            reserved = engine.memory.reserved_bytes
+
+            streams = [await engine.generate_stream(GenerateRequest(**{**request, "max_length": 200}))
+                       for _ in range(2)]
+            assert await engine.cancel("dup")
+            done = [[event async for event in stream][-1] for stream in streams]
+            return reserved, done, engine.memory.reserved_bytes, engine._requests
+        finally:
+            await engine.aclose()
+
+    reserved, done, reserved_after_cancel, requests = asyncio.run(run())
+    assert reserved == 0 and reserved_after_cancel == 0
+    assert [event["finish_reason"] for event in done] == ["cancelled", "cancelled"]
+    assert requests == {}
+
+def test_registry_models_share_one_budget(tmp_path, monkeypatch):
+    """Every model reserves against one budget, sized without the prefix caches of all models"""
+    monkeypatch.setattr(memory, "detect_budget", lambda model, fraction=0.9: 100 * 2**20)
+    models = {name: {**FAKE_CONFIG["model"], "name": name} for name in ("a", "b")}
+    config = {"models": models, "registry": {"default_model": "a", "preload": []},
+              "prefix_cache": {"max_memory_mb": 10}, "scheduler": {"max_wait_ms": 0}}
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.safe_dump(config))
+    registry = ModelRegistry(str(path))
+
+    async def run():
+        try:
+            for model in ("a", "b"):
+                await registry.generate(GenerateRequest(dialogue_history=[{"role": "user", "content": "hi"}],
+                                                        model=model, max_length=2, temperature=0.0))
+            engines = [registry.entries[name].engine for name in ("a", "b")]
+            return engines[0].memory, engines[1].memory, await registry.stats()
+        finally:
+            await registry.aclose()
+
+    first, second, stats = asyncio.run(run())
+    assert first is second is registry.memory
+    assert first.budget_bytes == (100 - 2 * 10) * 2**20
+    assert stats["memory"]["requests_free_mb"] == 80 and stats["memory"]["requests_reserved_mb"] == 0
+
+def test_detected_budget_counts_reclaimable_memory_and_must_fit_a_request(monkeypatch):
+    """CPU budgets use MemAvailable, and a detected budget too small for any request stops startup"""
+    available = memory.available_ram()
+    with open("/proc/meminfo") as f:
+        meminfo = dict(line.split(":", 1) for line in f)
+    assert available == int(meminfo["MemAvailable"].split()[0]) * 1024
+
+    config = {**FAKE_CONFIG, "memory": {}, "prefix_cache": {"max_memory_mb": 1}}
+    monkeypatch.setattr(memory, "available_ram", lambda: 2**20)
+    with pytest.raises(ValueError, match="budget_mb"):
+        InferenceEngine(config=config)
@@ -0,0 +1,92 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_registry.py
+import asyncio
+
+import pytest
+import yaml
+
+from ShareLMAPI.server.ipc import ModelNotFoundError
+from ShareLMAPI.server.registry import ModelRegistry
+from ShareLMAPI.server.schemas import GenerateRequest
+
+def fake_model(seed):
+    return {"name": f"fake-{seed}", "loading_method": "fake", "fake": {"max_positions": 256, "seed": seed}}
+
+@pytest.fixture
+def registry(tmp_path):
+    # Each fake model is about 0.65MB, so the budget holds two of them
+    config = {
+        "models": {"a": fake_model(0), "b": fake_model(1), "c": fake_model(2)},
+        "registry": {"default_model": "a", "preload": [], "max_memory_mb": 1.5},
+        "scheduler": {"max_wait_ms": 0},
+        "memory": {"budget_mb": 256}
+    }
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.safe_dump(config))
+    return ModelRegistry(str(path))
+
+def request(model=None, max_length=2):
+    return GenerateRequest(dialogue_history=[{"role": "user", "content": "hi"}], model=model, max_length=max_length,
+                           temperature=0.0)
+
+def test_models_load_lazily_and_least_recently_used_is_evicted(registry):
+    """Models load on first use and the least recently used idle model makes room for a new one"""
+    async def run():
+        try:
+            assert not any(info["loaded"] for info in (await registry.models())["models"].values())
+            await registry.generate(request())
+            await registry.generate(request("b"))
+            await registry.generate(request("a"))
+            await registry.generate(request("c"))
+            with pytest.raises(ModelNotFoundError):
+                await registry.generate(request("missing"))
+            return await registry.stats()
+        finally:
+            await registry.aclose()
+
+    stats = asyncio.run(run())
+    assert {name: info["loaded"] for name, info in stats["models"].items()} == {"a": True, "b": False, "c": True}
+    assert stats["memory"]["used_mb"] <= stats["memory"]["max_mb"]
+
+def test_reload_swaps_without_dropping_in_flight_requests(registry):
+    """A hot swap serves new requests from the new version while an open stream finishes on the old one"""
+    async def run():
+        try:
+            stream = await registry.generate_stream(request("a", max_length=40))
+            events = [await stream.__anext__()]
+            old_engine = registry.entries["a"].engine
+            info = await registry.reload("a", {"fake": {"max_positions": 256, "seed": 5}})
+            assert registry.entries["a"].engine is not old_engine and old_engine.leases == 1
+            await registry.generate(request("a"))
+            events += [event async for event in stream]
+            await asyncio.sleep(0)
+            return info, events, old_engine
+        finally:
+            await registry.aclose()
+
+    info, events, old_engine = asyncio.run(run())
+    assert info["version"] == 2
+    assert events[-1]["type"] == "done" and events[-1]["usage"]["completion_tokens"] > 0
+    # The drained engine was closed once its last request finished
+    assert old_engine.leases == 0 and not old_engine.scheduler._thread.is_alive()
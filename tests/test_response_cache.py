@@ -0,0 +1,68 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_response_cache.py
+import time
+from ShareLMAPI.server.response_cache import ResponseCache
+
+def test_lru_and_ttl():
+    """Entries are evicted least recently used first and expire after the TTL"""
+    cache = ResponseCache(max_entries=2, ttl=0.2)
+    cache.put("a", {"generated_text": "a"})
+    cache.put("b", {"generated_text": "b"})
+    assert cache.get("a") == {"generated_text": "a"}
+    cache.put("c", {"generated_text": "c"})
+    assert cache.get("b") is None
+    time.sleep(0.3)
+    assert cache.get("a") is None
+
+def test_disk_tier_survives_restart(tmp_path):
+    """Responses written to the on-disk tier are served by a new cache instance"""
+    path = str(tmp_path / "responses.sqlite")
+    key = ResponseCache.key("generate", "gpt-2:default", {"dialogue_history": [], "max_length": 5})
+    cache = ResponseCache(disk_path=path)
+    cache.put(key, {"generated_text": "cached"})
+    cache.close()
+
+    restarted = ResponseCache(disk_path=path)
+    assert restarted.get(key) == {"generated_text": "cached"}
+    restarted.close()
+
+def test_disk_tier_drops_least_recently_used_rows(tmp_path):
+    """The on-disk tier keeps at most max_disk_entries rows and deletes the least recently used first"""
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(max_entries=1, disk_path=path, max_disk_entries=2)
+    cache.put("a", {"generated_text": "a"})
+    cache.put("b", {"generated_text": "b"})
+    # Read back from disk, which makes "a" the most recently used row
+    assert cache.get("a") == {"generated_text": "a"}
+    cache.put("c", {"generated_text": "c"})
+    cache.close()
+
+    restarted = ResponseCache(disk_path=path, max_disk_entries=2)
+    assert restarted.get("b") is None
+    assert restarted.get("a") == {"generated_text": "a"} and restarted.get("c") == {"generated_text": "c"}
+    restarted.close()
+
+    trimmed = ResponseCache(disk_path=path, max_disk_entries=0, max_disk_mb=30 / 2**20)
+    assert trimmed.get("a") is None and trimmed.get("c") == {"generated_text": "c"}
+    trimmed.close()
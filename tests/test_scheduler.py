@@ -0,0 +1,194 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_scheduler.py
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from ShareLMAPI.server.scheduler import BatchScheduler, SamplingParams
+from ShareLMAPI.server.prefix_cache import PrefixCache
+
+@pytest.fixture(scope="module")
+def model_loader():
+    # A tiny randomly initialised model keeps the test CPU-only and offline
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_head=2, n_embd=32, vocab_size=128, n_positions=128)
+    model = GPT2LMHeadModel(config).eval()
+    return SimpleNamespace(model=model, tokenizer=SimpleNamespace(eos_token_id=None))
+
+def greedy_reference(model, input_ids, max_new_tokens):
+    with torch.inference_mode():
+        outputs = model.generate(torch.tensor([input_ids]), max_new_tokens=max_new_tokens, do_sample=False,
+                                 pad_token_id=0, eos_token_id=None)
+    return outputs[0, len(input_ids):].tolist()
+
+def test_batched_greedy_matches_generate(model_loader):
+    """Concurrent requests of different lengths produce the same tokens as unbatched greedy decoding"""
+    prompts = [[5, 6, 7], [9, 10, 11, 12, 13, 14], [20], [30, 31, 32, 33]]
+    max_new_tokens = [8, 3, 12, 5]
+
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=4, max_wait_ms=20)
+        try:
+            sequences = [
+                scheduler.submit(prompt, SamplingParams(max_new_tokens=n, do_sample=False))
+                for prompt, n in zip(prompts, max_new_tokens)
+            ]
+            return await asyncio.gather(*(sequence.result() for sequence in sequences))
+        finally:
+            scheduler.stop()
+
+    results = asyncio.run(run())
+    for prompt, n, output_ids in zip(prompts, max_new_tokens, results):
+        assert output_ids == greedy_reference(model_loader.model, prompt, n)
+
+def test_requests_join_between_decode_steps(model_loader):
+    """A request submitted while a batch is running joins it and still gets its own result"""
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=2, max_wait_ms=0)
+        try:
+            first = scheduler.submit([1, 2, 3], SamplingParams(max_new_tokens=20, do_sample=False))
+            await asyncio.sleep(0.01)
+            second = scheduler.submit([4, 5], SamplingParams(max_new_tokens=4, do_sample=False))
+            third = scheduler.submit([6], SamplingParams(max_new_tokens=4, do_sample=False))
+            return await asyncio.gather(first.result(), second.result(), third.result())
+        finally:
+            scheduler.stop()
+
+    first, second, third = asyncio.run(run())
+    assert first == greedy_reference(model_loader.model, [1, 2, 3], 20)
+    assert second == greedy_reference(model_loader.model, [4, 5], 4)
+    assert third == greedy_reference(model_loader.model, [6], 4)
+
+def test_prefix_cache_reuse_matches_generate(model_loader):
+    """Follow-up turns reuse the cached prefix and still decode exactly like a full prefill"""
+    prefix_cache = PrefixCache(max_bytes=1 << 20, min_prefix_tokens=2, block_size=1)
+    first_prompt = [3, 1, 4, 1, 5, 9]
+
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=4, max_wait_ms=0, prefix_cache=prefix_cache)
+        try:
+            first = await scheduler.submit(first_prompt, SamplingParams(max_new_tokens=5, do_sample=False)).result()
+            second_prompt = first_prompt + first + [2, 6]
+            second = await scheduler.submit(second_prompt, SamplingParams(max_new_tokens=5, do_sample=False)).result()
+            return first, second_prompt, second
+        finally:
+            scheduler.stop()
+
+    first, second_prompt, second = asyncio.run(run())
+    assert second == greedy_reference(model_loader.model, second_prompt, 5)
+    stats = prefix_cache.stats()
+    assert stats["hits"] == 1
+    # Everything but the last generated token of the first turn was fed to the model and cached
+    assert stats["reused_tokens"] == len(first_prompt) + len(first) - 1
+
+def test_prefix_cache_matches_whole_blocks():
+    """Prefixes are stored in whole blocks and the longest cached block prefix short of the prompt is reused"""
+    prefix_cache = PrefixCache(max_bytes=1 << 20, min_prefix_tokens=4, block_size=4)
+
+    def kv(length):
+        return ((torch.zeros(1, 1, length, 1), torch.zeros(1, 1, length, 1)),)
+
+    prompt = list(range(20))
+    prefix_cache.insert(prompt[:6], kv(6))
+    assert prefix_cache.stats()["entries"] == 0
+    prefix_cache.insert(prompt[:4], kv(4))
+    prefix_cache.insert(prompt[:12], kv(12))
+    prefix_cache.insert(prompt[:12], kv(12), namespace="adapter")
+    assert prefix_cache.lookup(prompt)[0] == 12
+    assert prefix_cache.lookup(prompt[:12])[0] == 4
+    assert prefix_cache.lookup(prompt[:9] + [99] * 8)[0] == 4
+    assert prefix_cache.lookup([99] + prompt[1:])[0] == 0
+    assert prefix_cache.lookup(prompt[:8], namespace="adapter")[0] == 0
+
+def test_cancel_and_deadline_stop_sequences(model_loader):
+    """Cancelled and expired sequences leave the batch early while the rest keep decoding"""
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=4, max_wait_ms=0)
+        try:
+            survivor = scheduler.submit([1, 2, 3], SamplingParams(max_new_tokens=60, do_sample=False))
+            cancelled = scheduler.submit([4, 5, 6], SamplingParams(max_new_tokens=60, do_sample=False))
+            expired = scheduler.submit([7, 8], SamplingParams(max_new_tokens=60, do_sample=False),
+                                       deadline=time.monotonic() - 1)
+            async for _ in cancelled:
+                cancelled.cancel()
+            await expired.result()
+            await survivor.result()
+            return survivor, cancelled, expired
+        finally:
+            scheduler.stop()
+
+    survivor, cancelled, expired = asyncio.run(run())
+    assert survivor.finish_reason == "length" and len(survivor.output_ids) == 60
+    assert cancelled.finish_reason == "cancelled" and len(cancelled.output_ids) < 60
+    assert expired.finish_reason == "timeout" and expired.output_ids == []
+
+def test_interactive_requests_skip_the_bulk_lane(model_loader):
+    """Queued interactive requests are admitted first and bulk requests leave reserved slots free"""
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=4, max_wait_ms=50, interactive_reserved_slots=1)
+        try:
+            # Hold the scheduler lock so every request is queued before the first batch forms.
+            with scheduler._cond:
+                bulk = [scheduler.submit([i + 1, i + 2], SamplingParams(max_new_tokens=30, do_sample=False),
+                                         priority="bulk") for i in range(5)]
+                interactive = scheduler.submit([9, 9], SamplingParams(max_new_tokens=30, do_sample=False))
+            await asyncio.gather(*(sequence.result() for sequence in bulk + [interactive]))
+            return bulk, interactive
+        finally:
+            scheduler.stop()
+
+    bulk, interactive = asyncio.run(run())
+    first_batch = [sequence for sequence in bulk if sequence.prefill_started_at == interactive.prefill_started_at]
+    assert first_batch == bulk[:2]
+    assert all(sequence.prefill_started_at > interactive.prefill_started_at for sequence in bulk[2:])
+
+def test_tenants_share_the_queue_by_weight(model_loader):
+    """A tenant with a deep backlog does not hold back another tenant's requests"""
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=1, max_wait_ms=0)
+        try:
+            params = lambda: SamplingParams(max_new_tokens=2, do_sample=False)
+            with scheduler._cond:
+                heavy = [scheduler.submit([1, 2], params(), tenant="heavy") for _ in range(6)]
+                light = [scheduler.submit([3, 4], params(), tenant="light", weight=2.0) for _ in range(2)]
+            await asyncio.gather(*(sequence.result() for sequence in heavy + light))
+            return heavy, light
+        finally:
+            scheduler.stop()
+
+    heavy, light = asyncio.run(run())
+    order = sorted(heavy + light, key=lambda sequence: sequence.prefill_started_at)
+    # Both of the lighter tenant's requests run before the heavy tenant's third one
+    assert order.index(light[1]) < order.index(heavy[2])
+    assert [sequence for sequence in order if sequence in heavy] == heavy
+
+def test_unbatchable_kwargs_fall_back():
+    """Beam search and other unsupported generation kwargs are left to model.generate"""
+    assert SamplingParams.from_request(50, 1.0, {"num_beams": 4}) is None
+    assert SamplingParams.from_request(50, 1.0, {"repetition_penalty": 1.2}) is None
+    assert SamplingParams.from_request(50, 1.0, {"top_k": 10}).top_k == 10
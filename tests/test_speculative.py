@@ -0,0 +1,121 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_speculative.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from ShareLMAPI.server.engine import InferenceEngine
+from ShareLMAPI.server.prefix_cache import PrefixCache
+from ShareLMAPI.server.schemas import GenerateRequest
+from ShareLMAPI.server.scheduler import BatchScheduler, SamplingParams
+from ShareLMAPI.server.speculative import SpeculativeDecoder, speculative_sample
+
+def tiny_model(seed, n_layer=2):
+    # Larger initial weights than GPT-2's default, so greedy outputs depend on the whole context
+    torch.manual_seed(seed)
+    return GPT2LMHeadModel(GPT2Config(n_layer=n_layer, n_head=2, n_embd=32, vocab_size=128, n_positions=128,
+                                      initializer_range=0.3)).eval()
+
+@pytest.fixture(scope="module")
+def model_loader():
+    return SimpleNamespace(model=tiny_model(0), tokenizer=SimpleNamespace(eos_token_id=None))
+
+def greedy_reference(model, input_ids, max_new_tokens):
+    with torch.inference_mode():
+        outputs = model.generate(torch.tensor([input_ids]), max_new_tokens=max_new_tokens, do_sample=False,
+                                 pad_token_id=0, eos_token_id=None)
+    return outputs[0, len(input_ids):].tolist()
+
+def run_greedy(model_loader, speculative, prompts, max_new_tokens, prefix_cache=None):
+    async def run():
+        scheduler = BatchScheduler(model_loader, max_batch_size=4, max_wait_ms=20, prefix_cache=prefix_cache,
+                                   speculative=speculative)
+        try:
+            sequences = [scheduler.submit(prompt, SamplingParams(max_new_tokens=n, do_sample=False))
+                         for prompt, n in zip(prompts, max_new_tokens)]
+            return await asyncio.gather(*(sequence.result() for sequence in sequences))
+        finally:
+            scheduler.stop()
+    return asyncio.run(run())
+
+def test_identical_draft_accepts_every_token(model_loader):
+    """A draft identical to the model has every proposal accepted and gives the same greedy output"""
+    speculative = SpeculativeDecoder(model_loader.model, num_speculative_tokens=4)
+    [output_ids] = run_greedy(model_loader, speculative, [[5, 6, 7]], [17])
+    assert output_ids == greedy_reference(model_loader.model, [5, 6, 7], 17)
+    stats = speculative.stats()
+    assert stats["acceptance_rate"] == 1.0
+    assert stats["tokens_per_step"] > 4
+
+def test_weak_draft_keeps_greedy_output(model_loader):
+    """Rejected proposals never change the output, also when a batch shrinks to one sequence or hits the prefix cache"""
+    speculative = SpeculativeDecoder(tiny_model(1, n_layer=1), num_speculative_tokens=3)
+    prefix_cache = PrefixCache(max_bytes=1 << 24, min_prefix_tokens=2)
+    prompts = [[5, 6, 7], [9, 10, 11, 12, 13, 14]]
+    max_new_tokens = [4, 20]
+    for _ in range(2):
+        results = run_greedy(model_loader, speculative, prompts, max_new_tokens, prefix_cache)
+        for prompt, n, output_ids in zip(prompts, max_new_tokens, results):
+            assert output_ids == greedy_reference(model_loader.model, prompt, n)
+        # The next turn continues each conversation from the KV cached when it finished.
+        prompts = [prompt + output_ids + [40] for prompt, output_ids in zip(prompts, results)]
+    assert prefix_cache.hits
+    stats = speculative.stats()
+    assert stats["steps"] > 0 and stats["acceptance_rate"] < 1.0
+
+def test_speculative_sampling_follows_the_model_distribution():
+    """Tokens from speculative sampling are distributed like the model's, not the draft's"""
+    generator = torch.Generator().manual_seed(0)
+    p = torch.tensor([[0.5, 0.3, 0.2], [1 / 3, 1 / 3, 1 / 3]])
+    q = torch.tensor([0.1, 0.2, 0.7])
+    counts = torch.zeros(3)
+    trials = 20000
+    for _ in range(trials):
+        draft_token = int(torch.multinomial(q, 1, generator=generator))
+        counts[speculative_sample(p, [q], [draft_token], generator)[0]] += 1
+    assert torch.allclose(counts / trials, p[0], atol=0.015)
+
+def test_engine_loads_the_configured_draft_model():
+    """The draft model from `model.speculative` is loaded and its acceptance rate reported with the engine stats"""
+    fake = {"device": "cpu", "n_layer": 2, "n_head": 4, "n_embd": 64, "max_positions": 256}
+    config = {"model": {"name": "fake", "loading_method": "fake", "fake": fake,
+                        "speculative": {"enabled": True, "num_speculative_tokens": 3, "draft_model": {
+                            "name": "fake", "loading_method": "fake", "fake": {**fake, "n_layer": 1, "seed": 1}}}}}
+    request = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 12, "temperature": 0.0}
+
+    async def run(config):
+        engine = InferenceEngine(config=config)
+        try:
+            return (await engine.generate(GenerateRequest(**request)))["generated_text"], engine.snapshot()
+        finally:
+            await engine.aclose()
+
+    text, stats = asyncio.run(run(config))
+    assert stats["speculative"]["steps"] > 0
+    assert stats["speculative"]["acceptance_rate"] is not None
+    del config["model"]["speculative"]
+    assert text == asyncio.run(run(config))[0]
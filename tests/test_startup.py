@@ -0,0 +1,79 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_startup.py
+import asyncio
+import os
+
+import torch
+import yaml
+
+from ShareLMAPI.server.load_model import ModelLoader
+from ShareLMAPI.server.registry import ModelRegistry
+
+def fake_config(tmp_path):
+    return {"model": {"name": "fake", "loading_method": "fake", "fake": {"max_positions": 256}},
+            "weight_cache": {"directory": str(tmp_path / "weights")}}
+
+def test_weight_cache_is_written_once_and_reused(tmp_path):
+    """The first load writes a safetensors copy that later loads use instead of rebuilding the model"""
+    first = ModelLoader(config=fake_config(tmp_path))
+    second = ModelLoader(config=fake_config(tmp_path))
+    assert first.load_timings["weight_cache"] == "miss"
+    assert second.load_timings["weight_cache"] == "hit"
+    (entry,) = os.listdir(tmp_path / "weights")
+    assert "model.safetensors" in os.listdir(tmp_path / "weights" / entry)
+
+    messages = [{"role": "user", "content": "hello"}]
+    prompt = first.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+    assert torch.equal(prompt, second.tokenizer.apply_chat_template(messages, add_generation_prompt=True,
+                                                                    return_tensors="pt"))
+    with torch.inference_mode():
+        assert torch.equal(first.model(prompt).logits, second.model(prompt).logits)
+
+    # Different settings build different weights, so they get their own entry
+    config = fake_config(tmp_path)
+    config["model"]["fake"]["seed"] = 1
+    assert ModelLoader(config=config).load_timings["weight_cache"] == "miss"
+
+def test_start_preloads_and_warms_up(tmp_path):
+    """The registry only reports ready after the preloaded model has loaded and warmed up"""
+    config = {**fake_config(tmp_path), "warmup": {"prompt_lengths": [8, 64]}, "scheduler": {"max_wait_ms": 0}}
+    path = tmp_path / "config.yaml"
+    path.write_text(yaml.safe_dump(config))
+    registry = ModelRegistry(str(path))
+
+    async def run():
+        try:
+            assert not (await registry.stats())["ready"]
+            await registry.start()
+            return await registry.stats()
+        finally:
+            await registry.aclose()
+
+    stats = asyncio.run(run())
+    assert stats["ready"] and stats["models"]["fake"]["loaded"]
+    timings = stats["startup"]["models"]["fake"]
+    assert {"tokenizer", "weights", "engine", "warmup"} <= set(timings)
+    assert timings["warmup"] > 0 and stats["startup"]["total"] >= timings["warmup"]
+    # Warmup prompts do not stay in the prefix cache
+    assert stats["models"]["fake"]["prefix_cache"]["entries"] == 0
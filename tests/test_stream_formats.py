@@ -0,0 +1,56 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_stream_formats.py
+import asyncio
+import json
+
+import httpx
+
+def test_stream_formats(model_server_app):
+    """Streams end with a usage event, and SSE/plain text are available for other consumers"""
+    async def stream(payload, headers=None):
+        transport = httpx.ASGITransport(app=model_server_app)
+        async with httpx.AsyncClient(base_url="http://model-server", transport=transport) as client:
+            response = await client.post("/generate_stream", json=payload, headers=headers)
+            return response.headers["content-type"], response.text
+
+    payload = {"dialogue_history": [{"role": "user", "content": "line one\nline two"}], "max_length": 6,
+               "temperature": 0.0}
+    content_type, body = asyncio.run(stream(payload))
+    assert content_type.startswith("application/x-ndjson")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert all(event["type"] == "token" for event in events[:-1])
+    done = events[-1]
+    assert done["type"] == "done"
+    assert done["finish_reason"] in ("stop", "length")
+    assert done["usage"]["completion_tokens"] <= 6
+    assert done["usage"]["total_tokens"] == done["usage"]["prompt_tokens"] + done["usage"]["completion_tokens"]
+    assert "ttft" in done["timing"]
+
+    content_type, body = asyncio.run(stream(payload, headers={"Accept": "text/event-stream"}))
+    assert content_type.startswith("text/event-stream")
+    assert body.rstrip("\n").split("\n\n")[-1].startswith("event: done\ndata: ")
+
+    content_type, text = asyncio.run(stream({**payload, "stream_format": "text"}))
+    assert content_type.startswith("text/plain")
+    assert text == "".join(event["text"] for event in events[:-1])
@@ -0,0 +1,124 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_tenants.py
+import asyncio
+import importlib
+
+import httpx
+import pytest
+
+from ShareLMAPI.server.tenants import RateLimitError, TenantPolicy, TokenBucket, UnknownTenantError, estimate_tokens
+
+CONFIG = {"tenants": {"enabled": True, "api_keys": {"key-a": "a", "key-b": "b"},
+                      "default_limits": {"tokens_per_minute": 60, "burst_tokens": 50},
+                      "limits": {"b": {"weight": 3, "priority": "bulk"}}}}
+
+def test_bucket_waits_for_refill_and_refunds_unused_tokens():
+    """A reservation past the burst reports a wait, and settling refunds the unused part"""
+    bucket = TokenBucket(600, burst_tokens=100)
+    assert bucket.reserve(80) == 0
+    retry_after = bucket.reserve(80)
+    assert 5 < retry_after <= 6
+    bucket.settle(80, 20)
+    assert bucket.reserve(80) == 0
+
+def test_identify_by_api_key():
+    """Tenants are found by X-API-Key or a bearer token and pick up their configured limits"""
+    policy = TenantPolicy(CONFIG)
+    assert policy.identify({"x-api-key": "key-a"}).name == "a"
+    tenant = policy.identify({"authorization": "Bearer key-b"})
+    assert tenant.name == "b" and tenant.weight == 3 and tenant.apply_priority("interactive") == "bulk"
+    with pytest.raises(UnknownTenantError):
+        policy.identify({"x-api-key": "nope"})
+    with pytest.raises(UnknownTenantError):
+        policy.identify({})
+    assert TenantPolicy({**CONFIG, "tenants": {**CONFIG["tenants"], "anonymous_tenant": "public"}}).identify({}).name == "public"
+    assert TenantPolicy({}).identify({"x-api-key": "key-a"}) is None
+
+def test_tenant_rate_limit():
+    """A tenant over its token rate is rejected with the time to wait"""
+    tenant = TenantPolicy(CONFIG).tenant("a")
+    tenant.reserve(estimate_tokens({"dialogue_history": [{"role": "user", "content": "x" * 200}], "max_length": 50}))
+    with pytest.raises(RateLimitError) as error:
+        tenant.reserve(50)
+    assert error.value.retry_after > 0
+
+def test_model_server_rejects_unknown_and_limited_tenants(model_server_app, monkeypatch):
+    """The model server answers 401 for unknown keys and 429 with rate limit headers once the budget is spent"""
+    # The first request reserves more than the burst, so the bucket is short until well after it finishes
+    model_server = importlib.import_module("ShareLMAPI.server.model_server")
+    monkeypatch.setattr(model_server, "tenant_policy", TenantPolicy(CONFIG))
+    body = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 60}
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app), base_url="http://model-server") as client:
+            unknown = await client.post("/generate", json=body, headers={"X-API-Key": "nope"})
+            first = await client.post("/generate", json=body, headers={"X-API-Key": "key-a"})
+            second = await client.post("/generate", json=body, headers={"X-API-Key": "key-a"})
+            return unknown, first, second
+
+    unknown, first, second = asyncio.run(run())
+    assert unknown.status_code == 401
+    assert first.status_code == 200
+    assert first.headers["X-RateLimit-Limit-Tokens"] == "60"
+    assert second.status_code == 429
+    assert int(second.headers["Retry-After"]) >= 1
+    assert "X-RateLimit-Remaining-Tokens" in second.headers
+
+def test_failed_requests_refund_their_reservation(model_server_app, monkeypatch):
+    """A request that fails inside the engine gives its reserved tokens back"""
+    model_server = importlib.import_module("ShareLMAPI.server.model_server")
+    policy = TenantPolicy(CONFIG)
+    monkeypatch.setattr(model_server, "tenant_policy", policy)
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("engine failed")
+
+    monkeypatch.setattr(model_server.engine, "generate", fail)
+    monkeypatch.setattr(model_server.engine, "generate_stream", fail)
+    body = {"dialogue_history": [{"role": "user", "content": "Hello"}], "max_length": 20}
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app), base_url="http://model-server") as client:
+            return [(await client.post(endpoint, json=body, headers={"X-API-Key": "key-a"})).status_code
+                    for endpoint in ("/generate", "/generate_stream")]
+
+    assert asyncio.run(run()) == [500, 500]
+    bucket = policy.tenant("a").bucket
+    assert bucket.tokens == bucket.capacity
+
+def test_model_reload_needs_an_admin_key_and_allowed_settings(model_server_app, monkeypatch):
+    """Reloads are refused without admin keys, with a wrong key, or when overriding settings not opted into"""
+    model_server = importlib.import_module("ShareLMAPI.server.model_server")
+    name = model_server.engine.default_model
+
+    async def reload(headers=None, settings=None):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app), base_url="http://model-server") as client:
+            response = await client.post(f"/models/{name}/reload", json={"settings": settings}, headers=headers)
+            return response.status_code
+
+    assert asyncio.run(reload({"X-API-Key": "admin"})) == 403
+    monkeypatch.setattr(model_server, "ADMIN_API_KEYS", ["admin"])
+    assert asyncio.run(reload({"X-API-Key": "key-a"})) == 401
+    assert asyncio.run(reload({"Authorization": "Bearer admin"}, {"loading_method": "standard"})) == 400
+    assert asyncio.run(reload({"Authorization": "Bearer admin"})) == 200
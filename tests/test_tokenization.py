@@ -0,0 +1,105 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_tokenization.py
+import asyncio
+
+import pytest
+from pydantic import ValidationError
+
+from ShareLMAPI.server.engine import InferenceEngine
+from ShareLMAPI.server.fake_model import build_fake_tokenizer
+from ShareLMAPI.server.ipc import EngineError
+from ShareLMAPI.server.schemas import GenerateRequest
+from ShareLMAPI.server.tokenization import TokenizationStage
+
+SYSTEM = {"role": "system", "content": "You are a helpful assistant. " * 8}
+
+def conversation(turns):
+    messages = [SYSTEM]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"question {turn}"})
+        messages.append({"role": "assistant", "content": f"answer {turn}"})
+    return messages + [{"role": "user", "content": "and now?"}]
+
+@pytest.fixture
+def tokenizer():
+    # Role markers are added tokens, as in ChatML or Llama 3 templates, so prompts can be split on them
+    tokenizer = build_fake_tokenizer()
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<|system|>", "<|user|>", "<|assistant|>"]})
+    return tokenizer
+
+def test_memoized_prefixes_tokenize_like_the_whole_prompt(tokenizer):
+    """Prompts assembled from memoized prefixes match apply_chat_template exactly"""
+    stage = TokenizationStage(tokenizer, max_entries=3)
+
+    async def run():
+        try:
+            results = []
+            for turns in [0, 1, 2, 1, 3]:
+                results.append((turns, await stage.encode(conversation(turns))))
+            return results
+        finally:
+            stage.shutdown()
+
+    system_length = len(tokenizer.apply_chat_template([SYSTEM]))
+    for turns, (token_ids, length) in asyncio.run(run()):
+        assert token_ids == tokenizer.apply_chat_template(conversation(turns), add_generation_prompt=True)
+        assert length == system_length
+    stats = stage.stats()
+    # Every prompt after the first reuses at least the system prompt
+    assert stats["hits"] == 4 and stats["entries"] <= 3
+
+def test_pre_tokenized_input_and_attention_mask():
+    """input_ids skip tokenization and the unbatched path attends to pad tokens inside the prompt"""
+    config = {"model": {"name": "fake", "loading_method": "fake", "fake": {"max_positions": 256}},
+              "scheduler": {"max_wait_ms": 0}}
+    batched = InferenceEngine(config=config)
+    unbatched = InferenceEngine(config={**config, "scheduler": {"enabled": False}})
+    tokenizer = batched.model_loader.tokenizer
+    # The fake tokenizer's pad token is also its EOS token, which chat prompts may contain
+    input_ids = tokenizer.encode("hello") + [tokenizer.pad_token_id] + tokenizer.encode("world")
+
+    def request(**fields):
+        return GenerateRequest(max_length=6, temperature=0.0, generation_kwargs={"do_sample": False}, **fields)
+
+    async def run():
+        try:
+            texts = [(await engine.generate(request(input_ids=input_ids)))["generated_text"]
+                     for engine in (batched, unbatched)]
+            messages = [{"role": "user", "content": "hi"}]
+            prompt_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+            assert (await batched.generate(request(dialogue_history=messages))) == \
+                (await batched.generate(request(input_ids=prompt_ids)))
+            with pytest.raises(EngineError):
+                await batched.generate(request(input_ids=[len(tokenizer)]))
+            return texts
+        finally:
+            await batched.aclose()
+            await unbatched.aclose()
+
+    batched_text, unbatched_text = asyncio.run(run())
+    assert batched_text == unbatched_text
+    generation_kwargs = unbatched._generation_kwargs(request(input_ids=input_ids), input_ids, None)
+    assert generation_kwargs["attention_mask"].all()
+    with pytest.raises(ValidationError):
+        GenerateRequest(input_ids=[])
@@ -0,0 +1,96 @@
+# MIT License
+
+# Copyright (c) 2024 starpig1129
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# test_wire.py
+import asyncio
+import gzip
+import json
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from ShareLMAPI.server.wire import CompressionMiddleware, compress_body
+
+def post(app, path, **kwargs):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post(path, **kwargs)
+    return asyncio.run(run())
+
+def test_compression_middleware():
+    """Request bodies are inflated, complete responses gzipped and streams left alone"""
+    app = FastAPI()
+
+    @app.post("/echo")
+    async def echo(body: dict):
+        return JSONResponse(body)
+
+    @app.post("/stream")
+    async def stream():
+        return StreamingResponse(iter([b"a" * 100, b"b" * 100]), media_type="text/plain")
+
+    wrapped = CompressionMiddleware(app, enabled=True, min_bytes=64, max_body_bytes=10_000)
+    document = {"text": "hello " * 200}
+    content, headers = compress_body(json.dumps(document).encode(), enabled=True, min_bytes=64)
+    assert headers == {"Content-Encoding": "gzip"}
+    response = post(wrapped, "/echo", content=content, headers={**headers, "Content-Type": "application/json"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == document
+
+    response = post(wrapped, "/stream")
+    assert "content-encoding" not in response.headers
+    assert response.text == "a" * 100 + "b" * 100
+
+    bomb = gzip.compress(json.dumps({"text": "x" * 100_000}).encode())
+    response = post(wrapped, "/echo", content=bomb, headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert response.status_code == 400
+
+def test_gateway_forwards_the_body_untouched(model_server_app, gateway_module, monkeypatch):
+    """The gateway sends the client's bytes on, compressed when large, and passes the response back"""
+    gateway = gateway_module
+    monkeypatch.setattr(gateway, "compression_config", {"enabled": True, "min_bytes": 256})
+    sent = []
+
+    async def record(request):
+        sent.append((request.headers.get("content-encoding"), request.headers["x-request-id"], request.content))
+
+    payload = json.dumps({"dialogue_history": [{"role": "user", "content": "hello " * 100}],
+                          "max_length": 4, "temperature": 0.0, "unknown_field": 1}).encode()
+
+    async def run():
+        upstream = httpx.AsyncClient(transport=httpx.ASGITransport(app=model_server_app), event_hooks={"request": [record]})
+        monkeypatch.setattr(gateway, "http_client", upstream)
+        async with upstream, httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway.app), base_url="http://gateway") as client:
+            response = await client.post("/generate", content=payload, headers={"X-Request-ID": "req-1"})
+            stream = await client.post("/generate_stream", content=payload)
+            return response, stream
+
+    response, stream = asyncio.run(run())
+    assert json.loads(stream.text.splitlines()[-1])["type"] == "done"
+    assert stream.headers["x-request-id"] == sent[1][1]
+    assert response.status_code == 200
+    assert response.headers["x-request-id"] == "req-1"
+    assert response.json()["usage"]["completion_tokens"] <= 4
+    encoding, request_id, content = sent[0]
+    assert encoding == "gzip" and request_id == "req-1"
+    assert gzip.decompress(content) == payload